@@ -0,0 +1,66 @@
+"""
+Wall-clock reduction time of one FedAvg round vs. number of devices, for
+1, 2, 4 and 8 aggregator worker processes.
+
+Run from the repository root:
+  python -m benchmarks.aggregation_benchmark --model_size 1000000
+"""
+import argparse
+import logging
+import time
+
+import torch
+
+from pyfl.server.aggregator import AggregatorPool, MasterAggregator
+
+parser = argparse.ArgumentParser(description='Aggregation benchmark')
+parser.add_argument(
+  '--model_size', default=1000000, type=int, help='Number of parameters per update')
+parser.add_argument(
+  '--devices', default=[16, 64, 256], type=int, nargs='+', help='Device counts to benchmark')
+parser.add_argument(
+  '--aggregators', default=[1, 2, 4, 8], type=int, nargs='+', help='Aggregator counts to benchmark')
+parser.add_argument(
+  '--repeats', default=3, type=int, help='Rounds timed per setting, the best one is reported')
+
+
+def make_updates(num_devices, model_size):
+  # Decoded updates are plain tensors, the pool copies them into shared memory
+  return {device_id: (torch.randn(model_size), 1 + device_id % 7)
+          for device_id in range(num_devices)}
+
+
+def fresh_copy(updates):
+  # Pickling moves a tensor into shared memory for good, every round gets new ones
+  return {device_id: (update.clone(), num_samples) for device_id, (update, num_samples) in updates.items()}
+
+
+def time_reduction(num_aggregators, updates, repeats):
+  configs = [{'aggregator_id': i, 'device_ids': list(updates.keys())[i::num_aggregators]}
+             for i in range(num_aggregators)]
+  pool = AggregatorPool(configs, MasterAggregator({'master_aggregator_id': 0}))
+  # Warm up so worker start up is not counted
+  pool.reduce(fresh_copy(updates))
+  best = float('inf')
+  for _ in range(repeats):
+    round_updates = fresh_copy(updates)
+    start = time.perf_counter()
+    pool.reduce(round_updates)
+    best = min(best, time.perf_counter() - start)
+  pool.shutdown()
+  return best
+
+
+def main():
+  args = parser.parse_args()
+  logging.getLogger('pyfl.server.aggregator').setLevel(logging.WARNING)
+  print('{:>8} | '.format('devices') + ' | '.join('{:>12}'.format('{} aggr (s)'.format(n))
+                                                  for n in args.aggregators))
+  for num_devices in args.devices:
+    updates = make_updates(num_devices, args.model_size)
+    timings = [time_reduction(n, updates, args.repeats) for n in args.aggregators]
+    print('{:>8} | '.format(num_devices) + ' | '.join('{:>12.4f}'.format(t) for t in timings))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,108 @@
+"""
+Time to accuracy of synchronous FedAvg rounds vs. buffered asynchronous
+aggregation, when some of the simulated devices are stragglers.
+Uses a synthetic MNIST sized task (a fixed noisy template per class) so
+nothing needs to be downloaded. The device pools run in threads.
+
+Run from the repository root:
+  python -m benchmarks.async_benchmark --target_accuracy 0.9
+"""
+import argparse
+import threading
+
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.device.simulation import SimulatedDevicePool
+from pyfl.models.flat_params import FlatParameters
+from pyfl.server import metrics
+from pyfl.server.simulation import SimulationServer
+from pyfl.utils import get_model
+
+parser = argparse.ArgumentParser(description='Async aggregation benchmark')
+parser.add_argument(
+  '--num_workers', default=4, type=int, help='Device pools')
+parser.add_argument(
+  '--num_devices', default=32, type=int, help='Number of simulated devices')
+parser.add_argument(
+  '--samples_per_device', default=20, type=int, help='Shard size of every device')
+parser.add_argument(
+  '--stragglers', default=0.25, type=float, help='Fraction of slow devices')
+parser.add_argument(
+  '--straggler_latency', default=0.5, type=float, help='Extra seconds a slow device takes')
+parser.add_argument(
+  '--clients_per_round', default=8, type=int, help='Devices per synchronous round')
+parser.add_argument(
+  '--buffer_size', default=4, type=int, help='Updates per asynchronous model version')
+parser.add_argument(
+  '--target_accuracy', default=0.9, type=float, help='Accuracy to reach')
+parser.add_argument(
+  '--updates', default=320, type=int, help='Device updates applied in each mode')
+parser.add_argument(
+  '--server_lr', default=0.2, type=float, help='Step size of the server on the averaged update')
+
+TASK_CONFIG = {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.05}}
+
+
+def synthetic_task(num_samples, seed=0):
+  templates = torch.randn(10, 1, 28, 28, generator=torch.Generator().manual_seed(1234))
+  generator = torch.Generator().manual_seed(seed)
+  targets = torch.randint(0, 10, (num_samples,), generator=generator)
+  data = templates[targets] + torch.randn(num_samples, 1, 28, 28, generator=generator)
+  return torch.utils.data.TensorDataset(data, targets)
+
+
+def run(args, asynchronous):
+  torch.manual_seed(0)
+  num_samples = args.num_devices * args.samples_per_device
+  trainset = synthetic_task(num_samples)
+  test_loader = torch.utils.data.DataLoader(synthetic_task(1000, seed=1), batch_size=1000)
+  partitions = {device_id: torch.arange(device_id * args.samples_per_device,
+                                        (device_id + 1) * args.samples_per_device).numpy()
+                for device_id in range(args.num_devices)}
+  num_slow = int(args.num_devices * args.stragglers)
+  latency = {device_id: args.straggler_latency for device_id in range(num_slow)}
+
+  server_id = 0
+  communicator = Communicator()
+  owners = {}
+  threads = []
+  for worker_id in range(1, args.num_workers + 1):
+    device_ids = list(range(worker_id - 1, args.num_devices, args.num_workers))
+    owners.update({device_id: worker_id for device_id in device_ids})
+    communicator.register(worker_id, server_id)
+    pool = SimulatedDevicePool({'pool_id': worker_id, 'server_id': server_id, 'device_ids': device_ids,
+                                'task_config': TASK_CONFIG, 'batch_size': 10, 'local_epochs': 1,
+                                'latency': latency}, trainset, partitions, communicator)
+    threads.append(threading.Thread(target=pool.serve))
+  for thread in threads:
+    thread.start()
+
+  model, _ = get_model(TASK_CONFIG)
+  server = SimulationServer({'server_id': server_id, 'owners': owners,
+                             'clients_per_round': args.clients_per_round,
+                             'buffer_size': args.buffer_size, 'server_lr': args.server_lr},
+                            communicator, FlatParameters(model).weights,
+                            lambda: metrics.evaluate(model, test_loader))
+  if asynchronous:
+    timeline = server.run_async(args.updates // args.buffer_size)
+  else:
+    timeline = server.run_sync(args.updates // args.clients_per_round)
+  server.stop_workers()
+  for thread in threads:
+    thread.join()
+  return timeline
+
+
+def main():
+  args = parser.parse_args()
+  for name, asynchronous in (('sync', False), ('async', True)):
+    timeline = run(args, asynchronous)
+    seconds = timeline.time_to_accuracy(args.target_accuracy)
+    print('{:>6}: time to {:.0%} accuracy {}, best accuracy {:.2%} after {:.1f} s'.format(
+      name, args.target_accuracy, '{:.1f} s'.format(seconds) if seconds is not None else 'not reached',
+      timeline.best(), timeline.points[-1][0]))
+
+
+if __name__ == '__main__':
+  main()
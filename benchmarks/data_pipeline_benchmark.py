@@ -0,0 +1,69 @@
+"""
+Training data throughput, in samples per second, of the per-sample PIL
+transform DataLoader vs. the pre-normalized TensorBatchLoader.
+Uses random CIFAR10 sized images so nothing needs to be downloaded.
+
+Run from the repository root:
+  python -m benchmarks.data_pipeline_benchmark --num_samples 10000
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from pyfl.datasets import TensorBatchLoader, get_transforms
+
+parser = argparse.ArgumentParser(description='Data pipeline benchmark')
+parser.add_argument(
+  '--dataset', default='cifar10', type=str, help='Dataset whose shapes and transforms are used')
+parser.add_argument(
+  '--num_samples', default=10000, type=int, help='Number of samples in the shard')
+parser.add_argument(
+  '--batch_size', default=100, type=int, help='Batch size')
+
+
+class PILDataset(torch.utils.data.Dataset):
+  # Mirrors what torchvision's CIFAR/MNIST datasets do per sample
+  def __init__(self, data, targets, transform):
+    self.data = data
+    self.targets = targets
+    self.transform = transform
+
+  def __len__(self):
+    return len(self.targets)
+
+  def __getitem__(self, index):
+    return self.transform(Image.fromarray(self.data[index])), int(self.targets[index])
+
+
+def throughput(loader, num_samples):
+  start = time.perf_counter()
+  for _ in loader:
+    pass
+  return num_samples / (time.perf_counter() - start)
+
+
+def main():
+  args = parser.parse_args()
+  shape = (args.num_samples, 28, 28) if args.dataset == 'mnist' else (args.num_samples, 32, 32, 3)
+  data = np.random.randint(0, 256, size=shape, dtype=np.uint8)
+  targets = np.random.randint(0, 10, size=args.num_samples)
+  transform_train, _ = get_transforms(args.dataset)
+
+  pil_loader = torch.utils.data.DataLoader(PILDataset(data, targets, transform_train),
+                                           batch_size=args.batch_size, shuffle=True)
+  start = time.perf_counter()
+  tensor_loader = TensorBatchLoader(data, targets, args.dataset, args.batch_size, train=True)
+  setup = time.perf_counter() - start
+
+  pil = throughput(pil_loader, args.num_samples)
+  tensor = throughput(tensor_loader, args.num_samples)
+  print('PIL transforms + DataLoader : {:>10.0f} samples/s'.format(pil))
+  print('TensorBatchLoader           : {:>10.0f} samples/s ({:.3f}s one-time normalization)'.format(tensor, setup))
+  print('Speedup                     : {:>10.1f}x'.format(tensor / pil))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,59 @@
+"""
+Downlink bytes of the global model broadcast: the full model to every selected
+device vs. deltas from the version each device holds. Devices take part in a
+round with probability --participation, the model moves by a random step every
+round.
+
+Run from the repository root:
+  python -m benchmarks.delta_benchmark --model resnet20 --participation 0.8
+"""
+import argparse
+import logging
+import random
+
+import torch
+
+from pyfl.communication.delta import ModelHistory
+from pyfl.models.flat_params import FlatParameters
+from pyfl.models.registry import build_model
+
+parser = argparse.ArgumentParser(description='Delta broadcast benchmark')
+parser.add_argument(
+  '--model', default='resnet20', type=str, help='Model to use')
+parser.add_argument(
+  '--num_devices', default=100, type=int, help='Number of devices')
+parser.add_argument(
+  '--participation', default=0.8, type=float, help='Probability of a device taking part in a round')
+parser.add_argument(
+  '--rounds', default=20, type=int, help='Rounds')
+parser.add_argument(
+  '--delta_history', default=4, type=int, help='Versions a delta can start from')
+parser.add_argument(
+  '--max_delta_chain', default=8, type=int, help='Deltas in a row before the full model is sent again')
+
+
+def main():
+  args = parser.parse_args()
+  logging.getLogger('pyfl.communication.compression').setLevel(logging.INFO)
+  rng = random.Random(0)
+  weights = FlatParameters(build_model(args.model)).weights.detach()
+  full_nbytes = weights.numel() * weights.element_size()
+  for codec in ('none', 'qsgd8'):
+    history = ModelHistory(weights, args.delta_history, codec, args.max_delta_chain)
+    held = {}
+    dense, sent = 0, 0
+    for _ in range(args.rounds):
+      for device_id in range(args.num_devices):
+        if rng.random() < args.participation:
+          payload = history.encode(device_id, held.get(device_id))
+          held[device_id] = payload.version
+          dense += full_nbytes
+          sent += payload.nbytes()
+      weights = weights - torch.randn_like(weights) * 1e-3
+      history.commit(weights)
+    print('{} deltas: {:.1f} MB full models -> {:.1f} MB ({:.1f}x less)'.format(
+      codec, dense / 1e6, sent / 1e6, dense / float(sent)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,49 @@
+"""
+Device setup time: building every device's model and optimizer from scratch
+vs. copying the registry's cached template of the architecture.
+
+Run from the repository root:
+  python -m benchmarks.model_build_benchmark --model vgg11 --num_devices 50
+"""
+import argparse
+import importlib
+import time
+
+from pyfl.models.registry import MODELS, build_optimizer, clear_templates
+from pyfl.utils import get_model
+
+parser = argparse.ArgumentParser(description='Model build benchmark')
+parser.add_argument(
+  '--model', default='resnet20', type=str, help='Model to use')
+parser.add_argument(
+  '--num_classes', default=10, type=int, help='Number of classes')
+parser.add_argument(
+  '--num_devices', default=50, type=int, help='Number of devices set up on the node')
+
+
+def main():
+  args = parser.parse_args()
+  task_config = {'model': args.model, 'optimizer': 'sgd', 'num_classes': args.num_classes,
+                 'lr_params': {'initial_lr': 0.01}}
+  module, factory = MODELS[args.model]
+  factory = getattr(importlib.import_module(module), factory)
+
+  start = time.perf_counter()
+  for _ in range(args.num_devices):
+    model = factory(args.num_classes)
+    build_optimizer('sgd', model.parameters(), task_config['lr_params'])
+  fresh = time.perf_counter() - start
+
+  clear_templates()
+  start = time.perf_counter()
+  for _ in range(args.num_devices):
+    get_model(task_config)
+  cached = time.perf_counter() - start
+
+  print('{} devices of {}: {:.1f} ms/device fresh, {:.1f} ms/device from the template ({:.1f}x)'.format(
+    args.num_devices, args.model, 1000 * fresh / args.num_devices, 1000 * cached / args.num_devices,
+    fresh / cached))
+
+
+if __name__ == '__main__':
+  main()
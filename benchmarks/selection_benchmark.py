@@ -0,0 +1,58 @@
+"""
+Device selection time: the previous selector loop over a dict of registered
+devices vs. the selection policies over the DeviceTable.
+
+Run from the repository root:
+  python -m benchmarks.selection_benchmark --num_devices 100000 --clients_per_round 100
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from pyfl.server.selection import DeviceTable, get_selection_policy
+
+parser = argparse.ArgumentParser(description='Device selection benchmark')
+parser.add_argument(
+  '--num_devices', default=100000, type=int, help='Number of registered devices')
+parser.add_argument(
+  '--clients_per_round', default=100, type=int, help='Devices selected every round')
+parser.add_argument(
+  '--num_strata', default=10, type=int, help='Number of strata of the devices')
+parser.add_argument(
+  '--rounds', default=20, type=int, help='Number of selections timed')
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(0)
+  devices = {device_id: {'device_id': device_id, 'ready': True} for device_id in range(args.num_devices)}
+  table = DeviceTable()
+  for device_id in range(args.num_devices):
+    table.add(device_id, stratum=device_id % args.num_strata)
+  table.loss[:len(table)] = rng.random(len(table))
+  table.latency[:len(table)] = rng.exponential(size=len(table))
+
+  start = time.perf_counter()
+  for _ in range(args.rounds):
+    ready = [device_id for device_id, device in devices.items() if device['ready']]
+    random.sample(ready, args.clients_per_round)
+  baseline = (time.perf_counter() - start) / args.rounds
+  print('{} devices, {} per round: dict scan {:.2f} ms'.format(
+    args.num_devices, args.clients_per_round, 1000 * baseline))
+
+  for name in ['uniform', 'stratified', 'power_of_choice', 'latency']:
+    policy = get_selection_policy({'selection_policy': name, 'seed': 0})
+    elapsed = 0.
+    for _ in range(args.rounds):
+      table.available[:len(table)] = True
+      start = time.perf_counter()
+      policy.select(table, args.clients_per_round)
+      elapsed += time.perf_counter() - start
+    elapsed /= args.rounds
+    print('  {:<16} {:.2f} ms ({:.1f}x)'.format(name, 1000 * elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,56 @@
+"""
+Device sharding: fixed chunks of consecutive devices vs. consistent hashing
+and load-aware bin packing, over devices with skewed update sizes and round
+times. Reports the most loaded shard against the mean and the devices moved
+when a shard is added.
+
+Run from the repository root:
+  python -m benchmarks.sharding_benchmark --num_devices 10000 --num_shards 16
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pyfl.server.sharding import ShardMap
+
+parser = argparse.ArgumentParser(description='Device sharding benchmark')
+parser.add_argument(
+  '--num_devices', default=10000, type=int, help='Number of devices')
+parser.add_argument(
+  '--num_shards', default=16, type=int, help='Number of selectors or aggregators')
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(0)
+  # Devices joining later are slower, as when new hardware classes connect
+  nbytes = rng.lognormal(10., 1., args.num_devices) * np.linspace(1., 4., args.num_devices)
+  latency = rng.lognormal(0., 1., args.num_devices) * np.linspace(1., 4., args.num_devices)
+  cost = nbytes / nbytes.mean() + latency / latency.mean()
+
+  chunks = np.array_split(cost, args.num_shards)
+  loads = np.array([chunk.sum() for chunk in chunks])
+  print('{} devices over {} shards'.format(args.num_devices, args.num_shards))
+  print('  fixed chunks  max / mean load {:.2f}'.format(loads.max() / loads.mean()))
+
+  for strategy in ['hash', 'balanced']:
+    shard_map = ShardMap({'num_shards': args.num_shards, 'strategy': strategy, 'smoothing': 1.})
+    start = time.perf_counter()
+    for device_id in range(args.num_devices):
+      shard_map.add(device_id)
+    join = (time.perf_counter() - start) / args.num_devices
+    for device_id in range(args.num_devices):
+      shard_map.record(device_id, nbytes[device_id], latency[device_id])
+    start = time.perf_counter()
+    moved = len(shard_map.rebalance())
+    rebalance = time.perf_counter() - start
+    loads = shard_map.loads()
+    added = len(shard_map.add_shard())
+    print('  {:<13} max / mean load {:.2f}, {:.0f} us per join, rebalance moved {} devices in {:.1f} ms, '
+          'a new shard moved {} devices'.format(strategy, loads.max() / loads.mean(), 1e6 * join, moved,
+                                                1000 * rebalance, added))
+
+
+if __name__ == '__main__':
+  main()
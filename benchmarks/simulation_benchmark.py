@@ -0,0 +1,60 @@
+"""
+Training throughput, in client samples per second, of a simulated device pool
+training its devices one after another vs. K at a time over stacked weights.
+Uses random MNIST sized images so nothing needs to be downloaded.
+
+Run from the repository root:
+  python -m benchmarks.simulation_benchmark --num_devices 64 --vectorize 64
+"""
+import argparse
+import time
+
+import torch
+
+from pyfl.device.simulation import SimulatedDevicePool
+
+parser = argparse.ArgumentParser(description='Simulation benchmark')
+parser.add_argument(
+  '--model', default='lenet', type=str, help='Model to use')
+parser.add_argument(
+  '--num_devices', default=64, type=int, help='Number of simulated devices')
+parser.add_argument(
+  '--samples_per_device', default=20, type=int, help='Shard size of every device')
+parser.add_argument(
+  '--batch_size', default=5, type=int, help='Local batch size')
+parser.add_argument(
+  '--vectorize', default=64, type=int, help='Devices trained together in the vectorized pool')
+parser.add_argument(
+  '--rounds', default=3, type=int, help='Timed rounds')
+
+
+def main():
+  args = parser.parse_args()
+  num_samples = args.num_devices * args.samples_per_device
+  trainset = torch.utils.data.TensorDataset(torch.randn(num_samples, 1, 28, 28),
+                                            torch.randint(0, 10, (num_samples,)))
+  partitions = {device_id: torch.arange(device_id * args.samples_per_device,
+                                        (device_id + 1) * args.samples_per_device).numpy()
+                for device_id in range(args.num_devices)}
+  pool_config = {
+    'pool_id': 1,
+    'server_id': 0,
+    'device_ids': list(range(args.num_devices)),
+    'task_config': {'model': args.model, 'optimizer': 'sgd'},
+    'batch_size': args.batch_size,
+    'local_epochs': 1
+  }
+  for vectorize in (0, args.vectorize):
+    pool = SimulatedDevicePool(dict(pool_config, vectorize=vectorize), trainset, partitions)
+    global_weights = pool.flat_params.weights.clone()
+    pool.run_round(global_weights)
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+      pool.run_round(global_weights)
+    elapsed = time.perf_counter() - start
+    print('{:>12}: {:10.0f} samples/s'.format('sequential' if vectorize < 2 else 'vectorize {}'.format(vectorize),
+                                              args.rounds * num_samples / elapsed))
+
+
+if __name__ == '__main__':
+  main()
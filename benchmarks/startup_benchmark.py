@@ -0,0 +1,54 @@
+"""
+Import time per process role. Every role is imported in a fresh interpreter,
+the way a spawned process starts, and the benchmark reports the median wall
+time and whether torchvision or the model zoo were pulled in.
+
+Run from the repository root:
+  python -m benchmarks.startup_benchmark --repeat 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description='Startup benchmark')
+parser.add_argument(
+  '--repeat', default=5, type=int, help='Fresh interpreters per role')
+
+# role -> modules the process of that role imports before it does any work
+ROLES = {
+  'torch only': ['torch'],
+  'spawned child (main)': ['main'],
+  'server': ['main', 'pyfl.server.server'],
+  'device': ['main', 'pyfl.device.device', 'pyfl.datasets'],
+  'simulation worker': ['main', 'pyfl.device.simulation', 'pyfl.datasets'],
+}
+
+HEAVY = ['torchvision', 'pyfl.datasets', 'pyfl.models.vgg', 'pyfl.models.resnet', 'pyfl.models.lenet']
+
+SCRIPT = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+  importlib.import_module(module)
+print(json.dumps([time.perf_counter() - start, [m for m in {heavy!r} if m in sys.modules]]))
+'''
+
+
+def time_imports(modules):
+  out = subprocess.run([sys.executable, '-c', SCRIPT.format(modules=modules, heavy=HEAVY)],
+                       check=True, capture_output=True, text=True).stdout
+  return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+  args = parser.parse_args()
+  for role, modules in ROLES.items():
+    runs = [time_imports(modules) for _ in range(args.repeat)]
+    print('{:<22} {:7.0f} ms   loads: {}'.format(
+      role, 1000 * statistics.median(run[0] for run in runs), ', '.join(runs[0][1]) or '-'))
+
+
+if __name__ == '__main__':
+  main()
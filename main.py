@@ -7,26 +7,19 @@ import torch.multiprocessing as mp
 from torch.multiprocessing import Process, Value
 
 from pyfl.args import get_args
-from pyfl.communication.communicator import Communicator
-from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
-from pyfl.datasets import get_data
-from pyfl.device.device import Device
-from pyfl.server.server import Server
-from pyfl.utils import get_logger, setup_dirs
-
-if torch.cuda.is_available():
-  device = 'cuda'
-  cudnn.benchmark = True
-else:
-  device = 'cpu'
-
-setup_dirs()
-args = get_args()
+from pyfl.communication.communicator import Communicator, get_communicator
+from pyfl.utils import get_logger, get_point_id, setup_dirs
+
+# Every spawned process re-imports this module: the role specific modules
+# (torchvision and the datasets, the device, the server) are imported by the
+# functions that need them, and the run arguments are parsed once in the main
+# process and passed down.
 logger = get_logger(__name__)
 
 # SERVER_ID = Value('i',0)
-device2server = DeviceServerMessage()
-server2device = ServerDeviceMessage()
+# With --role server/device the launchers share no memory, the server takes
+# this id and the devices on the other hosts know it without asking
+SPLIT_SERVER_ID = 0
 
 class Coordinator:
   def run(self, i=1):
@@ -35,29 +28,67 @@ class Coordinator:
     print("The number of batches per device {}".format(dataset_size // i))
 
 
-def spawn_server(communicator, server_id, dataset=None):
+def spawn_server(args, communicator, server_id, dataset=None):
+  from pyfl.server.checkpoint import latest_checkpoint
+  from pyfl.server.server import Server
+
   server_id.acquire()
-  server_id.value = os.getpid()
+  server_id.value = SPLIT_SERVER_ID if args.role == 'server' else os.getpid()
   server_id.release()
+  if args.transport != 'pipe':
+    # Devices connect to the server's socket, possibly from other hosts
+    communicator.listen(server_id.value)
 
   server_config = {
     'server_id': server_id.value,
     'num_selectors': 1,
     'num_coordinators': 1,
     'num_master_aggregators': 1,
-    'num_aggregators': 1,
-    'rounds': 1,
+    'num_aggregators': args.num_aggregators,
+    'rounds': args.rounds,
+    'server_lr': args.server_lr,
+    'task_config': get_task_config(args),
+    'clients_per_round': args.clients_per_round,
+    'round_timeout': args.round_timeout,
+    'deadline': args.round_deadline,
+    'quorum': args.quorum,
+    'expected_dropout': args.expected_dropout,
+    'heartbeat_interval': args.heartbeat_interval,
+    'liveness_timeout': args.liveness_timeout,
+    'max_devices_per_selector': args.max_devices_per_selector,
+    'sharding': args.sharding,
+    'selection_policy': args.selection_policy,
+    'power_of_choice_d': args.power_of_choice_d,
+    'latency_alpha': args.latency_alpha,
+    'seed': args.partition_seed,
+    'delta_history': args.delta_history,
+    'delta_codec': args.delta_codec,
+    'max_delta_chain': args.max_delta_chain,
+    'checkpoint_dir': args.checkpoint_dir,
+    'checkpoint_interval': args.checkpoint_interval,
+    'checkpoint_keep': args.checkpoint_keep,
     'run_args': args
   }
   logger.info("Spawning server with device config : {}".format(server_config))
   server = Server(server_config,
                   communicator=communicator)
+  if args.resume:
+    checkpoint = latest_checkpoint(args.checkpoint_dir)
+    if checkpoint is None:
+      logger.info('No checkpoint in {}, starting from round 0'.format(args.checkpoint_dir))
+    else:
+      server.restore(checkpoint)
   server.run_server()
 
 
-def spawn_device(communicator, server_id, dataset):
+def spawn_device(args, communicator, server_id, dataset, rank=1):
+  from pyfl.communication.compression import get_compressor
+  from pyfl.device.device import Device
+
+  if torch.cuda.is_available():
+    cudnn.benchmark = True
   device_config = {
-    'device_id': os.getpid(),
+    'device_id': get_point_id(),
     'server_id': server_id,
     'ready': 0,
     'participate': 0,
@@ -65,55 +96,181 @@ def spawn_device(communicator, server_id, dataset):
     'update_local_model': 0,
     'sync_server': 0,
     'model': args.model,
-    'optimizer': args.optim
+    'optimizer': args.optim,
+    'mask_transfer': args.mask_transfer,
+    'spill_dir': args.device_spill_dir,
+    'stratum': (rank - 1) % args.num_strata,
+    'local_epochs': args.local_epochs,
+    'server_timeout': args.liveness_timeout
   }
   logger.info("Spawning device with device config : {}".format(device_config))
   communicator.register(device_config['device_id'], server_id)
   device = Device(device_config=device_config,
                   dataset=dataset,
-                  communicator=communicator)
+                  communicator=communicator,
+                  compressor=get_compressor(args))
   device.run_device()
 
-def run(rank, communicator, fn, server_id):
+def get_task_config(args):
+  return {
+    'model': args.model,
+    'optimizer': args.optim,
+    'num_classes': args.num_classes,
+    'lr_params': {'initial_lr': args.lr}
+  }
+
+
+def spawn_simulation_worker(args, communicator, pool_config):
+  from pyfl.datasets import get_datasets, get_partitioner, get_transforms
+  from pyfl.device.simulation import SimulatedDevicePool
+
+  trainset, _ = get_datasets(args, *get_transforms(args.dataset))
+  # Same seed in every worker, so every worker derives the same split
+  partitions = get_partitioner(args, trainset, args.num_devices).partitions
+  pool = SimulatedDevicePool(pool_config, trainset,
+                             {device_id: partitions[device_id] for device_id in pool_config['device_ids']},
+                             communicator)
+  pool.serve()
+
+
+def run_simulation(args):
+  """
+  Simulates args.num_devices devices in args.num_workers worker processes.
+  The main process acts as the server, in synchronous FedAvg rounds or, with
+  --async_buffer, asynchronously with buffered aggregation.
+  """
+  from pyfl.models.flat_params import FlatParameters
+  from pyfl.server import metrics
+  from pyfl.server.simulation import SimulationServer
+  from pyfl.utils import get_model
+
+  server_id = os.getpid()
+  task_config = get_task_config(args)
+  model, _ = get_model(task_config)
+  global_weights = FlatParameters(model).weights
+
+  communicator = Communicator()
+  owners = {}
+  processes = []
+  for worker_id in range(1, args.num_workers + 1):
+    device_ids = list(range(worker_id - 1, args.num_devices, args.num_workers))
+    owners.update({device_id: worker_id for device_id in device_ids})
+    communicator.register(worker_id, server_id)
+    pool_config = {
+      'pool_id': worker_id,
+      'server_id': server_id,
+      'device_ids': device_ids,
+      'task_config': task_config,
+      'batch_size': args.batch_size,
+      'local_epochs': args.local_epochs,
+      'vectorize': args.vectorize
+    }
+    p = Process(target=spawn_simulation_worker, args=(args, communicator, pool_config))
+    p.start()
+    processes.append(p)
+
+  evaluate = None
+  if args.target_accuracy:
+    from pyfl.datasets import get_datasets, get_transforms
+    _, testset = get_datasets(args, *get_transforms(args.dataset))
+    test_loader = torch.utils.data.DataLoader(testset, batch_size=1000)
+    evaluate = lambda: metrics.evaluate(model, test_loader)
+  server = SimulationServer({
+    'server_id': server_id,
+    'owners': owners,
+    'clients_per_round': args.clients_per_round,
+    'devices_per_request': max(args.vectorize, 1),
+    'buffer_size': args.async_buffer,
+    'staleness_exponent': args.staleness_exponent,
+    'server_lr': args.server_lr,
+    'seed': args.partition_seed
+  }, communicator, global_weights, evaluate)
+  if args.async_buffer:
+    timeline = server.run_async(args.rounds)
+  else:
+    timeline = server.run_sync(args.rounds)
+  server.stop_workers()
+  for p in processes:
+    p.join()
+  if args.target_accuracy:
+    logger.info('Time to {:.2%} accuracy: {} s (best accuracy {:.2%})'.format(
+      args.target_accuracy, timeline.time_to_accuracy(args.target_accuracy), timeline.best()))
+
+
+def run(args, rank, communicator, fn, server_id):
   if rank != 0:
+    from pyfl.datasets import get_data, get_shard_data, get_tensor_data
+
     dataset = {}
-    dataset['trainset'], dataset['testset'] = get_data(args)
-    fn(communicator, server_id.value, dataset)
+    if args.loader == 'tensor':
+      # Devices never evaluate, they skip the test set
+      dataset['trainset'], dataset['testset'] = get_tensor_data(args, rank - 1, args.num_devices)
+    elif args.cache_shards:
+      dataset['trainset'], dataset['testset'] = get_shard_data(args, rank - 1, args.num_devices)
+    else:
+      dataset['trainset'], dataset['testset'] = get_data(args)
+    fn(args, communicator, server_id.value, dataset, rank)
   else:
-    fn(communicator, server_id)
+    fn(args, communicator, server_id)
 
 
-def init_process(rank, size, communicator,
+def init_process(args, rank, size, communicator,
                  fn, server_id=None, backend='gloo'):
   """ Initialize the distributed environment. """
-  os.environ['MASTER_ADDR'] = '127.0.0.1'
-  os.environ['MASTER_PORT'] = '29500'
+  os.environ['MASTER_ADDR'] = args.master_addr
+  os.environ['MASTER_PORT'] = str(args.master_port)
   logger.info("MASTER_ADDR : {}".format(os.environ['MASTER_ADDR']))
   logger.info("MASTER_PORT : {}".format(os.environ['MASTER_PORT']))
   dist.init_process_group(backend, rank=rank, world_size=size)
 
-  run(rank, communicator, fn, server_id)
+  run(args, rank, communicator, fn, server_id)
 
 
 if __name__ == "__main__":
   mp.set_start_method('spawn')
+  setup_dirs()
+  args = get_args()
   SERVER_ID = Value('i', 0)
   processes = []
   logger.info('Run arguments::{}'.format(vars(args)))
+  if args.simulate:
+    run_simulation(args)
+    exit(0)
   size = args.num_devices
+  if args.cache_shards and args.role != 'server':
+    from pyfl.datasets import cache_shards
 
-  communicator = Communicator()
-  for i in range(size + 1):
-    if i == 0:
-      p = Process(target=init_process, args=(i, (size + 1), communicator,
-                                             spawn_server,
-                                             SERVER_ID))
+    # Partition once, the devices only map their own shard
+    logger.info('Cached device shards in {}'.format(cache_shards(args, size)))
+
+  communicator = get_communicator(args)
+  if args.role == 'all':
+    for i in range(size + 1):
+      if i == 0:
+        p = Process(target=init_process, args=(args, i, (size + 1), communicator,
+                                               spawn_server,
+                                               SERVER_ID))
+      else:
+        p = Process(target=init_process, args=(args, i, (size + 1), communicator,
+                                               spawn_device,
+                                               SERVER_ID))
+      p.start()
+      processes.append(p)
+  else:
+    # The launchers of the other hosts are not part of a torch.distributed
+    # group, the processes only talk over the communicator
+    SERVER_ID.value = SPLIT_SERVER_ID
+    if args.role == 'server':
+      ranks = [0]
     else:
-      p = Process(target=init_process, args=(i, (size + 1), communicator,
-                                             spawn_device,
-                                             SERVER_ID))
-    p.start()
-    processes.append(p)
+      num_local = args.local_devices or size - args.first_device
+      ranks = range(args.first_device + 1, args.first_device + num_local + 1)
+    for rank in ranks:
+      p = Process(target=run, args=(args, rank, communicator,
+                                    spawn_server if rank == 0 else spawn_device,
+                                    SERVER_ID))
+      p.start()
+      processes.append(p)
 
   for p in processes:
     p.join()
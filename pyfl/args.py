@@ -16,17 +16,159 @@ parser.add_argument(
 # FL Parameteres
 parser.add_argument(
   '--iid_partion', default=False, type=bool, help='Do a non-iid partition of the dataset')
+parser.add_argument(
+  '--partition_scheme', default=None, type=str, choices=['iid', 'label_shard', 'dirichlet'],
+  help='How the dataset is split over the devices, defaults to label_shard with --iid_partion else iid')
+parser.add_argument(
+  '--dirichlet_alpha', default=0.5, type=float, help='Concentration of the dirichlet partition')
+parser.add_argument(
+  '--shards_per_client', default=2, type=int, help='Label shards per device of the label_shard partition')
+parser.add_argument(
+  '--partition_seed', default=1234, type=int, help='Seed of the dataset partition')
 parser.add_argument(
   '--num_devices', default=4, type=int, help='Number of devices')
 parser.add_argument(
   '--dist', default=True, type=bool, help='Distributed training')
+parser.add_argument(
+  '--loader', default='torch', type=str, choices=['torch', 'tensor'],
+  help='torch: DataLoader with per-sample PIL transforms, tensor: pre-normalized shard with batched augmentation')
+parser.add_argument(
+  '--cache_shards', action='store_true',
+  help='Partition the dataset once on disk, devices memory-map only their own shard')
+parser.add_argument(
+  '--model_transport', default='pipe', type=str, choices=['pipe', 'shared_memory'],
+  help='Send the global model through the pipes or publish it once in shared memory')
+parser.add_argument(
+  '--compression', default='none', type=str, choices=['none', 'topk', 'threshold', 'qsgd8', 'sign'],
+  help='Compression applied to the gradient updates sent by the devices')
+parser.add_argument(
+  '--compression_ratio', default=0.01, type=float, help='Fraction of the entries kept by top-k')
+parser.add_argument(
+  '--compression_threshold', default=1e-3, type=float, help='Magnitude threshold of threshold sparsification')
+parser.add_argument(
+  '--no_error_feedback', action='store_true', help='Drop the compression error instead of carrying it over')
+parser.add_argument(
+  '--mask_transfer', action='store_true',
+  help='Send only the unmasked weights, and the masks as bitmaps once per version')
+parser.add_argument(
+  '--simulate', action='store_true',
+  help='Simulate the devices inside a few worker processes instead of one process per device')
+parser.add_argument(
+  '--num_workers', default=1, type=int, help='Worker processes hosting the simulated devices')
+parser.add_argument(
+  '--vectorize', default=0, type=int,
+  help='Train this many simulated devices at once over stacked weights (sgd only, no batch norm)')
+parser.add_argument(
+  '--rounds', default=1, type=int, help='Number of federated rounds (model versions in async mode)')
+parser.add_argument(
+  '--async_buffer', default=0, type=int,
+  help='With --simulate, asynchronous buffered aggregation, the model moves on every this many updates. '
+       '0 runs synchronous rounds')
+parser.add_argument(
+  '--staleness_exponent', default=0.5, type=float, help='Staleness discount 1 / (1 + staleness) ** exponent')
+parser.add_argument(
+  '--target_accuracy', default=0., type=float,
+  help='Evaluate the global model after every update and report the time to reach this test accuracy')
+parser.add_argument(
+  '--clients_per_round', default=None, type=int, help='Devices sampled every round, all devices if not set')
+parser.add_argument(
+  '--local_epochs', default=1, type=int, help='Local epochs of a device per round')
+parser.add_argument(
+  '--lr', default=0.01, type=float, help='Learning rate of the devices')
+parser.add_argument(
+  '--server_lr', default=1.0, type=float, help='Step size of the server on the averaged update')
+parser.add_argument(
+  '--role', default='all', type=str, choices=['all', 'server', 'device'],
+  help='Processes this launcher starts: the server and every device, only the server, '
+       'or only devices connecting to the server at --master_addr (socket transports)')
+parser.add_argument(
+  '--first_device', default=0, type=int,
+  help='With --role device, index of the first device started here, devices use the shards from it on')
+parser.add_argument(
+  '--local_devices', default=None, type=int,
+  help='With --role device, number of devices started here, every device from --first_device on by default')
+parser.add_argument(
+  '--transport', default='pipe', type=str, choices=['pipe', 'tcp', 'unix'],
+  help='pipe: single host pipes, tcp/unix: socket connections to the server')
+parser.add_argument(
+  '--master_addr', default='127.0.0.1', type=str, help='Address of the server host')
+parser.add_argument(
+  '--master_port', default=29500, type=int, help='Port of the torch.distributed rendezvous')
+parser.add_argument(
+  '--comm_port', default=29501, type=int, help='Port the server listens on with the tcp transport')
+parser.add_argument(
+  '--socket_path', default='/tmp/pyfl.sock', type=str, help='Socket path of the unix transport')
 
 # Server Parameters
+parser.add_argument(
+  '--round_timeout', default=60., type=float, help='Seconds the selection of a round waits for ready devices')
+parser.add_argument(
+  '--round_deadline', default=60., type=float, help='Seconds after which a round closes with the updates it has')
+parser.add_argument(
+  '--quorum', default=1., type=float, help='Fraction of --clients_per_round updates that closes a round early')
+parser.add_argument(
+  '--expected_dropout', default=0., type=float,
+  help='Initial fraction of selected devices expected to drop out, selection is inflated to make up for them')
+parser.add_argument(
+  '--heartbeat_interval', default=1., type=float, help='Seconds of silence after which a device is probed')
+parser.add_argument(
+  '--liveness_timeout', default=None, type=float,
+  help='Seconds of silence after which a device is considered dead, never if not set')
+parser.add_argument(
+  '--delta_history', default=4, type=int,
+  help='Global model versions a returning device can get a delta from, 0 always sends the full model')
+parser.add_argument(
+  '--delta_codec', default='qsgd8', type=str, choices=['none', 'qsgd8'], help='Compression of the model deltas')
+parser.add_argument(
+  '--max_delta_chain', default=8, type=int,
+  help='Deltas a device gets in a row before it is sent the full model again')
+parser.add_argument(
+  '--checkpoint_dir', default='runs/checkpoints', type=str, help='Directory of the server checkpoints')
+parser.add_argument(
+  '--checkpoint_interval', default=5, type=int, help='Rounds between server checkpoints, 0 never checkpoints')
+parser.add_argument(
+  '--checkpoint_keep', default=3, type=int, help='Number of server checkpoints kept')
+parser.add_argument(
+  '--resume', action='store_true', help='Restart the server from the latest checkpoint in --checkpoint_dir')
+parser.add_argument(
+  '--device_spill_dir', default=None, type=str,
+  help='Directory idle devices write their model to between rounds, kept in memory if not set')
+parser.add_argument(
+  '--selection_policy', default='uniform', type=str, choices=['uniform', 'stratified', 'power_of_choice', 'latency'],
+  help='How the devices of a round are picked among the ready ones')
+parser.add_argument(
+  '--power_of_choice_d', default=2., type=float,
+  help='power_of_choice: candidates drawn as a multiple of the devices selected, the highest loss ones are kept')
+parser.add_argument(
+  '--num_strata', default=1, type=int,
+  help='stratified: devices are given strata 0 to num_strata - 1 round robin by device rank')
+parser.add_argument(
+  '--latency_alpha', default=1., type=float,
+  help='latency: devices are sampled with weight round_time ** -alpha, 0 is uniform')
 parser.add_argument(
   '--max_devices_per_selector', default=2, type=int, help='Maximum number of devices per selector')
+parser.add_argument(
+  '--num_aggregators', default=1, type=int,
+  help='Aggregator processes reducing the updates of a round, 1 reduces them in the server process')
+parser.add_argument(
+  '--sharding', default='balanced', type=str, choices=['hash', 'balanced'],
+  help='Assignment of the devices to the selectors and aggregators, consistent hashing or load-aware bin packing')
 
 
 def get_args():
   args = parser.parse_args()
+  if args.power_of_choice_d < 1:
+    parser.error('--power_of_choice_d must be at least 1, the candidates must hold the devices selected')
+  if args.mask_transfer and args.compression != 'none':
+    parser.error('--mask_transfer sends the unmasked values uncompressed, it needs --compression none')
+  if args.async_buffer and not args.simulate:
+    parser.error('--async_buffer is only implemented by the simulation server, it needs --simulate')
+  if args.role != 'all':
+    if args.simulate:
+      parser.error('--simulate runs the server and the devices in one launcher, it needs --role all')
+    if args.transport == 'pipe':
+      parser.error('--role {} runs over the network, it needs --transport tcp or unix'.format(args.role))
+    if args.role == 'device' and args.loader != 'tensor' and not args.cache_shards:
+      parser.error('--role device shards the data by device index, it needs --loader tensor or --cache_shards')
 
   return args
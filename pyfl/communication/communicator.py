@@ -1,3 +1,6 @@
+import asyncio
+from multiprocessing.connection import wait
+
 import loguru
 from torch.multiprocessing import Pipe
 
@@ -6,6 +9,21 @@ from pyfl.communication.message import Message
 log = loguru.logger
 
 
+async def wait_readable(fileno):
+  '''
+  Suspends the calling task until the file descriptor is readable
+  :param fileno: File descriptor
+  :return: None
+  '''
+  loop = asyncio.get_running_loop()
+  readable = loop.create_future()
+  loop.add_reader(fileno, lambda: readable.done() or readable.set_result(None))
+  try:
+    await readable
+  finally:
+    loop.remove_reader(fileno)
+
+
 class Channel:
   def __init__(self, sender_id, receiver_id, comm):
     '''
@@ -22,26 +40,54 @@ class Channel:
 class Communicator:
   def __init__(self):
     self.__channels = {}
+    # receiver_id -> {peer_id: connection the receiver reads from}
+    self.__recv_index = {}
 
   def register(self, pointa_id, pointb_id):
     server_con, device_con = Pipe()
     self.__channels[(pointa_id, pointb_id)] = Channel(pointa_id, pointb_id, device_con)  # endA: device is the sender
     self.__channels[(pointb_id, pointa_id)] = Channel(pointb_id, pointa_id, server_con)  # endB: Server is the sender
-    log.debug("Registered channel {}".format(self.__channels.keys()))
+    # Each end receives on the same connection it sends on
+    self.__recv_index.setdefault(pointa_id, {})[pointb_id] = device_con
+    self.__recv_index.setdefault(pointb_id, {})[pointa_id] = server_con
+    log.debug("Registered channel {}".format((pointa_id, pointb_id)))
+
+  def unregister(self, pointa_id, pointb_id):
+    """
+    Removes both ends of the channel between the two points and closes them
+    :param pointa_id: ID of one end of the channel
+    :param pointb_id: ID of the other end of the channel
+    :return: None
+    """
+    for sender_id, receiver_id in ((pointa_id, pointb_id), (pointb_id, pointa_id)):
+      channel = self.__channels.pop((sender_id, receiver_id), None)
+      if channel is not None:
+        channel.comm.close()
+      peers = self.__recv_index.get(sender_id)
+      if peers is not None:
+        peers.pop(receiver_id, None)
+        if not peers:
+          del self.__recv_index[sender_id]
+    log.debug("Unregistered channel {}".format((pointa_id, pointb_id)))
 
   def is_registered(self, pointa_id, pointb_id):
     return ((pointa_id, pointb_id) in self.__channels)
 
+  def peers(self, receiver_id):
+    """
+    :param receiver_id: Receiver ID
+    :return: IDs of every point the receiver has a channel with
+    """
+    return list(self.__recv_index.get(receiver_id, {}).keys())
+
   def __retrieve_comm_send(self, sender_id, receiver_id):
-    return self.__channels.get((sender_id, receiver_id)).comm
+    return self.__channels[(sender_id, receiver_id)].comm
 
   def __retrieve_comm_recv(self, receiver_id):
-    log.debug(self.__channels.keys())
-    comms = []
-    for key in self.__channels.keys():
-      if receiver_id == key[0]:
-        comms.append(self.__channels[key].comm)
-    return comms
+    peers = self.__recv_index.get(receiver_id)
+    if peers is None:
+      return []
+    return list(peers.values())
 
   def send_message(self, sender_id, receiver_id, msg_class, msg_type, msg):
     message = Message({
@@ -52,12 +98,73 @@ class Communicator:
       'message': msg
     })
     comm = self.__retrieve_comm_send(sender_id, receiver_id)
-    comm.send(message)
+    comm.send_bytes(message.encode())
 
-  def recv_message(self, receiver_id):
+  def recv_message(self, receiver_id, block=False, timeout=None):
+    '''
+    Waits on all the connections of the receiver at once and returns every
+    message that is ready to be read
+    :param receiver_id: Receiver ID
+    :param block: If True, sleep until a message arrives (or timeout expires),
+    else return immediately with whatever is already waiting
+    :param timeout: Maximum time in seconds to wait when blocking, None waits forever
+    :return: List of Message objects, empty if nothing arrived in time
+    '''
     messages = []
     comms = self.__retrieve_comm_recv(receiver_id)
-    for comm in comms:
-      if comm.poll(0.001):
-        messages.append(comm.recv())
+    if not comms:
+      return messages
+    for comm in wait(comms, timeout=timeout if block else 0):
+      # Drain the pipe so a chatty sender doesn't need one wait() per message
+      try:
+        while comm.poll():
+          messages.append(Message.decode(comm.recv_bytes()))
+      except EOFError:
+        log.debug('Channel closed by the other end')
+    return messages
+
+  async def recv_message_from(self, receiver_id, sender_id):
+    '''
+    Awaitable reader of one channel: suspends the calling task, not the event
+    loop, until the sender's messages are ready and returns all of them
+    :param receiver_id: Receiver ID
+    :param sender_id: Sender ID
+    :return: Non empty list of Message objects
+    :raises EOFError: When the channel was closed by the other end
+    '''
+    comm = self.__recv_index[receiver_id][sender_id]
+    while not comm.poll():
+      await wait_readable(comm.fileno())
+    messages = []
+    try:
+      while comm.poll():
+        messages.append(Message.decode(comm.recv_bytes()))
+    except EOFError:
+      if not messages:
+        raise
     return messages
+
+  async def new_peers(self, receiver_id):
+    '''
+    Yields the ID of every point the receiver has a channel with, pipes are
+    all registered up front
+    :param receiver_id: Receiver ID
+    '''
+    for peer_id in self.peers(receiver_id):
+      yield peer_id
+
+
+def get_communicator(args):
+  '''
+  Builds the communicator of the transport selected by the run arguments
+  :param args: Argument object
+  :return: Communicator or SocketCommunicator
+  '''
+  if args.transport == 'pipe':
+    return Communicator()
+  from pyfl.communication.socket_communicator import SocketCommunicator
+  if args.transport == 'tcp':
+    return SocketCommunicator((args.master_addr, args.comm_port))
+  elif args.transport == 'unix':
+    return SocketCommunicator(args.socket_path)
+  raise NotImplementedError('Transport {} not supported'.format(args.transport))
@@ -0,0 +1,220 @@
+"""
+Compression of the D2S gradient updates.
+
+A Compressor turns a flat update tensor into a CompressedUpdate, a compact
+payload carrying indices and values (sparsification) or packed codes and a
+scale (quantization). The aggregator calls decompress, or folds the payload
+straight into its running sum with add_to.
+
+Lossy compressors keep an error-feedback residual on the device: what was
+dropped from one round's update is added back to the next one.
+"""
+import numpy as np
+import torch
+
+from pyfl.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class CompressedUpdate(object):
+  """
+  Compact payload of a compressed update
+
+  codec : Name of the codec that produced the payload
+  numel : Number of elements of the dense update
+  indices : Positions of the sent values (sparse codecs), else None
+  values : Sent values, or the packed codes of the quantized codecs
+  scale : Dequantization scale (quantized codecs), else None
+  """
+  __slots__ = ('codec', 'numel', 'indices', 'values', 'scale')
+
+  def __init__(self, codec, numel, values, indices=None, scale=None):
+    self.codec = codec
+    self.numel = numel
+    self.values = values
+    self.indices = indices
+    self.scale = scale
+
+  def nbytes(self):
+    """
+    :return: Number of bytes of the payload tensors on the wire
+    """
+    nbytes = self.values.numel() * self.values.element_size()
+    if self.indices is not None:
+      nbytes += self.indices.numel() * self.indices.element_size()
+    if self.scale is not None:
+      nbytes += self.scale.numel() * self.scale.element_size()
+    return nbytes
+
+  def __getstate__(self):
+    return tuple(getattr(self, slot) for slot in self.__slots__)
+
+  def __setstate__(self, state):
+    for slot, value in zip(self.__slots__, state):
+      setattr(self, slot, value)
+
+
+def _index_dtype(numel):
+  return torch.int32 if numel < 2 ** 31 else torch.int64
+
+
+def decompress(payload):
+  """
+  Rebuilds the dense flat update
+  :param payload: CompressedUpdate or a dense tensor
+  :return: Flat tensor
+  """
+  if torch.is_tensor(payload):
+    return payload
+  if payload.codec in ('topk', 'threshold'):
+    dense = torch.zeros(payload.numel, dtype=payload.values.dtype, device=payload.values.device)
+    dense[payload.indices.long()] = payload.values
+    return dense
+  if payload.codec == 'qsgd8':
+    return (payload.values.float() - 127.) * payload.scale
+  if payload.codec == 'sign':
+    bits = np.unpackbits(payload.values.cpu().numpy(), count=payload.numel)
+    return (torch.from_numpy(bits).to(payload.scale.device).float() * 2. - 1.) * payload.scale
+  raise NotImplementedError('Codec {} not supported'.format(payload.codec))
+
+
+def add_to(total, payload, alpha=1.):
+  """
+  Folds alpha * update into total. Sparse payloads are scattered in place,
+  only the sent entries are touched
+  :param total: Flat tensor to accumulate into
+  :param payload: CompressedUpdate or a dense tensor
+  :param alpha: Weight of the update
+  :return: total
+  """
+  if isinstance(payload, CompressedUpdate) and payload.codec in ('topk', 'threshold'):
+    total.index_add_(0, payload.indices.long(), payload.values * alpha)
+  else:
+    total.add_(decompress(payload), alpha=alpha)
+  return total
+
+
+class Compressor(object):
+  """
+  Compressor base class, also the identity compressor
+
+  error_feedback : Keep what compression dropped and add it to the next update
+  """
+  codec = 'none'
+
+  def __init__(self, error_feedback=True):
+    self.error_feedback = error_feedback
+    self.residual = None
+    self.bytes_sent = 0
+
+  def encode(self, update):
+    return update
+
+  def compress(self, update):
+    """
+    Compresses a flat update, updating the error-feedback residual
+    :param update: Flat update tensor
+    :return: CompressedUpdate (or the dense tensor for the identity compressor)
+    """
+    update = update.detach().reshape(-1)
+    if self.error_feedback and self.codec != 'none':
+      if self.residual is None:
+        self.residual = torch.zeros_like(update)
+      update = update + self.residual
+    payload = self.encode(update)
+    if self.error_feedback and self.codec != 'none':
+      self.residual = update - decompress(payload)
+    nbytes = payload_nbytes(payload)
+    self.bytes_sent += nbytes
+    logger.debug('{} update: {} dense bytes -> {} bytes'.format(
+      self.codec, update.numel() * update.element_size(), nbytes))
+    return payload
+
+
+class TopKCompressor(Compressor):
+  """
+  Keeps the ratio * numel entries of largest magnitude
+  """
+  codec = 'topk'
+
+  def __init__(self, ratio=0.01, error_feedback=True):
+    super(TopKCompressor, self).__init__(error_feedback)
+    self.ratio = ratio
+
+  def encode(self, update):
+    k = max(1, int(update.numel() * self.ratio))
+    _, indices = torch.topk(update.abs(), k, sorted=False)
+    return CompressedUpdate(self.codec, update.numel(), update[indices],
+                            indices=indices.to(_index_dtype(update.numel())))
+
+
+class ThresholdCompressor(Compressor):
+  """
+  Keeps the entries whose magnitude is at least threshold
+  """
+  codec = 'threshold'
+
+  def __init__(self, threshold=1e-3, error_feedback=True):
+    super(ThresholdCompressor, self).__init__(error_feedback)
+    self.threshold = threshold
+
+  def encode(self, update):
+    indices = torch.nonzero(update.abs() >= self.threshold, as_tuple=False).reshape(-1)
+    return CompressedUpdate(self.codec, update.numel(), update[indices],
+                            indices=indices.to(_index_dtype(update.numel())))
+
+
+class QSGD8Compressor(Compressor):
+  """
+  Linear 8-bit quantization, one byte per entry plus a float scale
+  """
+  codec = 'qsgd8'
+
+  def encode(self, update):
+    scale = update.abs().max().clamp(min=1e-12) / 127.
+    codes = torch.round(update / scale).clamp_(-127, 127).add_(127).to(torch.uint8)
+    return CompressedUpdate(self.codec, update.numel(), codes, scale=scale.reshape(1))
+
+
+class SignCompressor(Compressor):
+  """
+  1-bit sign quantization, the signs are packed 8 per byte and scaled by the
+  mean magnitude of the update
+  """
+  codec = 'sign'
+
+  def encode(self, update):
+    scale = update.abs().mean()
+    bits = np.packbits((update >= 0).cpu().numpy())
+    return CompressedUpdate(self.codec, update.numel(), torch.from_numpy(bits), scale=scale.reshape(1))
+
+
+def payload_nbytes(payload):
+  """
+  :param payload: CompressedUpdate or a dense tensor
+  :return: Number of bytes of the payload on the wire
+  """
+  if torch.is_tensor(payload):
+    return payload.numel() * payload.element_size()
+  return payload.nbytes()
+
+
+def get_compressor(args):
+  """
+  Builds the compressor selected by the run arguments
+  :param args: Argument object
+  :return: Compressor
+  """
+  error_feedback = not args.no_error_feedback
+  if args.compression == 'none':
+    return Compressor(error_feedback=False)
+  elif args.compression == 'topk':
+    return TopKCompressor(args.compression_ratio, error_feedback)
+  elif args.compression == 'threshold':
+    return ThresholdCompressor(args.compression_threshold, error_feedback)
+  elif args.compression == 'qsgd8':
+    return QSGD8Compressor(error_feedback)
+  elif args.compression == 'sign':
+    return SignCompressor(error_feedback)
+  raise NotImplementedError('Compression {} not supported'.format(args.compression))
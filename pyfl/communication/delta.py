@@ -0,0 +1,130 @@
+"""
+Versioned delta broadcast of the global model.
+
+The server numbers the versions of the global model and keeps the last few of
+them. A device tells the server which version it holds, and if that version is
+still in the history the device gets the compressed difference to the current
+version instead of the full weights. A device already holding the current
+version gets an empty payload. New devices and devices that fell too far behind
+get the full model.
+
+Lossy deltas leave a small error in the device's copy, which builds up over
+consecutive deltas, so after max_chain deltas in a row a device gets the full
+model again.
+"""
+import threading
+from collections import OrderedDict
+
+from pyfl.communication.compression import Compressor, QSGD8Compressor, add_to, payload_nbytes
+
+CODECS = {
+  'none': Compressor,
+  'qsgd8': QSGD8Compressor,
+}
+
+
+class ModelDelta(object):
+  """
+  Payload of a versioned S2D_SEND_GLOBAL_MODEL message
+
+  version : Version of the global model the payload brings the device to
+  base_version : Version the delta applies to, None when values is the full flat model
+  values : Full flat weights, the CompressedUpdate (or dense tensor) of the
+           difference to base_version, or None if the device is up to date
+  """
+  __slots__ = ('version', 'base_version', 'values')
+
+  def __init__(self, version, base_version, values):
+    self.version = version
+    self.base_version = base_version
+    self.values = values
+
+  def is_full(self):
+    return self.base_version is None
+
+  def nbytes(self):
+    return 0 if self.values is None else payload_nbytes(self.values)
+
+  def apply(self, flat):
+    """
+    Brings a flat copy of the base version to this payload's version
+    :param flat: Flat weights tensor, updated in place
+    :return: flat
+    """
+    if self.is_full():
+      flat.copy_(self.values)
+    elif self.values is not None:
+      add_to(flat, self.values)
+    return flat
+
+  def __getstate__(self):
+    return tuple(getattr(self, slot) for slot in self.__slots__)
+
+  def __setstate__(self, state):
+    for slot, value in zip(self.__slots__, state):
+      setattr(self, slot, value)
+
+
+class ModelHistory(object):
+  """
+  Server side: the last versions of the global model and the delta chain of
+  every device
+
+  max_versions : Number of past versions a delta can start from
+  codec : Compression of the deltas, one of CODECS
+  max_chain : Deltas a device gets in a row before it is sent the full model again
+  version : Version of the weights the history starts from
+
+  Every device holding a given version gets the same delta, which is only
+  compressed once per version. commit and encode can be called from different
+  threads.
+  """
+
+  def __init__(self, weights, max_versions=4, codec='qsgd8', max_chain=8, version=0):
+    if codec not in CODECS:
+      raise NotImplementedError('Delta codec {} not supported'.format(codec))
+    self.max_versions = max_versions
+    self.max_chain = max_chain
+    self.compressor = CODECS[codec](error_feedback=False)
+    self.version = version
+    self.snapshots = OrderedDict([(version, weights.detach().clone().reshape(-1))])
+    self.chains = {}
+    self.deltas = {}
+    self.lock = threading.Lock()
+
+  def commit(self, weights):
+    """
+    Records the current global model as a new version
+    :param weights: Flat global model weights
+    :return: The new version
+    """
+    snapshot = weights.detach().clone().reshape(-1)
+    with self.lock:
+      self.version += 1
+      self.snapshots[self.version] = snapshot
+      while len(self.snapshots) > self.max_versions + 1:
+        self.snapshots.popitem(last=False)
+      self.deltas.clear()
+      return self.version
+
+  def encode(self, peer_id=None, held_version=None):
+    """
+    :param peer_id: Receiver of the payload
+    :param held_version: Version the receiver holds, None if it holds no model
+    :return: ModelDelta bringing the receiver to the current version
+    """
+    with self.lock:
+      current = self.snapshots[self.version]
+      if held_version == self.version:
+        return ModelDelta(self.version, held_version, None)
+      chain = self.chains.get(peer_id, 0)
+      if held_version not in self.snapshots or chain >= self.max_chain:
+        self.chains[peer_id] = 0
+        return ModelDelta(self.version, None, current)
+      if held_version not in self.deltas:
+        self.deltas[held_version] = self.compressor.compress(current - self.snapshots[held_version])
+      self.chains[peer_id] = chain + 1
+      return ModelDelta(self.version, held_version, self.deltas[held_version])
+
+  def forget(self, peer_id):
+    self.chains.pop(peer_id, None)
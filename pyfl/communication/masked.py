@@ -0,0 +1,163 @@
+"""
+Mask-aware serialization of weights and updates.
+
+Pruned positions of MaskedConv/MaskedDense weights are zero on the wire and in
+aggregation. The sender ships the mask once per mask version as a packed
+bitmap (1 bit per weight) and afterwards only the values of the active
+weights. The receiver caches the mask of every peer and scatters the values
+back, or folds them straight into an aggregate.
+"""
+import numpy as np
+import torch
+
+
+def pack_mask(active):
+  """
+  :param active: Flat bool tensor
+  :return: uint8 tensor with 8 mask entries per byte
+  """
+  return torch.from_numpy(np.packbits(active.cpu().numpy()))
+
+
+def unpack_mask(packed, numel):
+  """
+  :param packed: uint8 tensor returned by pack_mask
+  :param numel: Number of entries of the mask
+  :return: Flat bool tensor
+  """
+  return torch.from_numpy(np.unpackbits(packed.cpu().numpy(), count=numel).astype(np.bool_))
+
+
+class MaskedWeights(object):
+  """
+  Payload carrying only the active entries of a flat tensor
+
+  mask_version : Version of the sender's mask the values are laid out by
+  numel : Number of elements of the dense tensor
+  values : Values of the active entries, in increasing position order
+  packed_mask : Bitmap of the mask, only sent when the receiver lacks this version
+  indices : Active positions, filled in by the receiver's MaskedDecoder, None on the wire
+  """
+  __slots__ = ('mask_version', 'numel', 'values', 'packed_mask', 'indices')
+
+  def __init__(self, mask_version, numel, values, packed_mask=None):
+    self.mask_version = mask_version
+    self.numel = numel
+    self.values = values
+    self.packed_mask = packed_mask
+    self.indices = None
+
+  def nbytes(self):
+    nbytes = self.values.numel() * self.values.element_size()
+    if self.packed_mask is not None:
+      nbytes += self.packed_mask.numel()
+    return nbytes
+
+  def __getstate__(self):
+    return tuple(getattr(self, slot) for slot in self.__slots__)
+
+  def __setstate__(self, state):
+    for slot, value in zip(self.__slots__, state):
+      setattr(self, slot, value)
+
+
+class MaskedEncoder(object):
+  """
+  Sender side: tracks the current mask, its version, and which version every
+  peer already holds
+  """
+
+  def __init__(self):
+    self.active = None
+    self.indices = None
+    self.packed_mask = None
+    self.mask_version = 0
+    self.peer_versions = {}
+
+  def set_mask(self, active):
+    """
+    Sets the mask, bumping its version if it changed
+    :param active: Flat bool tensor, True for the weights that are sent
+    :return: Current mask version
+    """
+    if self.active is not None and torch.equal(self.active, active):
+      return self.mask_version
+    self.active = active.clone()
+    self.indices = torch.nonzero(active, as_tuple=False).reshape(-1)
+    self.packed_mask = pack_mask(active)
+    self.mask_version += 1
+    return self.mask_version
+
+  def encode(self, flat, peer_id=None):
+    """
+    :param flat: Flat tensor laid out like the mask
+    :param peer_id: Receiver of the payload, the bitmap is attached the first
+    time a peer gets a mask version
+    :return: MaskedWeights
+    """
+    packed_mask = None
+    if self.peer_versions.get(peer_id) != self.mask_version:
+      packed_mask = self.packed_mask
+      self.peer_versions[peer_id] = self.mask_version
+    return MaskedWeights(self.mask_version, flat.numel(),
+                         flat.detach().reshape(-1).index_select(0, self.indices), packed_mask)
+
+  def forget(self, peer_id):
+    """
+    Makes sure the next payload sent to a peer carries the bitmap again
+    """
+    self.peer_versions.pop(peer_id, None)
+
+
+class MaskedDecoder(object):
+  """
+  Receiver side: caches the latest mask of every peer
+  """
+
+  def __init__(self):
+    self.masks = {}
+
+  def resolve(self, payload, peer_id=None):
+    """
+    Attaches the active positions to a payload, caching the bitmap it carries
+    :param payload: MaskedWeights
+    :param peer_id: Sender of the payload
+    :return: payload
+    """
+    cached = self.masks.get(peer_id)
+    if payload.packed_mask is not None:
+      active = unpack_mask(payload.packed_mask, payload.numel)
+      cached = (payload.mask_version, torch.nonzero(active, as_tuple=False).reshape(-1))
+      self.masks[peer_id] = cached
+    if cached is None or cached[0] != payload.mask_version:
+      raise ValueError('Mask version {} of peer {} was never received'.format(payload.mask_version, peer_id))
+    payload.indices = cached[1]
+    return payload
+
+  def forget(self, peer_id):
+    """
+    Drops the cached mask of a peer that is gone
+    """
+    self.masks.pop(peer_id, None)
+
+  def active(self, payload):
+    """
+    :param payload: Resolved MaskedWeights
+    :return: Flat bool tensor of the mask the payload is laid out by
+    """
+    active = torch.zeros(payload.numel, dtype=torch.bool)
+    active[payload.indices] = True
+    return active
+
+  def decode(self, payload, peer_id=None):
+    """
+    Rebuilds the dense tensor, masked out entries are zero
+    :param payload: MaskedWeights
+    :param peer_id: Sender of the payload
+    :return: Flat tensor
+    """
+    if payload.indices is None:
+      self.resolve(payload, peer_id)
+    dense = torch.zeros(payload.numel, dtype=payload.values.dtype)
+    dense[payload.indices] = payload.values
+    return dense
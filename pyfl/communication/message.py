@@ -1,15 +1,176 @@
+"""
+Messages exchanged between the actors, and their binary wire format.
+
+A message on the wire is a fixed header followed by a raw payload:
+  sender_id (int64) | receiver_id (int64) | class code (int8) | type code (int8) |
+  payload kind (uint8) | payload length (uint32) | payload
+Tensors (and lists of tensors) are written as their raw buffers behind a small
+dtype/shape header. Anything else (dicts, CompressedUpdate, MaskedWeights,
+ModelDelta...) is pickled with the multiprocessing pickler, minus its tensors:
+they are taken out of the pickle and written as raw buffers before it, so the
+payload is plain bytes that outlive the sender and the sender's tensors are
+never moved to shared memory. Tensors already in shared memory are pickled
+as handles on a pipe, encode(share_memory=False) writes them raw too for
+transports between hosts.
+"""
+import io
+import pickle
+import struct
 from abc import ABC
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+import torch
+
+from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
+
+HEADER = struct.Struct('<qqbbBI')
+TENSOR_HEADER = struct.Struct('<BB')
+DIM = struct.Struct('<q')
+COUNT = struct.Struct('<I')
+
+# Wire codes of the message classes, the decoded message_class is the same
+# instance the message definitions expose
+MESSAGE_CLASSES = [
+  DeviceServerMessage.D2S_NOTIF_CLASS,
+  DeviceServerMessage.D2S_QUERY_CLASS,
+  DeviceServerMessage.D2S_UPDATE_CLASS,
+  ServerDeviceMessage.S2D_NOTIF_CLASS,
+  ServerDeviceMessage.S2D_QUERY_CLASS,
+  ServerDeviceMessage.S2D_SEND_CLASS,
+]
+CLASS_CODES = {type(message_class): code for code, message_class in enumerate(MESSAGE_CLASSES)}
+
+PAYLOAD_NONE = 0
+PAYLOAD_TENSOR = 1
+PAYLOAD_TENSOR_LIST = 2
+PAYLOAD_PICKLE = 3
+
+DTYPES = [torch.float32, torch.float64, torch.float16, torch.int64, torch.int32,
+          torch.int16, torch.int8, torch.uint8, torch.bool]
+DTYPE_CODES = {dtype: code for code, dtype in enumerate(DTYPES)}
+NUMPY_DTYPES = [np.float32, np.float64, np.float16, np.int64, np.int32,
+                np.int16, np.int8, np.uint8, np.bool_]
+
+
+def _is_raw_tensor(payload, share_memory=True):
+  # Shared-memory tensors are pickled so that only their handles are sent
+  return (torch.is_tensor(payload) and payload.dtype in DTYPE_CODES and
+          not payload.requires_grad and not (share_memory and payload.is_shared()))
+
+
+class _TensorPickler(ForkingPickler):
+  """
+  Pickles a payload with its raw tensors swapped for their position in tensors
+  """
+
+  def __init__(self, file, tensors, share_memory):
+    super(_TensorPickler, self).__init__(file, pickle.HIGHEST_PROTOCOL)
+    self.tensors = tensors
+    self.share_memory = share_memory
+
+  def persistent_id(self, obj):
+    if torch.is_tensor(obj) and obj.dtype in DTYPE_CODES and not (self.share_memory and obj.is_shared()):
+      self.tensors.append(obj)
+      return len(self.tensors) - 1
+    return None
+
+
+class _TensorUnpickler(pickle.Unpickler):
+
+  def __init__(self, file, tensors):
+    super(_TensorUnpickler, self).__init__(file)
+    self.tensors = tensors
+
+  def persistent_load(self, pid):
+    return self.tensors[pid]
+
+
+def _encode_tensor(tensor, chunks):
+  tensor = tensor.detach().cpu().contiguous()
+  chunks.append(TENSOR_HEADER.pack(DTYPE_CODES[tensor.dtype], tensor.dim()))
+  chunks.extend(DIM.pack(dim) for dim in tensor.shape)
+  chunks.append(memoryview(tensor.numpy().reshape(-1).view(np.uint8)))
+
+
+def _decode_tensor(buffer, offset):
+  dtype_code, ndim = TENSOR_HEADER.unpack_from(buffer, offset)
+  offset += TENSOR_HEADER.size
+  shape = [DIM.unpack_from(buffer, offset + i * DIM.size)[0] for i in range(ndim)]
+  offset += ndim * DIM.size
+  count = int(np.prod(shape)) if ndim else 1
+  array = np.frombuffer(buffer, dtype=NUMPY_DTYPES[dtype_code], count=count, offset=offset)
+  offset += array.nbytes
+  # The receive buffer is read-only, the tensor gets its own storage
+  return torch.from_numpy(array.copy()).view(shape), offset
+
+
+def _encode_tensors(tensors, chunks):
+  chunks.append(COUNT.pack(len(tensors)))
+  for tensor in tensors:
+    _encode_tensor(tensor, chunks)
+
+
+def _decode_tensors(buffer, offset):
+  count, = COUNT.unpack_from(buffer, offset)
+  offset += COUNT.size
+  tensors = []
+  for _ in range(count):
+    tensor, offset = _decode_tensor(buffer, offset)
+    tensors.append(tensor)
+  return tensors, offset
+
+
+def _encode_payload(payload, share_memory=True):
+  """
+  :param share_memory: If False, tensors in shared memory are written raw instead of as handles
+  :return: (payload kind, list of bytes-like chunks)
+  """
+  chunks = []
+  if payload is None:
+    return PAYLOAD_NONE, chunks
+  if _is_raw_tensor(payload, share_memory):
+    _encode_tensor(payload, chunks)
+    return PAYLOAD_TENSOR, chunks
+  if isinstance(payload, (list, tuple)) and payload and all(_is_raw_tensor(p, share_memory) for p in payload):
+    _encode_tensors(payload, chunks)
+    return PAYLOAD_TENSOR_LIST, chunks
+  # The tensors go first as raw buffers, the pickle refers to them by position
+  tensors, file = [], io.BytesIO()
+  _TensorPickler(file, tensors, share_memory).dump(payload)
+  _encode_tensors(tensors, chunks)
+  chunks.append(file.getbuffer())
+  return PAYLOAD_PICKLE, chunks
+
+
+def _decode_payload(kind, buffer, offset, length):
+  if kind == PAYLOAD_NONE:
+    return None
+  if kind == PAYLOAD_TENSOR:
+    return _decode_tensor(buffer, offset)[0]
+  if kind == PAYLOAD_TENSOR_LIST:
+    return _decode_tensors(buffer, offset)[0]
+  if kind == PAYLOAD_PICKLE:
+    end = offset + length
+    tensors, offset = _decode_tensors(buffer, offset)
+    return _TensorUnpickler(io.BytesIO(buffer[offset:end]), tensors).load()
+  raise ValueError('Unknown payload kind {}'.format(kind))
 
 
 class Message(ABC):
+  __slots__ = ('sender_id', 'receiver_id', 'message_class', 'message_type', 'message')
+
   def __init__(self, message_params):
-    self.message_params = message_params
     self.sender_id = message_params['sender_id']
     self.receiver_id = message_params['receiver_id']
     self.message_class = message_params['message_class']
     self.message_type = message_params['message_type']
     self.message = message_params['message']
 
+  @property
+  def message_params(self):
+    return self.get_message_params()
+
   def get_sender(self):
     return self.sender_id
 
@@ -17,4 +178,78 @@ class Message(ABC):
     return self.receiver_id
 
   def get_message_params(self):
-    return self.message_params
+    return {
+      'sender_id': self.sender_id,
+      'receiver_id': self.receiver_id,
+      'message_class': self.message_class,
+      'message_type': self.message_type,
+      'message': self.message
+    }
+
+  def encode(self, share_memory=True):
+    """
+    Serializes the message to its wire format
+    :param share_memory: If True, tensors already in shared memory travel as
+    handles, only valid between processes of one host
+    :return: bytes
+    """
+    kind, chunks = _encode_payload(self.message, share_memory)
+    length = sum(memoryview(chunk).nbytes for chunk in chunks)
+    header = HEADER.pack(self.sender_id, self.receiver_id, CLASS_CODES[type(self.message_class)],
+                         self.message_type, kind, length)
+    return b''.join([header] + chunks)
+
+  @classmethod
+  def decode(cls, buffer):
+    """
+    Rebuilds a message from its wire format
+    :param buffer: bytes-like object returned by encode
+    :return: Message
+    """
+    buffer = memoryview(buffer)
+    sender_id, receiver_id, class_code, message_type, kind, length = HEADER.unpack_from(buffer, 0)
+    message = cls.__new__(cls)
+    message.sender_id = sender_id
+    message.receiver_id = receiver_id
+    message.message_class = MESSAGE_CLASSES[class_code]
+    message.message_type = message_type
+    message.message = _decode_payload(kind, buffer, HEADER.size, length)
+    return message
+
+
+def update_payload(update, num_samples, loss=None):
+  """
+  Payload of a D2S_SEND_GRADIENT_UPDATES message
+  :param update: Flat update tensor
+  :param num_samples: Number of samples the device trained on, used as FedAvg weight
+  :param loss: Optional, training loss of the last local epoch, used by loss based selection
+  :return: dict
+  """
+  return {'update': update, 'num_samples': num_samples, 'loss': loss}
+
+
+def version_payload(version):
+  """
+  Payload of the D2S_QUERY_GLOBAL_MODEL message and of the S2D_SELECTED notification
+  :param version: Version of the global model the sender holds, None if it holds no model
+  :return: dict
+  """
+  return {'version': version}
+
+
+def ready_payload(version, stratum=None):
+  """
+  Payload of the D2S_READY message
+  :param version: Version of the global model the device holds, None if it holds no model
+  :param stratum: Optional, stratum of the device used by stratified selection
+  :return: dict
+  """
+  return {'version': version, 'stratum': stratum}
+
+
+def held_version(message):
+  """
+  :param message: Message with a version_payload or a ready_payload
+  :return: Version of the global model the sender holds, None if it did not say
+  """
+  return message.message.get('version') if isinstance(message.message, dict) else None
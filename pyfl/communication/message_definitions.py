@@ -42,9 +42,11 @@ class ServerDeviceNotifClass(object):
   """
   1 : Notify the device it's selected
   0 : Notify the device to try later
+  2 : Notify the device the task is finished
   """
   S2D_SELECTED = 1
   S2D_TRY_LATER = 0
+  S2D_TASK_FINISHED = 2
 
 
 class ServerDeviceQueryClass(object):
@@ -74,6 +76,7 @@ class ServerDeviceMessage(object):
   0 : Class of Notification messages from server to device
     0 : Notify the device it's selected
     1 : Notify the device to try later
+    2 : Notify the device the task is finished
   1 : Class of Query messages from server to device
     0 : Query the device if it's alive
     1 : Query the device if it's ready
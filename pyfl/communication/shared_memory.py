@@ -0,0 +1,129 @@
+"""
+Shared-memory transport for model weights.
+
+The server publishes the global model once into a flat buffer living in shared
+memory and only sends a SharedModelHandle to the devices. Pickling a handle over
+a torch.multiprocessing pipe sends the shared-memory handles of the buffer and
+its version counter, not the weights, so every device maps the same pages.
+
+The version counter works as a seqlock: publish marks the version it starts
+writing before the copy and the version it finished after it, a reader copies
+the buffer and checks that no publish started or ran in the meantime.
+"""
+import numpy as np
+import torch
+
+
+class SharedModelHandle(object):
+  """
+  Reference to one published version of the global model
+
+  What is in a handle ?
+  buffer : Flat shared-memory tensor holding every weight back to back
+  version_counter : Shared int64 tensor, the latest published version and the
+                    version being written
+  shapes : Shape of each weight tensor, in model order
+  version : Version of the model this handle was created for
+
+  The views returned by weights() alias the server's buffer and can change
+  under the reader, read() returns a copy checked against concurrent publishes.
+  """
+
+  def __init__(self, buffer, version_counter, shapes, version):
+    self.buffer = buffer
+    self.version_counter = version_counter
+    self.shapes = shapes
+    self.version = version
+
+  def is_current(self):
+    """
+    Checks if the server has published a newer model since this handle was made
+    :return: True if the buffer still holds this handle's version
+    """
+    published, writing = self.version_counter.tolist()
+    return published == writing == self.version
+
+  def views(self, buffer):
+    sizes = [int(np.prod(shape)) for shape in self.shapes]
+    return [view.view(shape) for view, shape in zip(torch.split(buffer, sizes), self.shapes)]
+
+  def read(self):
+    """
+    Copies the published weights out of shared memory
+    :return: Flat copy of the buffer, owned by the caller, views() splits it per weight
+    """
+    if not self.is_current():
+      raise RuntimeError('Shared model version {} was overwritten by version {}'.format(
+        self.version, int(self.version_counter[1])))
+    copy = self.buffer.clone()
+    # A publish that started during the copy may have left it torn
+    if not self.is_current():
+      raise RuntimeError('Shared model version {} was overwritten during the copy by version {}'.format(
+        self.version, int(self.version_counter[1])))
+    return copy
+
+  def weights(self):
+    """
+    Returns views of the published weights, no data is copied. The views alias
+    the server's buffer: they are not write protected and must not be modified,
+    use read() for a copy the caller owns
+    :return: List of tensors shaped like the model weights
+    """
+    if not self.is_current():
+      raise RuntimeError('Shared model version {} was overwritten by version {}'.format(
+        self.version, int(self.version_counter[1])))
+    return self.views(self.buffer)
+
+
+class SharedModelBuffer(object):
+  """
+  Server side owner of the shared-memory model buffer
+
+  The buffer is allocated once for a given list of weight shapes, every publish
+  copies the new weights in place and bumps the version counter.
+  """
+
+  def __init__(self, shapes, dtype=torch.float32):
+    self.shapes = [tuple(shape) for shape in shapes]
+    numel = sum(int(np.prod(shape)) for shape in self.shapes)
+    self.buffer = torch.zeros(numel, dtype=dtype).share_memory_()
+    # Published version, version being written
+    self.version_counter = torch.zeros(2, dtype=torch.int64).share_memory_()
+
+  @classmethod
+  def from_weights(cls, weights):
+    """
+    Allocates a buffer matching the given weights and publishes them
+    :param weights: List of weight tensors
+    :return: SharedModelBuffer
+    """
+    shared = cls([w.shape for w in weights], dtype=weights[0].dtype)
+    shared.publish(weights)
+    return shared
+
+  @property
+  def version(self):
+    return int(self.version_counter[0])
+
+  def publish(self, weights):
+    """
+    Copies a new global model into the shared buffer and bumps its version
+    :param weights: List of weight tensors, same shapes as the buffer
+    :return: SharedModelHandle for the new version
+    """
+    if len(weights) != len(self.shapes):
+      raise ValueError('Expected {} weight tensors, got {}'.format(len(self.shapes), len(weights)))
+    sizes = [int(np.prod(shape)) for shape in self.shapes]
+    version = self.version + 1
+    self.version_counter[1] = version
+    with torch.no_grad():
+      for view, weight in zip(torch.split(self.buffer, sizes), weights):
+        view.copy_(weight.detach().reshape(-1))
+    self.version_counter[0] = version
+    return self.handle()
+
+  def handle(self):
+    """
+    :return: SharedModelHandle for the latest published version
+    """
+    return SharedModelHandle(self.buffer, self.version_counter, self.shapes, self.version)
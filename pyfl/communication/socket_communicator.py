@@ -0,0 +1,429 @@
+"""
+Socket transport with the Communicator API.
+
+SocketCommunicator offers the register/send_message/recv_message API of the
+pipe based Communicator over TCP or Unix domain sockets, so the devices can
+live on other hosts. The server listens on one address and keeps a pool of
+persistent connections, one per device. A device opens one connection to the
+server when it registers and keeps it for the whole task.
+
+Every frame on a connection is an encoded Message behind an 8 byte length
+prefix. The first frame a point sends on a new connection is its id. Frames
+are plain bytes, tensors in shared memory are written raw instead of as
+handles, which would not outlive the sender nor reach another host.
+
+Sockets are non-blocking. Every connection queues the frames it sends: on an
+event loop the part the socket does not take at once is written when the
+socket is writable, so a slow peer never stalls the loop, other callers wait
+until their frame is written.
+"""
+import asyncio
+import collections
+import os
+import select
+import selectors
+import socket
+import struct
+import threading
+import time
+
+import loguru
+
+from pyfl.communication.communicator import wait_readable
+from pyfl.communication.message import Message
+
+log = loguru.logger
+
+LENGTH = struct.Struct('<Q')
+POINT_ID = struct.Struct('<q')
+RECV_SIZE = 1 << 20
+
+
+class Connection(object):
+  """
+  One persistent connection and its receive buffer
+
+  frames : Complete frames read off the socket and not handed out yet
+  closed : The other end closed the connection
+  pending : Write queue, the parts of the sent frames the socket has not taken yet
+  """
+
+  def __init__(self, sock):
+    sock.setblocking(False)
+    self.sock = sock
+    self.buffer = bytearray()
+    self.frames = []
+    self.closed = False
+    self.pending = collections.deque()
+    self.writer = None
+    self.lock = threading.Lock()
+
+  def send_frame(self, data):
+    """
+    Queues a frame and writes what the socket takes right away. Called from an
+    event loop the rest is written by the loop when the socket is writable,
+    otherwise the call waits until the frame is written
+    :param data: Frame bytes
+    :return: None
+    """
+    data = memoryview(data).cast('B')
+    with self.lock:
+      self.pending.append(memoryview(LENGTH.pack(data.nbytes)))
+      self.pending.append(data)
+      self.flush()
+      if not self.pending:
+        return
+      try:
+        loop = asyncio.get_running_loop()
+      except RuntimeError:
+        loop = None
+      if loop is not None:
+        if self.writer is None:
+          self.writer = loop
+          loop.add_writer(self.sock.fileno(), self.on_writable)
+        return
+    while True:
+      select.select([], [self.sock], [])
+      with self.lock:
+        self.flush()
+        if not self.pending:
+          return
+
+  def flush(self):
+    """
+    Writes the queued frames until the socket would block, the lock must be held
+    :return: None
+    """
+    while self.pending:
+      try:
+        sent = self.sock.send(self.pending[0])
+      except (BlockingIOError, InterruptedError):
+        return
+      if sent == len(self.pending[0]):
+        self.pending.popleft()
+      else:
+        self.pending[0] = self.pending[0][sent:]
+
+  def on_writable(self):
+    with self.lock:
+      try:
+        self.flush()
+      except OSError:
+        # The peer is gone, its reader sees the connection close
+        self.pending.clear()
+      if not self.pending:
+        self.writer.remove_writer(self.sock.fileno())
+        self.writer = None
+
+  def fill(self):
+    """
+    Reads what the socket has, the socket must be readable
+    :return: None
+    """
+    try:
+      chunk = self.sock.recv(RECV_SIZE)
+    except (BlockingIOError, InterruptedError):
+      return
+    if not chunk:
+      self.closed = True
+      return
+    self.buffer += chunk
+    offset = 0
+    while len(self.buffer) - offset >= LENGTH.size:
+      length, = LENGTH.unpack_from(self.buffer, offset)
+      end = offset + LENGTH.size + length
+      if end > len(self.buffer):
+        break
+      self.frames.append(bytes(self.buffer[offset + LENGTH.size:end]))
+      offset = end
+    del self.buffer[:offset]
+
+  def take_frames(self):
+    frames, self.frames = self.frames, []
+    return frames
+
+  def close(self):
+    self.closed = True
+    if self.writer is not None and not self.writer.is_closed():
+      self.writer.remove_writer(self.sock.fileno())
+    self.writer = None
+    self.sock.close()
+
+
+class SocketCommunicator(object):
+  """
+  Socket communicator
+
+  address : (host, port) tuple for TCP, a filesystem path for a Unix socket
+  connect_timeout : Seconds register retries while the server is not up
+  handshake_timeout : Seconds a new connection has to send its id before it is dropped
+
+  The server calls listen(server_id) once, every device then calls
+  register(device_id, server_id) which connects it to the server. A pickled
+  communicator only carries the address, every process opens its own sockets.
+  """
+
+  def __init__(self, address, connect_timeout=30., handshake_timeout=10.):
+    self.address = tuple(address) if not isinstance(address, str) else address
+    self.connect_timeout = connect_timeout
+    self.handshake_timeout = handshake_timeout
+    # local point id -> {peer id: Connection}
+    self.__connections = {}
+    self.__listeners = {}
+    self.__selectors = {}
+
+  def __getstate__(self):
+    return {'address': self.address, 'connect_timeout': self.connect_timeout,
+            'handshake_timeout': self.handshake_timeout}
+
+  def __setstate__(self, state):
+    self.__init__(state['address'], state['connect_timeout'], state['handshake_timeout'])
+
+  def __socket(self):
+    if isinstance(self.address, str):
+      return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+  def __selector(self, local_id):
+    if local_id not in self.__selectors:
+      self.__selectors[local_id] = selectors.DefaultSelector()
+    return self.__selectors[local_id]
+
+  def __add(self, local_id, peer_id, connection):
+    self.__connections.setdefault(local_id, {})[peer_id] = connection
+    selector = self.__selector(local_id)
+    if self.__is_watched(selector, connection.sock):
+      selector.modify(connection.sock, selectors.EVENT_READ, (peer_id, connection))
+    else:
+      selector.register(connection.sock, selectors.EVENT_READ, (peer_id, connection))
+
+  @staticmethod
+  def __is_watched(selector, sock):
+    try:
+      selector.get_key(sock)
+      return True
+    except KeyError:
+      return False
+
+  def listen(self, local_id, backlog=1024):
+    """
+    Starts accepting connections for local_id on the address. A TCP port 0
+    picks a free port, the address is updated with it
+    :param local_id: ID of the listening point, usually the server
+    :param backlog: Connections the OS queues before they are accepted
+    :return: The address listened on
+    """
+    sock = self.__socket()
+    if isinstance(self.address, str):
+      if os.path.exists(self.address):
+        os.unlink(self.address)
+    else:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(self.address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    if not isinstance(self.address, str):
+      self.address = (self.address[0], sock.getsockname()[1])
+    self.__listeners[local_id] = sock
+    self.__selector(local_id).register(sock, selectors.EVENT_READ, None)
+    log.debug("Listening on {} as {}".format(self.address, local_id))
+    return self.address
+
+  def register(self, pointa_id, pointb_id):
+    """
+    Connects pointa to pointb listening on the address, retrying until the
+    connect timeout while pointb is not up yet
+    :param pointa_id: ID of the connecting point, usually a device
+    :param pointb_id: ID of the listening point, usually the server
+    :return: None
+    """
+    deadline = time.monotonic() + self.connect_timeout
+    while True:
+      sock = self.__socket()
+      try:
+        sock.connect(self.address)
+        break
+      except (ConnectionRefusedError, FileNotFoundError):
+        sock.close()
+        if time.monotonic() > deadline:
+          raise
+        time.sleep(0.05)
+    connection = Connection(sock)
+    connection.send_frame(POINT_ID.pack(pointa_id))
+    self.__add(pointa_id, pointb_id, connection)
+    log.debug("Registered channel {}".format((pointa_id, pointb_id)))
+
+  def unregister(self, pointa_id, pointb_id):
+    """
+    Closes the connections between the two points this process holds
+    :param pointa_id: ID of one end of the channel
+    :param pointb_id: ID of the other end of the channel
+    :return: None
+    """
+    for local_id, peer_id in ((pointa_id, pointb_id), (pointb_id, pointa_id)):
+      self.__drop(local_id, peer_id)
+    log.debug("Unregistered channel {}".format((pointa_id, pointb_id)))
+
+  def __drop(self, local_id, peer_id):
+    connection = self.__connections.get(local_id, {}).pop(peer_id, None)
+    if connection is None:
+      return
+    if self.__is_watched(self.__selector(local_id), connection.sock):
+      self.__selector(local_id).unregister(connection.sock)
+    connection.close()
+
+  def is_registered(self, pointa_id, pointb_id):
+    return pointb_id in self.__connections.get(pointa_id, {})
+
+  def peers(self, receiver_id):
+    return list(self.__connections.get(receiver_id, {}).keys())
+
+  def send_message(self, sender_id, receiver_id, msg_class, msg_type, msg):
+    message = Message({
+      'sender_id': sender_id,
+      'receiver_id': receiver_id,
+      'message_class': msg_class,
+      'message_type': msg_type,
+      'message': msg
+    })
+    self.__connections[sender_id][receiver_id].send_frame(message.encode(share_memory=False))
+
+  def __accept(self, local_id):
+    try:
+      sock, _ = self.__listeners[local_id].accept()
+    except BlockingIOError:
+      return None
+    if not isinstance(self.address, str):
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return Connection(sock)
+
+  def __handshake(self, local_id, connection):
+    """
+    Moves a new connection into the pool once its first frame (the peer id) is in
+    :return: Peer id, None while the id has not arrived
+    """
+    if not connection.frames:
+      return None
+    peer_id, = POINT_ID.unpack(connection.frames.pop(0))
+    self.__add(local_id, peer_id, connection)
+    log.debug("Accepted channel {}".format((peer_id, local_id)))
+    return peer_id
+
+  def __read(self, local_id, peer_id, connection, messages):
+    connection.fill()
+    if peer_id is None:
+      peer_id = self.__handshake(local_id, connection)
+    if peer_id is not None:
+      messages.extend(Message.decode(frame) for frame in connection.take_frames())
+    if connection.closed:
+      log.debug('Channel closed by the other end')
+      if peer_id is None:
+        self.__selector(local_id).unregister(connection.sock)
+        connection.close()
+      else:
+        self.__drop(local_id, peer_id)
+
+  def recv_message(self, receiver_id, block=False, timeout=None):
+    '''
+    Waits on the listening socket and every connection of the receiver at once
+    and returns every message that is ready to be read. New connections are
+    accepted on the way
+    :param receiver_id: Receiver ID
+    :param block: If True, sleep until a message arrives (or timeout expires),
+    else return immediately with whatever is already waiting
+    :param timeout: Maximum time in seconds to wait when blocking, None waits forever
+    :return: List of Message objects, empty if nothing arrived in time
+    '''
+    messages = []
+    selector = self.__selectors.get(receiver_id)
+    if selector is None:
+      return messages
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      if not block:
+        wait = 0
+      elif deadline is None:
+        wait = None
+      else:
+        wait = max(deadline - time.monotonic(), 0)
+      for key, _ in selector.select(wait):
+        if key.data is None:
+          connection = self.__accept(receiver_id)
+          if connection is not None:
+            selector.register(connection.sock, selectors.EVENT_READ, (None, connection))
+        else:
+          self.__read(receiver_id, key.data[0], key.data[1], messages)
+      if messages or not block or (deadline is not None and time.monotonic() >= deadline):
+        return messages
+      if not selector.get_map():
+        return messages
+
+  async def recv_message_from(self, receiver_id, sender_id):
+    '''
+    Awaitable reader of one connection: suspends the calling task, not the event
+    loop, until the sender's messages are ready and returns all of them
+    :param receiver_id: Receiver ID
+    :param sender_id: Sender ID
+    :return: Non empty list of Message objects
+    :raises EOFError: When the connection was closed by the other end
+    '''
+    connection = self.__connections[receiver_id][sender_id]
+    while not connection.frames:
+      if connection.closed:
+        self.__drop(receiver_id, sender_id)
+        raise EOFError
+      await wait_readable(connection.sock.fileno())
+      connection.fill()
+    return [Message.decode(frame) for frame in connection.take_frames()]
+
+  async def new_peers(self, receiver_id):
+    '''
+    Yields the ID of every point connected to the receiver, then of every new
+    connection as it comes in
+    :param receiver_id: Receiver ID
+    '''
+    for peer_id in self.peers(receiver_id):
+      yield peer_id
+    listener = self.__listeners.get(receiver_id)
+    if listener is None:
+      return
+    # Every new connection sends its id in its own task, a stalled client only
+    # holds up itself
+    accepted = asyncio.Queue()
+    handshakes = set()
+    accepting = asyncio.create_task(self.__accept_peers(receiver_id, listener, accepted, handshakes))
+    try:
+      while True:
+        yield await accepted.get()
+    finally:
+      accepting.cancel()
+      for task in list(handshakes):
+        task.cancel()
+
+  async def __accept_peers(self, local_id, listener, accepted, handshakes):
+    while True:
+      await wait_readable(listener.fileno())
+      connection = self.__accept(local_id)
+      if connection is None:
+        continue
+      task = asyncio.create_task(self.__receive_id(local_id, connection, accepted))
+      handshakes.add(task)
+      task.add_done_callback(handshakes.discard)
+
+  async def __receive_id(self, local_id, connection, accepted):
+    async def first_frame():
+      while not connection.frames and not connection.closed:
+        await wait_readable(connection.sock.fileno())
+        connection.fill()
+
+    try:
+      await asyncio.wait_for(first_frame(), self.handshake_timeout)
+    except asyncio.TimeoutError:
+      log.debug('No id received within {}s, dropping the connection'.format(self.handshake_timeout))
+    peer_id = self.__handshake(local_id, connection)
+    if peer_id is None:
+      connection.close()
+    else:
+      accepted.put_nowait(peer_id)
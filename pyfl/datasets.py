@@ -1,12 +1,15 @@
 from __future__ import print_function
 
-from random import Random
+import json
+import os
 
+import numpy as np
 import torch
 import torch.distributed as dist
-import torchvision
-import torchvision.transforms as transforms
+import torch.nn.functional as F
 
+# torchvision (and PIL) are imported by the functions using them, the devices
+# training on tensor shards never load them
 mean = {
   'mnist': (0.1307,),
   'cifar10': (0.4914, 0.4822, 0.4465),
@@ -32,37 +35,138 @@ class Partition(object):
 
   def __init__(self, data, index):
     self.data = data
-    self.index = index
+    self.index = np.asarray(index, dtype=np.int64)
 
   def __len__(self):
     return len(self.index)
 
   def __getitem__(self, index):
-    data_idx = self.index[index]
+    data_idx = int(self.index[index])
     return self.data[data_idx]
 
+  def __getitems__(self, indices):
+    # Batched fetch used by the DataLoader, translated with one array gather
+    data_idx = self.index[indices]
+    if hasattr(self.data, '__getitems__'):
+      return self.data.__getitems__(data_idx)
+    return [self.data[i] for i in data_idx.tolist()]
+
+
+def dataset_targets(data):
+  """
+  :param data: Dataset with a targets attribute (torchvision datasets, ShardDataset)
+  :return: int64 array of labels
+  """
+  targets = data.targets
+  if torch.is_tensor(targets):
+    targets = targets.numpy()
+  return np.asarray(targets, dtype=np.int64)
+
+
+def _group_by_client(order, client_of_sample, num_clients):
+  """
+  Groups sample indexes by client with one stable sort
+  :param order: Array of sample indexes
+  :param client_of_sample: Client of each entry of order
+  :param num_clients: Number of clients
+  :return: List of index arrays, views of one contiguous array
+  """
+  grouped = order[np.argsort(client_of_sample, kind='stable')]
+  counts = np.bincount(client_of_sample, minlength=num_clients)
+  return np.split(grouped, np.cumsum(counts)[:-1])
+
+
+def iid_partitions(data_len, sizes, rng):
+  """
+  Uniform random split, partition i gets sizes[i] of the samples
+  """
+  indexes = rng.permutation(data_len)
+  bounds = np.cumsum((np.asarray(sizes) * data_len).astype(np.int64))
+  return np.split(indexes[:bounds[-1]], bounds[:-1])
+
+
+def label_shard_partitions(targets, num_clients, shards_per_client, rng):
+  """
+  Non-IID split: samples are sorted by label and cut in num_clients * shards_per_client
+  contiguous shards, every client gets shards_per_client random shards and
+  so only sees a few classes
+  """
+  order = rng.permutation(len(targets))
+  order = order[np.argsort(targets[order], kind='stable')]
+  num_shards = num_clients * shards_per_client
+  shard_of_sample = np.arange(len(order)) * num_shards // len(order)
+  client_of_shard = np.empty(num_shards, dtype=np.int64)
+  client_of_shard[rng.permutation(num_shards)] = np.arange(num_shards) // shards_per_client
+  return _group_by_client(order, client_of_shard[shard_of_sample], num_clients)
+
+
+def dirichlet_partitions(targets, num_clients, alpha, rng):
+  """
+  Non-IID split: the samples of every class are spread over the clients in
+  proportions drawn from Dirichlet(alpha), smaller alpha is more skewed
+  """
+  order = rng.permutation(len(targets))
+  order = order[np.argsort(targets[order], kind='stable')]
+  classes, class_counts = np.unique(targets, return_counts=True)
+  proportions = rng.dirichlet(np.full(num_clients, alpha), size=len(classes))
+  # Per class cut points, rounded so that every sample is assigned
+  cuts = np.round(np.cumsum(proportions, axis=1) * class_counts[:, None]).astype(np.int64)
+  per_client = np.diff(np.concatenate([np.zeros((len(classes), 1), dtype=np.int64), cuts], axis=1), axis=1)
+  client_of_sample = np.repeat(np.tile(np.arange(num_clients), len(classes)), per_client.reshape(-1))
+  return _group_by_client(order, client_of_sample, num_clients)
+
 
 class DataPartitioner(object):
+  """
+  Splits a dataset in partitions of index arrays
+
+  scheme : How samples are spread over the partitions
+    iid : Uniform random split, partition i gets sizes[i] of the dataset
+    label_shard : Every partition gets shards_per_client label-sorted shards
+    dirichlet : Class proportions of every partition drawn from Dirichlet(alpha)
+  The non-IID schemes make one partition per entry of sizes and need the
+  labels, read from data.targets if not given.
+  """
 
-  def __init__(self, data, sizes=[0.5, 0.5, 0.5], seed=1234):
+  def __init__(self, data, sizes=[0.5, 0.5, 0.5], seed=1234, scheme='iid',
+               targets=None, alpha=0.5, shards_per_client=2):
     self.data = data
-    self.partitions = []
-    rng = Random()
-    rng.seed(seed)
-    data_len = len(data)
-    indexes = [x for x in range(0, data_len)]
-    rng.shuffle(indexes)
-
-    for frac in sizes:
-      part_len = int(frac * data_len)
-      self.partitions.append(indexes[0:part_len])
-      indexes = indexes[part_len:]
+    rng = np.random.default_rng(seed)
+    if scheme == 'iid':
+      self.partitions = iid_partitions(len(data), sizes, rng)
+    else:
+      if targets is None:
+        targets = dataset_targets(data)
+      if scheme == 'label_shard':
+        self.partitions = label_shard_partitions(targets, len(sizes), shards_per_client, rng)
+      elif scheme == 'dirichlet':
+        self.partitions = dirichlet_partitions(targets, len(sizes), alpha, rng)
+      else:
+        raise NotImplementedError('Partition scheme {} not supported'.format(scheme))
 
   def use(self, partition):
     return Partition(self.data, self.partitions[partition])
 
 
-def get_data(args):
+def get_partitioner(args, data, num_partitions, targets=None):
+  """
+  Builds the partitioner selected by the run arguments, --iid_partion without
+  an explicit scheme means a label shard split
+  :param args: Argument object
+  :param data: Dataset to split
+  :param num_partitions: Number of devices
+  :param targets: Optional labels of the dataset
+  :return: DataPartitioner
+  """
+  scheme = args.partition_scheme
+  if scheme is None:
+    scheme = 'label_shard' if args.iid_partion else 'iid'
+  return DataPartitioner(data, [1.0 / num_partitions for _ in range(num_partitions)],
+                         seed=args.partition_seed, scheme=scheme, targets=targets,
+                         alpha=args.dirichlet_alpha, shards_per_client=args.shards_per_client)
+
+
+def get_transforms(dataset):
   """ Applies general preprocess transformations to Datasets
       ops -
       transforms.Normalize = Normalizes each channel of the image
@@ -70,17 +174,32 @@ def get_data(args):
       transforms.RandomCrops - crops the image at random location
       transforms.HorizontalFlip - randomly flips the image
   """
+  import torchvision.transforms as transforms
+
   transform_train = transforms.Compose([
-    transforms.RandomCrop(crop_size[args.dataset], padding=4),
+    transforms.RandomCrop(crop_size[dataset], padding=4),
     transforms.RandomHorizontalFlip(),
     transforms.ToTensor(),
-    transforms.Normalize(mean[args.dataset], std[args.dataset]),
+    transforms.Normalize(mean[dataset], std[dataset]),
   ])
 
   transform_test = transforms.Compose([
     transforms.ToTensor(),
-    transforms.Normalize(mean[args.dataset], std[args.dataset])
+    transforms.Normalize(mean[dataset], std[dataset])
   ])
+  return transform_train, transform_test
+
+
+def get_datasets(args, transform_train=None, transform_test=None):
+  """
+  Loads the train and test sets of the dataset in args
+  :param args: Argument object
+  :param transform_train: Transform of the train samples
+  :param transform_test: Transform of the test samples
+  :return: trainset, testset
+  """
+  import torchvision
+
   if args.dataset == 'mnist':
     trainset = torchvision.datasets.MNIST(
       root='./data', train=True, download=True, transform=transform_train)
@@ -102,12 +221,18 @@ def get_data(args):
       root='./data', train=False, download=True, transform=transform_test)
     args.num_classes = 100
 
+  return trainset, testset
+
+
+def get_data(args):
+  transform_train, transform_test = get_transforms(args.dataset)
+  trainset, testset = get_datasets(args, transform_train, transform_test)
+
   if args.dist:
     print('Sharding dataset')
     size = dist.get_world_size() - 1
     args.batch_size = int(args.batch_size / float(size))
-    partition_sizes = [1.0 / size for _ in range(size)]
-    partition = DataPartitioner(trainset, partition_sizes)
+    partition = get_partitioner(args, trainset, size)
     partition = partition.use(dist.get_rank() - 1)
     trainloader = torch.utils.data.DataLoader(partition,
                                               batch_size=args.batch_size,
@@ -122,6 +247,229 @@ def get_data(args):
   return trainloader, testloader
 
 
+class ShardDataset(torch.utils.data.Dataset):
+  """
+  Dataset over a shard written by write_shards. The arrays are memory-mapped,
+  so a device only reads the pages of its own shard and processes reading the
+  same files share them through the page cache.
+  """
+
+  def __init__(self, prefix, transform=None):
+    self.data = np.load(prefix + '_data.npy', mmap_mode='r')
+    self.targets = np.load(prefix + '_targets.npy', mmap_mode='r')
+    self.transform = transform
+
+  def __len__(self):
+    return len(self.targets)
+
+  def __getitem__(self, index):
+    from PIL import Image
+
+    img = Image.fromarray(np.asarray(self.data[index]))
+    if self.transform is not None:
+      img = self.transform(img)
+    return img, int(self.targets[index])
+
+  def __getitems__(self, indices):
+    # One gather from the memory map for the whole batch
+    from PIL import Image
+
+    indices = np.asarray(indices, dtype=np.int64)
+    data, targets = self.data[indices], self.targets[indices]
+    samples = []
+    for img, target in zip(data, targets.tolist()):
+      img = Image.fromarray(img)
+      if self.transform is not None:
+        img = self.transform(img)
+      samples.append((img, target))
+    return samples
+
+
+def raw_arrays(dataset):
+  """
+  :param dataset: torchvision MNIST/CIFAR dataset
+  :return: (uint8 images array, int64 targets array)
+  """
+  data = dataset.data.numpy() if torch.is_tensor(dataset.data) else np.asarray(dataset.data)
+  return data, np.asarray(dataset.targets, dtype=np.int64)
+
+
+def write_shards(out_dir, data, targets, partitions, testset=None):
+  """
+  Writes every partition as its own pair of .npy files, then a manifest that
+  marks the shard directory as complete
+  :param out_dir: Shard directory
+  :param data: Array of raw samples
+  :param targets: Array of labels
+  :param partitions: List of index arrays, one per shard
+  :param testset: Optional (data, targets) of the test set
+  :return: None
+  """
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+  for shard_id, index in enumerate(partitions):
+    index = np.sort(np.asarray(index, dtype=np.int64))
+    prefix = os.path.join(out_dir, 'train_{}'.format(shard_id))
+    np.save(prefix + '_data.npy', data[index])
+    np.save(prefix + '_targets.npy', targets[index])
+  if testset is not None:
+    np.save(os.path.join(out_dir, 'test_data.npy'), testset[0])
+    np.save(os.path.join(out_dir, 'test_targets.npy'), testset[1])
+  manifest = {'num_shards': len(partitions), 'sizes': [int(len(index)) for index in partitions]}
+  with open(os.path.join(out_dir, 'manifest.json.tmp'), 'w') as f:
+    json.dump(manifest, f)
+  os.replace(os.path.join(out_dir, 'manifest.json.tmp'), os.path.join(out_dir, 'manifest.json'))
+
+
+def shard_dir(args, num_shards):
+  """
+  Directory of the cached shards, named after every parameter of the partition
+  :param args: Argument object
+  :param num_shards: Number of devices
+  :return: Path
+  """
+  scheme = args.partition_scheme or ('label_shard' if args.iid_partion else 'iid')
+  return os.path.join('./data', 'shards', '{}_{}_{}_alpha{}_spc{}_{}'.format(
+    args.dataset, num_shards, scheme, args.dirichlet_alpha, args.shards_per_client, args.partition_seed))
+
+
+def cache_shards(args, num_shards):
+  """
+  One-time sharding step, run once before the devices start. Loads the raw
+  train set, partitions it and writes one shard per device. Does nothing if
+  the shards are already cached
+  :param args: Argument object
+  :param num_shards: Number of devices
+  :return: Shard directory
+  """
+  out_dir = shard_dir(args, num_shards)
+  if os.path.exists(os.path.join(out_dir, 'manifest.json')):
+    return out_dir
+  trainset, testset = get_datasets(args)
+  data, targets = raw_arrays(trainset)
+  partitions = get_partitioner(args, trainset, num_shards, targets).partitions
+  write_shards(out_dir, data, targets, partitions, raw_arrays(testset))
+  return out_dir
+
+
+def get_shard_data(args, shard_id, num_shards):
+  """
+  Loads the cached shard of a device, memory-mapped
+  :param args: Argument object
+  :param shard_id: Index of the device's shard
+  :param num_shards: Number of devices
+  :return: trainloader, testloader
+  """
+  transform_train, transform_test = get_transforms(args.dataset)
+  out_dir = shard_dir(args, num_shards)
+  trainset = ShardDataset(os.path.join(out_dir, 'train_{}'.format(shard_id)), transform_train)
+  testset = ShardDataset(os.path.join(out_dir, 'test'), transform_test)
+  args.num_classes = 100 if args.dataset == 'cifar100' else 10
+  args.batch_size = int(args.batch_size / float(num_shards))
+  trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size, shuffle=True)
+  testloader = torch.utils.data.DataLoader(testset, batch_size=args.batch_size, shuffle=False)
+  return trainloader, testloader
+
+
+class TensorBatchLoader(object):
+  """
+  Loader over a shard kept as one pre-normalized float tensor.
+  Random crop (zero padding) and horizontal flip are applied to whole
+  minibatches with a single gather, and batches are yielded without going
+  through the DataLoader worker machinery. Iterates like a DataLoader.
+
+  data : uint8 array of images, NHW (grayscale) or NHWC
+  targets : Array of labels
+  dataset : Dataset name, picks the normalization constants
+  train : Shuffle and augment the batches
+  """
+
+  def __init__(self, data, targets, dataset, batch_size, train=True, padding=4, seed=None):
+    data = torch.as_tensor(np.asarray(data))
+    data = data.unsqueeze(1) if data.dim() == 3 else data.permute(0, 3, 1, 2)
+    channel_mean = torch.tensor(mean[dataset]).view(1, -1, 1, 1)
+    channel_std = torch.tensor(std[dataset]).view(1, -1, 1, 1)
+    self.data = data.float().div_(255.).sub_(channel_mean).div_(channel_std).contiguous()
+    self.targets = torch.as_tensor(np.asarray(targets, dtype=np.int64))
+    self.dataset = torch.utils.data.TensorDataset(self.data, self.targets)
+    # Normalized value of a black pixel, what RandomCrop pads with
+    self.pad_value = (-channel_mean / channel_std)
+    self.batch_size = batch_size
+    self.train = train
+    self.padding = padding
+    self.generator = torch.Generator()
+    self.generator.manual_seed(seed if seed is not None else torch.initial_seed())
+
+  def __len__(self):
+    return (len(self.targets) + self.batch_size - 1) // self.batch_size
+
+  def augment(self, batch):
+    """
+    Random crop and horizontal flip of a whole batch
+    :param batch: Normalized NCHW tensor
+    :return: Augmented NCHW tensor
+    """
+    n, c, h, w = batch.shape
+    p = self.padding
+    # Pad with the normalized black value by padding the shifted batch with zeros
+    padded = F.pad(batch - self.pad_value, (p, p, p, p)) + self.pad_value
+    offset_y = torch.randint(0, 2 * p + 1, (n, 1), generator=self.generator)
+    offset_x = torch.randint(0, 2 * p + 1, (n, 1), generator=self.generator)
+    rows = offset_y + torch.arange(h)
+    cols = offset_x + torch.arange(w)
+    # The flip is folded into the column gather
+    flip = torch.rand(n, 1, generator=self.generator) < 0.5
+    cols = torch.where(flip, cols.flip(1), cols)
+    return padded[torch.arange(n).view(n, 1, 1, 1), torch.arange(c).view(1, c, 1, 1),
+                  rows.view(n, 1, h, 1), cols.view(n, 1, 1, w)]
+
+  def __iter__(self):
+    if self.train:
+      order = torch.randperm(len(self.targets), generator=self.generator)
+    else:
+      order = torch.arange(len(self.targets))
+    for start in range(0, len(order), self.batch_size):
+      index = order[start:start + self.batch_size]
+      batch = self.data[index]
+      if self.train:
+        batch = self.augment(batch)
+      yield batch, self.targets[index]
+
+
+def get_tensor_data(args, shard_id, num_shards, evaluate=False):
+  """
+  Loads a device's shard as pre-normalized tensors, from the shard cache if
+  --cache_shards is set, else from a partition of the raw dataset
+  :param args: Argument object
+  :param shard_id: Index of the device's shard
+  :param num_shards: Number of devices
+  :param evaluate: Also load the test set. Only the evaluating role needs it,
+  every other process would hold its own normalized copy for nothing
+  :return: trainloader, testloader (TensorBatchLoader, None unless evaluate)
+  """
+  testloader = None
+  if args.cache_shards:
+    out_dir = shard_dir(args, num_shards)
+    prefix = os.path.join(out_dir, 'train_{}'.format(shard_id))
+    data, targets = np.load(prefix + '_data.npy', mmap_mode='r'), np.load(prefix + '_targets.npy', mmap_mode='r')
+    if evaluate:
+      test_data = np.load(os.path.join(out_dir, 'test_data.npy'), mmap_mode='r')
+      test_targets = np.load(os.path.join(out_dir, 'test_targets.npy'), mmap_mode='r')
+  else:
+    trainset, testset = get_datasets(args)
+    data, targets = raw_arrays(trainset)
+    index = get_partitioner(args, trainset, num_shards, targets).partitions[shard_id]
+    data, targets = data[index], targets[index]
+    if evaluate:
+      test_data, test_targets = raw_arrays(testset)
+  args.num_classes = 100 if args.dataset == 'cifar100' else 10
+  args.batch_size = int(args.batch_size / float(num_shards))
+  trainloader = TensorBatchLoader(data, targets, args.dataset, args.batch_size, train=True)
+  if evaluate:
+    testloader = TensorBatchLoader(test_data, test_targets, args.dataset, args.batch_size, train=False)
+  return trainloader, testloader
+
+
 '''
 def make_data_partition(args):
   """
@@ -1,12 +1,19 @@
 import abc
+import os
 
 import torch
 import torch.backends.cudnn as cudnn
+import torch.nn as nn
 
 from pyfl.communication.communicator import Communicator
-from pyfl.communication.message import Message
+from pyfl.communication.compression import Compressor, payload_nbytes
+from pyfl.communication.delta import ModelDelta
+from pyfl.communication.masked import MaskedDecoder, MaskedEncoder, MaskedWeights
+from pyfl.communication.message import held_version, ready_payload, update_payload, version_payload
 from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
-from pyfl.communication.message_definitions import ServerDeviceSendClass, ServerDeviceNotifClass
+from pyfl.communication.message_definitions import ServerDeviceNotifClass, ServerDeviceQueryClass
+from pyfl.communication.shared_memory import SharedModelHandle
+from pyfl.models.flat_params import FlatParameters
 from pyfl.utils import get_logger, get_model
 
 logger = get_logger(__name__)
@@ -87,6 +94,14 @@ class Device(DeviceBase):
   * Sync_server : Send the gradient updates to server
     0 : The updates are not sent
     1 : The updates are sent
+  * Mask_transfer : Send only the unmasked weights of the updates (optional)
+  * Local_epochs : Epochs of local training per round (optional, default 1)
+  * Stratum : Data or hardware class of the device, reported when it is ready
+    and used by stratified selection (optional, default 0)
+  * Server_timeout : Seconds of silence of the server after which the device
+    stops (optional, waits forever if missing). The server probes its devices
+    every heartbeat interval, the probes are answered with D2S_TASK_RUNNING,
+    and notifies them when the task is finished
 
   Device2Server message system:
   We have three classes of messages
@@ -106,41 +121,178 @@ class Device(DeviceBase):
 
   If the server accepts the participation request of the device,
   we set participate var to 1. If the request is rejected we set it to 0
+
+  The built model, its optimizer state and the version of the global model
+  are kept across rounds: a returning device skips the model download when it
+  holds the current version and only applies a delta otherwise. With a
+  spill_dir in the device config they are written to disk while the device is
+  idle and read back when it is selected again.
   """
 
-  def __init__(self, device_config, dataset, communicator):
+  def __init__(self, device_config, dataset, communicator, compressor=None):
     self.device_config = device_config
     self.dataset = dataset
     self.model = None
     self.optimizer = None
     self.communicator = communicator
     self.lr_scheduler = None
+    self.criterion = nn.CrossEntropyLoss()
     self.participate = False
+    # Messages of the server received and not handled yet
+    self.inbox = []
     self.task_config = None
-    self.gradient_updates = []
+    self.flat_params = None
+    self.gradient_updates = None
+    # Compression stage of the updates, keeps the error-feedback residual across rounds
+    self.compressor = compressor if compressor is not None else Compressor(error_feedback=False)
+    self.bytes_sent = []
+    # Mean training loss of the last local epoch, reported with the update
+    self.last_loss = None
+    # Mask-aware transfer: only the unpruned weights travel, the mask once per version
+    self.mask_encoder = MaskedEncoder() if device_config.get('mask_transfer') else None
+    if self.mask_encoder is not None and self.compressor.codec != 'none':
+      logger.warning('Mask transfer is skipped for {} compressed updates'.format(self.compressor.codec))
+    self.mask_decoder = MaskedDecoder()
+    # Version and copy of the global model held, local training leaves the
+    # copy untouched so the next delta applies to it
+    self.model_version = None
+    self.global_weights = None
+    # Checkpoint of the idle device's model, None while it is in memory
+    self.spill_path = None
 
   def build_device(self, task_config):
     self.model, self.optimizer = get_model(task_config)
+    # Pack the weights, grads and masks in flat buffers so that applying,
+    # accumulating and sending updates are single tensor ops
+    self.flat_params = FlatParameters(self.model)
+    self.model_version = None
+    self.global_weights = None
+
+  def prepare_model(self, task_config):
+    """
+    Makes the model of a task ready, reusing the one of the previous rounds
+    when the task did not change
+    :param task_config: Task config sent by the server
+    :return: True if the model was built from scratch
+    """
+    if task_config == self.task_config:
+      if self.spill_path is not None:
+        self.unspill()
+      if self.model is not None:
+        return False
+    self.task_config = task_config
+    self.spill_path = None
+    self.build_device(task_config)
+    return True
+
+  def spill(self):
+    """
+    Writes the model weights, the optimizer state and the model version to the
+    spill_dir of the device config and frees the model
+    :return: Path of the spilled state
+    """
+    path = os.path.join(self.device_config['spill_dir'], 'device-{}.pt'.format(self.device_config['device_id']))
+    os.makedirs(self.device_config['spill_dir'], exist_ok=True)
+    torch.save({'weights': self.global_weights, 'optimizer': self.optimizer.state_dict(),
+                'version': self.model_version}, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    self.model, self.optimizer, self.flat_params, self.gradient_updates = None, None, None, None
+    self.global_weights = None
+    self.spill_path = path
+    return path
+
+  def unspill(self):
+    """
+    Rebuilds the model from the registry's template and reads the spilled state back
+    :return: None
+    """
+    state = torch.load(self.spill_path)
+    self.build_device(self.task_config)
+    self.optimizer.load_state_dict(state['optimizer'])
+    if state['weights'] is not None:
+      self.flat_params.set_flat_weights(state['weights'])
+      self.global_weights = state['weights']
+      self.model_version = state['version']
+    os.remove(self.spill_path)
+    self.spill_path = None
 
-  # def send_message(self,
-  #                  message):
-  #   logger.info('Sending Message {} to Server'.format(message.message_params))
-  #   self.comm.send(message)
-  #   server_response = self.recv_message()
-  #   return server_response
-  #
-  # def recv_message(self):
-  #   message = self.comm.recv()
-  #   logger.info('Received Message {} from Server'.format(message.message_params))
-  #   return message
+  def send_message(self, msg_class, msg_type, msg=None):
+    self.communicator.send_message(self.device_config['device_id'], self.device_config['server_id'],
+                                   msg_class, msg_type, msg)
+
+  def recv_message(self, message_class):
+    """
+    Waits for the next message of the server, answering its liveness probes on the way
+    :param message_class: Class of the message expected
+    :return: Message
+    :raises EOFError: When the task is finished or the server has been silent for server_timeout seconds
+    """
+    while True:
+      if not self.inbox:
+        self.inbox = self.communicator.recv_message(self.device_config['device_id'], block=True,
+                                                    timeout=self.device_config.get('server_timeout'))
+        # A blocking receive only comes back empty on timeout or a closed channel
+        if not self.inbox:
+          raise EOFError('No message from the server')
+      message = self.inbox.pop(0)
+      if isinstance(message.message_class, ServerDeviceQueryClass):
+        self.send_message(device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_TASK_RUNNING)
+        continue
+      if isinstance(message.message_class, ServerDeviceNotifClass) and \
+          message.message_type == ServerDeviceNotifClass.S2D_TASK_FINISHED:
+        raise EOFError('Task finished')
+      if not isinstance(message.message_class, type(message_class)):
+        logger.error('Wrong message class used by the server')
+        raise ValueError
+      return message
 
   def apply_weights(self, weights_list):
-    count = 0
-    for layer in self.model.parameters():
-      if hasattr(layer, 'mask'):
-        layer.weight.data = weights_list[count]
-        self.gradient_updates.append(torch.zeros_like(layer.weight.data))
-        count += 1
+    """
+    Copy the global weights into the local model and reset the running updates
+    :param weights_list: Flat weights tensor, list of weight tensors (in model.parameters()
+    order), a SharedModelHandle, MaskedWeights or ModelDelta
+    :return: None
+    """
+    if isinstance(weights_list, ModelDelta):
+      if weights_list.is_full():
+        self.global_weights = torch.empty_like(self.flat_params.weights.detach())
+      elif weights_list.base_version != self.model_version or self.global_weights is None:
+        raise ValueError('Delta from version {} applied to version {}'.format(
+          weights_list.base_version, self.model_version))
+      weights_list.apply(self.global_weights)
+      self.model_version = weights_list.version
+      self.restore_global_model()
+      return
+    if isinstance(weights_list, MaskedWeights):
+      # Only the active weights are sent, a new mask comes along with its bitmap
+      self.mask_decoder.resolve(weights_list, self.device_config['server_id'])
+      if weights_list.packed_mask is not None:
+        self.flat_params.set_weight_mask(self.mask_decoder.active(weights_list))
+      with torch.no_grad():
+        self.flat_params.weights.index_copy_(0, weights_list.indices, weights_list.values)
+      self.model_version, self.global_weights = None, None
+      self.gradient_updates = torch.zeros_like(self.flat_params.weights)
+      return
+    # Weights published in shared memory are copied out and checked against
+    # a publish overwriting them during the copy
+    if isinstance(weights_list, SharedModelHandle):
+      self.flat_params.set_flat_weights(weights_list.read())
+    elif torch.is_tensor(weights_list):
+      self.flat_params.set_flat_weights(weights_list)
+    else:
+      self.flat_params.set_weights(weights_list)
+    # Unversioned weights, the next model comes in full
+    self.model_version, self.global_weights = None, None
+    self.gradient_updates = torch.zeros_like(self.flat_params.weights)
+
+  def restore_global_model(self):
+    """
+    Resets the local model to the copy of the global model held, undoing the
+    local training of the previous round
+    :return: None
+    """
+    self.flat_params.set_flat_weights(self.global_weights)
+    self.gradient_updates = torch.zeros_like(self.flat_params.weights)
 
   def ping_server(self):
     """
@@ -149,95 +301,60 @@ class Device(DeviceBase):
     1. Tell the server device is ready to participate, see what the server says
     2. If accepted, ask the server for task config
     3. Ask the server for global model weights (build the model, optim objects based on task config)
-    :return:
-    """
-    # participate_query_response = self.send_message(Message({
-    #   'sender_id': self.device_config['device_id'],
-    #   'receiver_id': self.device_config['server_id'],
-    #   'message_class': device2server.D2S_NOTIF_CLASS,
-    #   'message_type': device2server.D2S_NOTIF_CLASS.D2S_READY if
-    #   self.device_config['ready']
-    #   else device2server.D2S_NOTIF_CLASS.D2S_NOT_READY,
-    #   'message': None
-    # }))
-    self.communicator.send_message(self.device_config['device_id'],
-                                   self.device_config['server_id'],
-                                   device2server.D2S_NOTIF_CLASS,
-                                   device2server.D2S_NOTIF_CLASS.D2S_READY,
-                                   None)
-    exit(0)
-    if not (isinstance(participate_query_response.message_class, ServerDeviceNotifClass)):
-      logger.error('Wrong message class used by the server')
-      raise ValueError
-    else:
-      self.participate = participate_query_response.message_type
-
-    if self.participate == 0:
-      return
+    :return: True if the device was selected and holds the global model
+    """
+    self.send_message(device2server.D2S_NOTIF_CLASS,
+                      device2server.D2S_NOTIF_CLASS.D2S_READY if self.device_config['ready']
+                      else device2server.D2S_NOTIF_CLASS.D2S_NOT_READY,
+                      ready_payload(self.model_version, self.device_config.get('stratum')))
+    participate_query_response = self.recv_message(server2device.S2D_NOTIF_CLASS)
+    self.participate = participate_query_response.message_type == server2device.S2D_NOTIF_CLASS.S2D_SELECTED
+    if not self.participate:
+      return False
 
     # Query the server for Task config, which is going to be a dict
     # with all training config params in it.
-    task_query_response = self.send_message(Message({
-      'sender_id': self.device_config['device_id'],
-      'receiver_id': self.device_config['server_id'],
-      'message_class': device2server.D2S_QUERY_CLASS,
-      'message_type': device2server.D2S_QUERY_CLASS.D2S_QUERY_TASK_CONFIG,
-      'message': None
-    }))
-    # Check if the received message of the correct class
-    if not (isinstance(task_query_response.message_class, ServerDeviceSendClass)):
-      logger.error('Wrong message class used by the server')
+    self.send_message(device2server.D2S_QUERY_CLASS, device2server.D2S_QUERY_CLASS.D2S_QUERY_TASK_CONFIG)
+    task_config = self.recv_message(server2device.S2D_SEND_CLASS).message
+    if task_config is None:
+      logger.error('Task config is None type')
       raise ValueError
-    else:
-      # Store the task_config in the the class attribute
-      self.task_config = task_query_response.message
-      if self.task_config is None:
-        logger.error('Task config is None type')
 
-    # Create the model, optimizer object to store the global weights in it
-    self.build_device(self.task_config)
+    # Create the model, optimizer object to store the global weights in it,
+    # or reuse the ones of the previous rounds
+    self.prepare_model(task_config)
 
-    # Query the server for the global model weights
-    model_query_response = self.send_message(Message({
-      'sender_id': self.device_config['device_id'],
-      'receiver_id': self.device_config['server_id'],
-      'message_class': device2server.D2S_QUERY_CLASS,
-      'message_type': device2server.D2S_QUERY_CLASS.D2S_QUERY_GLOBAL_MODEL,
-      'message': None
-    }))
-    if not (isinstance(model_query_response['message_class'], ServerDeviceSendClass)):
-      logger.error('Wrong message class used by the server')
-      raise ValueError
-    else:
-      # Store the model in the the class attribute
-      weights = task_query_response.message
-      if self.model is None:
-        logger.error('Model not instantiated')
-      else:
-        self.apply_weights(weights)
-        logger.info('Applied global weights to local model')
+    # The server tells the selected devices the current version
+    if self.model_version is not None and self.model_version == held_version(participate_query_response):
+      self.restore_global_model()
+      logger.info('Global model version {} already held, skipping the download'.format(self.model_version))
+      return True
+
+    # Query the server for the global model weights, a delta from the version held
+    self.send_message(device2server.D2S_QUERY_CLASS, device2server.D2S_QUERY_CLASS.D2S_QUERY_GLOBAL_MODEL,
+                      version_payload(self.model_version))
+    self.apply_weights(self.recv_message(server2device.S2D_SEND_CLASS).message)
+    logger.info('Applied global weights to local model')
+    return True
 
   def store_grads(self):
     """
     Maintain a running average of the model's gradients to send to the server
     :return: None
     """
-    count = 0
-    for layer in self.model.parameters():
-      if hasattr(layer, 'mask'):
-        self.gradient_updates[count] = (0.7 * layer.weight.grad.data) + (0.3 * self.gradient_updates[count])
-        count += 1
+    self.gradient_updates.mul_(0.3).add_(self.flat_params.grads, alpha=0.7)
 
   def train_step(self):
     """
     Good ol' training step
-    :return:
+    :return: Number of correctly classified training samples
     """
     self.model.train()
     correct = 0
+    total_loss, num_batches = 0., 0
     for batch_idx, (data, target) in enumerate(self.dataset['trainset']):
       data, target = data.to(device), target.to(device)
-      self.optimizer.zero_grad()
+      self.flat_params.zero_grad()
       output = self.model(data)
       loss = self.criterion(output, target)
       loss.backward()
@@ -245,20 +362,60 @@ class Device(DeviceBase):
       self.optimizer.step()
       pred = output.argmax(dim=1, keepdim=True)  # get the index of the max log-probability
       correct += pred.eq(target.view_as(pred)).sum().item()
+      total_loss += loss.item()
+      num_batches += 1
+    self.last_loss = total_loss / num_batches if num_batches else None
+    return correct
 
   def execute_task(self):
-    logger.info('Executing {} task'.format(self.task_config['task_name']))
+    logger.info('Executing {} task'.format(self.task_config.get('task_name', self.task_config['model'])))
     logger.info('Using task config {}'.format(self.task_config))
+    for epoch in range(self.device_config.get('local_epochs', 1)):
+      correct = self.train_step()
+      logger.info('Local epoch {}: {} training samples correct, loss {}'.format(epoch, correct, self.last_loss))
 
   def run_device(self):
+    """
+    Runs rounds until the task is finished: report ready, and when selected
+    train on the global model and send the update
+    :return: None
+    """
     # Setting the device to ready
     self.device_config['ready'] = 1
     logger.info("Set device_config['ready'] to 1")
-    # Ping the server to get task config and global weights to
-    # start the task
-    self.ping_server()
-    exit(0)
-    self.execute_task()
+    try:
+      while True:
+        # Ping the server to get task config and global weights to
+        # start the task
+        if self.ping_server():
+          self.execute_task()
+          self.update_model()
+    except EOFError as e:
+      logger.info('Device stopping: {}'.format(e))
 
   def update_model(self):
-    print('updating local model')
+    """
+    Send the running average of the gradients to the server, weighted by the
+    number of local training samples
+    :return: None
+    """
+    num_samples = len(self.dataset['trainset'].dataset)
+    if self.mask_encoder is not None and self.compressor.codec == 'none':
+      self.mask_encoder.set_mask(self.flat_params.weight_mask())
+      update = self.mask_encoder.encode(self.gradient_updates, self.device_config['server_id'])
+    else:
+      update = self.compressor.compress(self.gradient_updates)
+    self.communicator.send_message(self.device_config['device_id'],
+                                   self.device_config['server_id'],
+                                   device2server.D2S_UPDATE_CLASS,
+                                   device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                                   update_payload(update, num_samples, self.last_loss))
+    nbytes = payload_nbytes(update)
+    self.bytes_sent.append(nbytes)
+    # A sparse update may keep no value at all
+    ratio = payload_nbytes(self.gradient_updates) / float(nbytes) if nbytes else float('inf')
+    logger.info('Sent {} gradient update of {} bytes ({:.1f}x smaller than dense) over {} samples'.format(
+      'masked' if isinstance(update, MaskedWeights) else self.compressor.codec, nbytes, ratio, num_samples))
+    # Idle until the next selection
+    if self.device_config.get('spill_dir'):
+      self.spill()
@@ -0,0 +1,186 @@
+"""
+Multi-client simulation: many logical devices inside one worker process.
+
+A SimulatedDevicePool hosts one Device object per simulated client. The
+clients share one model skeleton (with its flat buffers and optimizer) and one
+copy of the dataset, each client only owns an index array into it. Training
+a client swaps its state into the skeleton, runs the usual Device training
+step and swaps the state back out, so memory stays bounded by one model plus
+the small per-client state no matter how many clients the worker hosts.
+With vectorize set, the clients are instead trained K at a time in one batched
+pass over stacked weights, see pyfl.device.vectorized.
+"""
+import os
+import time
+from collections import defaultdict
+
+import torch
+
+from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
+from pyfl.communication.message_definitions import ServerDeviceSendClass
+from pyfl.datasets import Partition
+from pyfl.device.device import Device
+from pyfl.device.vectorized import VectorizedTrainer
+from pyfl.models.flat_params import FlatParameters
+from pyfl.server.aggregator import Aggregator
+from pyfl.utils import get_logger, get_model
+
+logger = get_logger(__name__)
+device2server = DeviceServerMessage()
+server2device = ServerDeviceMessage()
+
+
+class SimulatedDevicePool(object):
+  """
+  Simulated device pool
+
+  What is pool config ? A dict with the following params:
+  pool_id : A unique identifier for this worker
+  server_id : Server id
+  device_ids : Ids of the simulated devices hosted by this worker
+  task_config : Task config used to build the shared model skeleton
+  batch_size : Local batch size of every device
+  local_epochs : Number of passes over its shard a device makes per round
+  vectorize : Optional, number of devices trained together in one batched pass
+              (sgd only), 0 or missing trains the devices one after another
+  latency : Optional, maps device ids to extra seconds their training takes,
+            to simulate slow devices
+
+  partitions maps every device id to the index array of its shard in trainset.
+  """
+
+  def __init__(self, pool_config, trainset, partitions, communicator=None):
+    self.config = pool_config
+    self.trainset = trainset
+    self.communicator = communicator
+    # One skeleton for every client
+    self.model, self.optimizer = get_model(pool_config['task_config'])
+    self.flat_params = FlatParameters(self.model)
+    self.devices = {}
+    for device_id in pool_config['device_ids']:
+      device_config = {
+        'device_id': device_id,
+        'server_id': pool_config['server_id'],
+        'ready': 1,
+        'participate': 0,
+        'task_status': 0,
+        'update_local_model': 0,
+        'sync_server': 0,
+        'model': pool_config['task_config']['model'],
+        'optimizer': pool_config['task_config']['optimizer']
+      }
+      loader = torch.utils.data.DataLoader(Partition(trainset, partitions[device_id]),
+                                           batch_size=pool_config['batch_size'], shuffle=True)
+      self.devices[device_id] = Device(device_config, {'trainset': loader}, communicator)
+    # Per client optimizer state (e.g. momentum), only kept when non empty
+    self.optimizer_states = {}
+    self.trainer = None
+    if pool_config.get('vectorize', 0) > 1:
+      if pool_config['task_config']['optimizer'] != 'sgd':
+        raise ValueError('Vectorized training only supports sgd')
+      lr_params = pool_config['task_config'].get('lr_params') or {}
+      self.trainer = VectorizedTrainer(self.model, lr_params.get('initial_lr', 0.01),
+                                       lr_params.get('momentum', 0.), lr_params.get('weight_decay', 0.),
+                                       lr_params.get('nesterov', False))
+
+  def swap_in(self, device):
+    """
+    Points the device at the shared skeleton and loads its optimizer state
+    :param device: Device
+    :return: None
+    """
+    device.model = self.model
+    device.optimizer = self.optimizer
+    device.flat_params = self.flat_params
+    self.optimizer.state = self.optimizer_states.pop(device.device_config['device_id'], defaultdict(dict))
+
+  def swap_out(self, device):
+    """
+    Stores the device's optimizer state and releases the skeleton
+    :param device: Device
+    :return: None
+    """
+    if self.optimizer.state:
+      self.optimizer_states[device.device_config['device_id']] = self.optimizer.state
+    self.optimizer.state = defaultdict(dict)
+    device.model = None
+    device.optimizer = None
+    device.flat_params = None
+    device.gradient_updates = None
+
+  def train_device(self, device_id, global_weights):
+    """
+    Runs one round of local training of a simulated device
+    :param device_id: Device id
+    :param global_weights: Flat global model weights
+    :return: (update, number of samples)
+    """
+    device = self.devices[device_id]
+    self.swap_in(device)
+    try:
+      device.apply_weights(global_weights)
+      for _ in range(self.config['local_epochs']):
+        device.train_step()
+      time.sleep(self.config.get('latency', {}).get(device_id, 0))
+      return device.gradient_updates, len(device.dataset['trainset'].dataset)
+    finally:
+      self.swap_out(device)
+
+  def run_round(self, global_weights, device_ids=None):
+    """
+    Trains the given devices one after another, folding every update into a
+    running partial sum as soon as it is produced
+    :param global_weights: Flat global model weights
+    :param device_ids: Devices taking part, all hosted devices if None
+    :return: (weighted sum of updates, sum of weights, number of updates)
+    """
+    aggregator = Aggregator({'aggregator_id': self.config['pool_id']})
+    device_ids = list(device_ids if device_ids is not None else self.devices.keys())
+    if self.trainer is not None:
+      chunk = self.config['vectorize']
+      for start in range(0, len(device_ids), chunk):
+        chunk_ids = device_ids[start:start + chunk]
+        loaders = [self.devices[device_id].dataset['trainset'] for device_id in chunk_ids]
+        buffers = None
+        if self.trainer.momentum:
+          # Momentum buffers are per client state, kept across rounds like the optimizer states
+          buffers = torch.stack([self.optimizer_states.get(device_id, torch.zeros_like(global_weights))
+                                 for device_id in chunk_ids])
+        updates, _ = self.trainer.train(global_weights, loaders, self.config['local_epochs'], buffers)
+        if buffers is not None:
+          self.optimizer_states.update(zip(chunk_ids, buffers))
+        # Devices trained in lock step finish with the slowest of them
+        time.sleep(max(self.config.get('latency', {}).get(device_id, 0) for device_id in chunk_ids))
+        # Every device's update is still reported on its own
+        for update, loader in zip(updates, loaders):
+          aggregator.accumulate(update, len(loader.dataset))
+      return aggregator.ping_master()
+    for device_id in device_ids:
+      update, num_samples = self.train_device(device_id, global_weights)
+      aggregator.accumulate(update, num_samples)
+    return aggregator.ping_master()
+
+  def serve(self):
+    """
+    Worker loop: waits for the server to send the global model along with the
+    devices selected in this worker, trains them and sends back one partial sum,
+    tagged with the model version the server sent. An empty device list stops
+    the worker.
+    :return: None
+    """
+    pool_id, server_id = self.config['pool_id'], self.config['server_id']
+    while True:
+      for message in self.communicator.recv_message(pool_id, block=True):
+        if not (isinstance(message.message_class, ServerDeviceSendClass) and
+                message.message_type == ServerDeviceSendClass.S2D_SEND_GLOBAL_MODEL):
+          continue
+        device_ids = message.message['device_ids']
+        if not device_ids:
+          return
+        total, weight, count = self.run_round(message.message['weights'], device_ids)
+        self.communicator.send_message(pool_id, server_id,
+                                       device2server.D2S_UPDATE_CLASS,
+                                       device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                                       {'update': total, 'num_samples': weight, 'count': count,
+                                        'version': message.message.get('version', 0)})
+        logger.info('Worker {} (pid {}) trained {} devices'.format(pool_id, os.getpid(), count))
@@ -0,0 +1,136 @@
+"""
+Vectorized training of several simulated clients sharing one architecture.
+
+The weights of K clients are stacked along a leading dimension, one row of a
+[K, numel] tensor per client, and the model is called functionally on every
+row at once with torch.func.vmap. Under vmap the convolutions of the K clients
+run as one grouped convolution and their dense layers as one batched matmul,
+so a single forward/backward pass trains all K clients on one batch each.
+
+Every client keeps its own weights, its own running gradient average (the same
+update a Device sends), its own momentum buffer and its own data order, clients
+that run out of data earlier than the others simply stop being updated.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, grad_and_value, vmap
+
+
+def _padded(data, target, batch_size):
+  """
+  Pads a batch up to batch_size, the padded samples get a zero loss weight
+  :return: (data, target, per sample weights)
+  """
+  weights = torch.ones(batch_size, device=data.device)
+  missing = batch_size - data.shape[0]
+  if missing > 0:
+    data = torch.cat([data, data.new_zeros((missing,) + data.shape[1:])])
+    target = torch.cat([target, target.new_zeros(missing)])
+    weights[-missing:] = 0.
+  return data, target, weights
+
+
+class VectorizedTrainer(object):
+  """
+  Trains K clients of the same model in lock step
+
+  model : Model skeleton, its trainable parameters are replaced by the stacked
+          client weights at every call, its masks and buffers are shared
+  lr : Learning rate of the clients
+  momentum, weight_decay, nesterov : SGD hyperparameters, same meaning as in torch.optim.SGD
+
+  Models with batch norm are not supported, their running statistics would be
+  updated in place by every client at once.
+  """
+
+  def __init__(self, model, lr, momentum=0., weight_decay=0., nesterov=False):
+    if any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules()):
+      raise ValueError('Vectorized training does not support batch norm layers')
+    if nesterov and not momentum:
+      raise ValueError('Nesterov momentum requires a momentum')
+    self.model = model
+    self.lr = lr
+    self.momentum = momentum
+    self.weight_decay = weight_decay
+    self.nesterov = nesterov
+    self.names = [name for name, p in model.named_parameters() if p.requires_grad]
+    self.shapes = [p.shape for name, p in model.named_parameters() if p.requires_grad]
+    self.sizes = [int(torch.Size(shape).numel()) for shape in self.shapes]
+    self.batched_step = vmap(grad_and_value(self._loss, has_aux=True),
+                             in_dims=(0, 0, 0, 0), randomness='different')
+
+  def _views(self, flat):
+    return {name: view.view(shape) for name, view, shape in
+            zip(self.names, torch.split(flat, self.sizes), self.shapes)}
+
+  def _loss(self, flat, data, target, weights):
+    output = functional_call(self.model, self._views(flat), (data,))
+    losses = F.cross_entropy(output, target, reduction='none')
+    loss = (losses * weights).sum() / weights.sum().clamp(min=1.)
+    correct = ((output.argmax(dim=1) == target).float() * weights).sum()
+    return loss, correct
+
+  def _direction(self, weights, grads, buffers):
+    """
+    Step direction of torch.optim.SGD without dampening
+    :param weights: Stacked weights of the stepping clients
+    :param grads: Their gradients
+    :param buffers: Their momentum buffers, updated in place, None without momentum
+    :return: Direction the weights move against, scaled by lr
+    """
+    if self.weight_decay:
+      grads = grads.add(weights, alpha=self.weight_decay)
+    if buffers is None:
+      return grads
+    # A zero buffer makes the first step the plain gradient, as torch's first step
+    buffers.mul_(self.momentum).add_(grads)
+    return grads.add(buffers, alpha=self.momentum) if self.nesterov else buffers
+
+  def train(self, global_weights, loaders, local_epochs=1, momentum_buffers=None):
+    """
+    Trains one client per loader, all starting from the global model
+    :param global_weights: Flat global model weights
+    :param loaders: One iterable of (data, target) batches per client
+    :param local_epochs: Passes every client makes over its loader
+    :param momentum_buffers: Optional [K, numel] momentum buffers the clients
+    carry over from earlier rounds, updated in place. Zero buffers if None
+    :return: (per client updates [K, numel], per client number of correct predictions)
+    """
+    num_clients = len(loaders)
+    stacked = global_weights.detach().reshape(1, -1).repeat(num_clients, 1)
+    updates = torch.zeros_like(stacked)
+    if self.momentum and momentum_buffers is None:
+      momentum_buffers = torch.zeros_like(stacked)
+    if not self.momentum:
+      momentum_buffers = None
+    correct = torch.zeros(num_clients)
+    self.model.train()
+    for _ in range(local_epochs):
+      iterators = [iter(loader) for loader in loaders]
+      while True:
+        batches = [next(iterator, None) for iterator in iterators]
+        active = torch.tensor([batch is not None for batch in batches])
+        if not active.any():
+          break
+        batch_size = max(batch[0].shape[0] for batch in batches if batch is not None)
+        reference = next(batch for batch in batches if batch is not None)
+        padded = [_padded(*(batch if batch is not None else
+                            (reference[0][:0], reference[1][:0])), batch_size) for batch in batches]
+        data, target, weights = (torch.stack(column) for column in zip(*padded))
+        grads, (_, step_correct) = self.batched_step(stacked, data, target, weights)
+        grads = grads.detach()
+        if active.all():
+          updates.mul_(0.3).add_(grads, alpha=0.7)
+          stacked.sub_(self._direction(stacked, grads, momentum_buffers), alpha=self.lr)
+        else:
+          # Clients without a batch this step keep their weights, update and momentum
+          rows = active.nonzero().reshape(-1)
+          updates[rows] = updates[rows].mul_(0.3).add_(grads[rows], alpha=0.7)
+          weights = stacked[rows]
+          buffers = None if momentum_buffers is None else momentum_buffers[rows]
+          stacked[rows] = weights.sub_(self._direction(weights, grads[rows], buffers), alpha=self.lr)
+          if buffers is not None:
+            momentum_buffers[rows] = buffers
+        correct += step_correct.detach() * active
+    return updates, correct.long().tolist()
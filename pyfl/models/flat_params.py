@@ -0,0 +1,139 @@
+"""
+Flat contiguous parameter buffers for pyfl.models networks.
+
+FlatParameters packs every trainable weight of a model into one contiguous
+tensor and rebinds each parameter to a view of it, so the module keeps working
+unchanged while the whole model can be read, written, averaged or sent as a
+single tensor. Gradients and the masks of MaskedConv/MaskedDense layers get
+their own flat buffers with the same treatment.
+"""
+import torch
+
+
+def _pack(tensors):
+  """
+  Copies the tensors into one flat buffer
+  :param tensors: List of tensors sharing a dtype and a device
+  :return: (flat buffer, list of views into it shaped like the tensors)
+  """
+  if not tensors:
+    return torch.zeros(0), []
+  flat = torch.cat([t.detach().reshape(-1) for t in tensors])
+  return flat, _unpack(flat, [t.shape for t in tensors])
+
+
+def _unpack(flat, shapes):
+  sizes = [int(torch.Size(shape).numel()) for shape in shapes]
+  return [view.view(shape) for view, shape in zip(torch.split(flat, sizes), shapes)]
+
+
+class FlatParameters(object):
+  """
+  Flat views over the weights, gradients and masks of a model
+
+  weights : Flat tensor holding every trainable parameter, in model.parameters() order
+  grads : Flat tensor the parameter gradients accumulate into, same layout as weights
+  masks : Flat tensor holding the mask of every masked layer, in model.modules() order
+
+  The parameters of the model are rebound to views of these buffers, any in-place
+  op on a buffer is seen by the model and vice versa.
+  """
+
+  def __init__(self, model):
+    self.model = model
+    self.params = [p for p in model.parameters() if p.requires_grad]
+    self.shapes = [p.shape for p in self.params]
+    self.weights, weight_views = _pack(self.params)
+    for param, view in zip(self.params, weight_views):
+      param.data = view
+
+    self.grads = torch.zeros_like(self.weights)
+    self.grad_views = _unpack(self.grads, self.shapes)
+    self.zero_grad()
+
+    self.masked_layers = [m for m in model.modules() if hasattr(m, 'mask')]
+    self.masks, mask_views = _pack([m.mask for m in self.masked_layers])
+    for layer, view in zip(self.masked_layers, mask_views):
+      layer.mask.data = view
+
+  def numel(self):
+    return self.weights.numel()
+
+  def views(self, flat):
+    """
+    Splits a flat tensor with the weights layout into per-parameter views
+    :param flat: Flat tensor, e.g. weights, grads or an update
+    :return: List of views shaped like the model parameters
+    """
+    return _unpack(flat, self.shapes)
+
+  def zero_grad(self):
+    """
+    Zeroes the flat gradient buffer and (re)binds every param.grad to its view,
+    optimizers that set the gradients to None would otherwise detach them
+    """
+    self.grads.zero_()
+    for param, view in zip(self.params, self.grad_views):
+      param.grad = view
+
+  def set_flat_weights(self, weights):
+    """
+    Overwrites the model weights with a single copy
+    :param weights: Flat tensor with the weights layout
+    :return: None
+    """
+    if weights.numel() != self.weights.numel():
+      raise ValueError('Expected {} flat weights, got {}'.format(self.weights.numel(), weights.numel()))
+    with torch.no_grad():
+      self.weights.copy_(weights.reshape(-1))
+
+  def set_weights(self, weights):
+    """
+    Overwrites the model weights, one tensor per parameter
+    :param weights: List of tensors in model.parameters() order
+    :return: None
+    """
+    if len(weights) != len(self.params):
+      raise ValueError('Expected {} weight tensors, got {}'.format(len(self.params), len(weights)))
+    with torch.no_grad():
+      for view, weight in zip(self.views(self.weights), weights):
+        view.copy_(weight)
+
+  def set_masks(self, masks):
+    """
+    Overwrites the masks of the masked layers with a single copy
+    :param masks: Flat tensor with the masks layout
+    :return: None
+    """
+    with torch.no_grad():
+      self.masks.copy_(masks.reshape(-1))
+
+  def weight_mask(self):
+    """
+    Builds a boolean mask aligned with the flat weights. Weights of the masked
+    layers follow their mask, every other parameter is always active
+    :return: Flat bool tensor of the weights size
+    """
+    active = torch.ones(self.weights.numel(), dtype=torch.bool, device=self.weights.device)
+    for start, layer in self._masked_weight_offsets():
+      active[start:start + layer.weight.numel()] = layer.mask.reshape(-1) != 0
+    return active
+
+  def set_weight_mask(self, active):
+    """
+    Writes a weights aligned boolean mask back into the masks of the masked layers
+    :param active: Flat bool tensor of the weights size
+    :return: None
+    """
+    with torch.no_grad():
+      for start, layer in self._masked_weight_offsets():
+        layer.mask.copy_(active[start:start + layer.weight.numel()].view_as(layer.mask))
+
+  def _masked_weight_offsets(self):
+    offsets = {}
+    offset = 0
+    for param in self.params:
+      offsets[id(param)] = offset
+      offset += param.numel()
+    return [(offsets[id(layer.weight)], layer) for layer in self.masked_layers
+            if id(layer.weight) in offsets]
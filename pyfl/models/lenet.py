@@ -5,14 +5,14 @@ import torch.nn.functional as F
 
 
 class SimpleConvNet(nn.Module):
-  def __init__(self):
+  def __init__(self, num_classes=10):
     super(SimpleConvNet, self).__init__()
     self.conv1 = nn.Conv2d(1, 32, 3, 1)
     self.conv2 = nn.Conv2d(32, 64, 3, 1)
     self.dropout1 = nn.Dropout2d(0.25)
     self.dropout2 = nn.Dropout2d(0.5)
     self.fc1 = nn.Linear(9216, 128)
-    self.fc2 = nn.Linear(128, 10)
+    self.fc2 = nn.Linear(128, num_classes)
 
   def forward(self, x):
     x = self.conv1(x)
@@ -35,13 +35,13 @@ class SimpleConvNet(nn.Module):
 class LeNet(nn.Module):
 
   # network structure
-  def __init__(self):
+  def __init__(self, num_classes=10):
     super(LeNet, self).__init__()
     self.conv1 = nn.Conv2d(1, 6, 5, padding=2)
     self.conv2 = nn.Conv2d(6, 16, 5)
     self.fc1 = nn.Linear(16 * 5 * 5, 120)
     self.fc2 = nn.Linear(120, 84)
-    self.fc3 = nn.Linear(84, 10)
+    self.fc3 = nn.Linear(84, num_classes)
 
   def forward(self, x):
     '''
@@ -0,0 +1,84 @@
+"""
+Model and optimizer registry.
+
+Architectures are registered by name with the module that defines them, the
+module is only imported the first time the architecture is built. The first
+build of an (architecture, num_classes) pair keeps the initialized model as a
+template, later builds deep copy it, which skips re-running the layer
+initializers. Every model built from the same template starts with the same
+weights, as the devices of a federated task do anyway once they sync with the
+server.
+"""
+import copy
+import importlib
+
+import torch
+
+# name -> (module, factory), every factory takes num_classes
+MODELS = {
+  'simplenet': ('pyfl.models.lenet', 'SimpleConvNet'),
+  'lenet': ('pyfl.models.lenet', 'LeNet'),
+  'vgg11': ('pyfl.models.vgg', 'vgg11'),
+  'vgg11_bn': ('pyfl.models.vgg', 'vgg11_bn'),
+  'vgg13': ('pyfl.models.vgg', 'vgg13'),
+  'vgg16': ('pyfl.models.vgg', 'vgg16'),
+  'resnet20': ('pyfl.models.resnet', 'resnet20'),
+  'resnet32': ('pyfl.models.resnet', 'resnet32'),
+  'resnet56': ('pyfl.models.resnet', 'resnet56'),
+}
+
+# name -> (torch.optim class name, lr_params keys passed on to it)
+OPTIMIZERS = {
+  'sgd': ('SGD', ('momentum', 'weight_decay', 'nesterov')),
+  'adam': ('Adam', ('weight_decay',)),
+}
+
+_templates = {}
+
+
+def register_model(name, module, factory):
+  """
+  Makes an architecture buildable by name
+  :param name: Name used in the task config
+  :param module: Import path of the module defining the architecture
+  :param factory: Name of the class or function in the module, called with num_classes
+  :return: None
+  """
+  MODELS[name] = (module, factory)
+  for key in [key for key in _templates if key[0] == name]:
+    del _templates[key]
+
+
+def build_model(name, num_classes=10):
+  """
+  :param name: Registered architecture name
+  :param num_classes: Number of outputs
+  :return: A new model, a copy of the cached template of the architecture
+  """
+  if name not in MODELS:
+    raise NotImplementedError("Model not supported")
+  key = (name, num_classes)
+  if key not in _templates:
+    module, factory = MODELS[name]
+    _templates[key] = getattr(importlib.import_module(module), factory)(num_classes)
+  return copy.deepcopy(_templates[key])
+
+
+def build_optimizer(name, params, lr_params=None):
+  """
+  :param name: Registered optimizer name
+  :param params: Parameters to optimize
+  :param lr_params: Dict with initial_lr (default 0.01) and optionally the
+  optimizer's own hyperparameters, e.g. momentum and weight_decay
+  :return: torch.optim.Optimizer
+  """
+  if name not in OPTIMIZERS:
+    raise NotImplementedError("Optimizer not implemented")
+  lr_params = lr_params or {}
+  optim_class, keys = OPTIMIZERS[name]
+  kwargs = {key: lr_params[key] for key in keys if key in lr_params}
+  return getattr(torch.optim, optim_class)(params, lr=lr_params.get('initial_lr', 0.01), **kwargs)
+
+
+def clear_templates():
+  _templates.clear()
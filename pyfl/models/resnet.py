@@ -134,4 +134,4 @@ def resnet110(num_classes):
 
 
 def resnet1202(num_classes):
-  return ResNet(BasicBlock, [200, 200, 200], num_clases=num_classes)
+  return ResNet(BasicBlock, [200, 200, 200], num_classes=num_classes)
@@ -1,4 +1,15 @@
 from abc import ABC
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.multiprocessing as mp
+
+from pyfl.communication.compression import CompressedUpdate, add_to
+from pyfl.communication.masked import MaskedDecoder, MaskedWeights
+from pyfl.communication.message_definitions import DeviceServerSendClass
+from pyfl.utils import get_logger
+
+logger = get_logger(__name__)
 
 
 class MasterAggregatorBase(ABC):
@@ -64,11 +75,316 @@ class AggregatorBase(ABC):
     raise NotImplementedError('Sync devices connected to this aggregator')
 
 
+def flatten_update(update):
+  """
+  Returns an update as one flat tensor
+  :param update: Flat tensor, list of tensors, CompressedUpdate or MaskedWeights
+  :return: Flat tensor, compressed and masked updates are returned as they are
+  """
+  if isinstance(update, (CompressedUpdate, MaskedWeights)):
+    return update
+  if torch.is_tensor(update):
+    return update.reshape(-1)
+  return torch.cat([u.reshape(-1) for u in update])
+
+
+class WeightedAccumulator(object):
+  """
+  Running weighted sum of flat updates.
+  Updates are folded in as soon as they arrive, so only one model sized
+  buffer is kept no matter how many updates are reduced.
+  """
+
+  def __init__(self):
+    self.total = None
+    self.weight = 0
+    self.count = 0
+
+  def add(self, update, weight):
+    """
+    Fold weight * update into the running sum
+    :param update: Flat tensor, list of tensors, CompressedUpdate or resolved MaskedWeights
+    :param weight: Scalar weight of the update (number of samples for FedAvg)
+    :return: None
+    """
+    update = flatten_update(update)
+    if isinstance(update, MaskedWeights):
+      # Only the active entries are aggregated
+      if update.indices is None:
+        raise ValueError('Masked update must be resolved by a MaskedDecoder first')
+      if self.total is None:
+        self.total = torch.zeros(update.numel, dtype=update.values.dtype)
+      self.total.index_add_(0, update.indices, update.values * weight)
+    elif isinstance(update, CompressedUpdate):
+      # Decompress straight into the running sum, sparse updates only touch the sent entries
+      if self.total is None:
+        self.total = torch.zeros(update.numel)
+      add_to(self.total, update, weight)
+    elif self.total is None:
+      self.total = torch.mul(update, weight)
+    else:
+      self.total.add_(update, alpha=weight)
+    self.weight += weight
+    self.count += 1
+
+  def merge(self, total, weight, count=1):
+    """
+    Fold an already weighted partial sum into the running sum
+    :param total: Weighted sum of updates
+    :param weight: Sum of the weights of those updates
+    :param count: Number of updates in the partial sum
+    :return: None
+    """
+    if total is None:
+      return
+    if self.total is None:
+      self.total = total.clone()
+    else:
+      self.total.add_(total)
+    self.weight += weight
+    self.count += count
+
+  def average(self):
+    """
+    :return: Weighted average of everything folded in so far, None if empty
+    """
+    if self.total is None or self.weight == 0:
+      return None
+    return self.total / self.weight
+
+  def reset(self):
+    self.total = None
+    self.weight = 0
+    self.count = 0
+
+
 class Aggregator(AggregatorBase):
+  """
+  Aggregator
+
+  What is aggregator config ? A dict with the following params:
+  aggregator_id : A unique identifier for each aggregator
+  device_ids : Devices whose updates this aggregator reduces
+
+  Every update is folded into a running sum weighted by the number of samples
+  the device trained on, the weighted partial sum is then sent to the master.
+  """
+
   def __init__(self, config):
     self.config = config
+    self.accumulator = WeightedAccumulator()
+    self.mask_decoder = MaskedDecoder()
+
+  def accumulate(self, update, num_samples):
+    """
+    Fold one device update into the running sum
+    :param update: Flat update tensor (or list of tensors)
+    :param num_samples: Number of samples the device trained on
+    :return: None
+    """
+    self.accumulator.add(update, num_samples)
+
+  def sync_devices(self, messages):
+    """
+    Fold the gradient updates found in the given device messages
+    :param messages: List of Message objects received from the devices
+    :return: Number of updates folded
+    """
+    num_updates = 0
+    for message in messages:
+      if not (isinstance(message.message_class, DeviceServerSendClass) and
+              message.message_type == DeviceServerSendClass.D2S_SEND_GRADIENT_UPDATES):
+        continue
+      update = message.message['update']
+      if isinstance(update, MaskedWeights):
+        self.mask_decoder.resolve(update, message.sender_id)
+      self.accumulate(update, message.message['num_samples'])
+      num_updates += 1
+    logger.debug('Aggregator {} folded {} updates'.format(self.config['aggregator_id'], num_updates))
+    return num_updates
+
+  def ping_master(self):
+    """
+    Hands the weighted partial sum over to the master and starts a new one
+    :return: (weighted sum of updates, sum of weights, number of updates)
+    """
+    partial = (self.accumulator.total, self.accumulator.weight, self.accumulator.count)
+    self.accumulator = WeightedAccumulator()
+    return partial
 
 
 class MasterAggregator(MasterAggregatorBase):
+  """
+  Master aggregator
+
+  What is master aggregator config ? A dict with the following params:
+  master_aggregator_id : A unique identifier for each master aggregator
+
+  Reduces the partial sums of the aggregators into the FedAvg average.
+  """
+
   def __init__(self, config):
     self.config = config
+    self.accumulator = WeightedAccumulator()
+
+  def sync_aggregator(self, partial_sums):
+    """
+    Fold the partial sums of the aggregators into the global sum
+    :param partial_sums: List of (weighted sum, sum of weights, number of updates)
+    :return: None
+    """
+    for total, weight, count in partial_sums:
+      self.accumulator.merge(total, weight, count)
+
+  def aggregate(self):
+    """
+    Returns the sample weighted average of every update of the round and resets
+    the master for the next round
+    :return: Flat averaged update, None if no update was received
+    """
+    average = self.accumulator.average()
+    logger.info('Averaged {} updates over {} samples'.format(self.accumulator.count, self.accumulator.weight))
+    self.accumulator.reset()
+    return average
+
+
+def staleness_discount(staleness, exponent=0.5):
+  """
+  Polynomial staleness discount of asynchronous updates, 1 / (1 + staleness) ** exponent
+  :param staleness: Number of model versions published since the update's base version
+  :param exponent: How fast stale updates lose weight, 0 disables the discount
+  :return: float
+  """
+  return (1. + max(staleness, 0)) ** -exponent
+
+
+class BufferedAggregator(MasterAggregatorBase):
+  """
+  Buffered asynchronous (FedBuff) master aggregator
+
+  What is buffered aggregator config ? A dict with the following params:
+  master_aggregator_id : A unique identifier for each master aggregator
+  buffer_size : Number of updates buffered before the global model moves on
+  staleness_exponent : Exponent of the staleness discount
+
+  Updates arrive tagged with the model version they were trained from. Each one
+  is discounted by its staleness and buffered, once buffer_size updates are in
+  the buffer is averaged and the model version is bumped. The average is taken
+  over the undiscounted sample counts, so stale updates move the model less.
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self.version = 0
+    self.accumulator = WeightedAccumulator()
+    self.num_samples = 0
+    self.staleness = []
+
+  def add(self, total, weight, count=1, version=0):
+    """
+    Buffers a (partial) weighted sum of updates trained from one model version
+    :param total: Weighted sum of updates, as returned by Aggregator.ping_master
+    :param weight: Sum of the weights of those updates
+    :param count: Number of updates in the sum
+    :param version: Model version the updates were trained from
+    :return: True once the buffer is full
+    """
+    staleness = self.version - version
+    discount = staleness_discount(staleness, self.config.get('staleness_exponent', 0.5))
+    if total is not None:
+      self.accumulator.merge(total * discount, weight * discount, count)
+      self.num_samples += weight
+      self.staleness.extend([staleness] * count)
+    return self.accumulator.count >= self.config['buffer_size']
+
+  def aggregate(self):
+    """
+    Empties the buffer and bumps the model version
+    :return: Flat buffered update, None if the buffer is empty
+    """
+    if self.accumulator.total is None or self.num_samples == 0:
+      return None
+    update = self.accumulator.total / self.num_samples
+    logger.info('Version {}: applied {} updates, mean staleness {:.2f}'.format(
+      self.version + 1, self.accumulator.count, sum(self.staleness) / len(self.staleness)))
+    self.accumulator.reset()
+    self.num_samples = 0
+    self.staleness = []
+    self.version += 1
+    return update
+
+
+def reduce_shard(aggregator_config, updates):
+  """
+  Aggregator worker entry point, reduces the updates of the devices the
+  aggregator owns into one weighted partial sum
+  :param aggregator_config: Config dict of the aggregator
+  :param updates: List of (update, num_samples) tuples
+  :return: (weighted sum of updates, sum of weights, number of updates)
+  """
+  aggregator = Aggregator(aggregator_config)
+  for update, num_samples in updates:
+    aggregator.accumulate(update, num_samples)
+  return aggregator.ping_master()
+
+
+class AggregatorPool(object):
+  """
+  Runs the aggregators as worker processes
+
+  Each aggregator owns the devices listed in its config, or the devices of its
+  shard when a ShardMap is given, see pyfl.server.sharding. A round's updates are
+  split by owner, every aggregator reduces its shard in its own process and the
+  master aggregator reduces the partial sums. Tensors travel to and from the
+  workers through torch's shared-memory pickling: the decoded updates are plain
+  tensors, so submitting a shard first copies each of them into shared memory,
+  then only its handle crosses the process boundary. The partial sums come back
+  the same way.
+  """
+
+  def __init__(self, aggregator_configs, master_aggregator, shard_map=None):
+    self.aggregator_configs = aggregator_configs
+    self.master_aggregator = master_aggregator
+    self.shard_map = shard_map
+    self.owner = {}
+    self.mask_decoder = MaskedDecoder()
+    for i, config in enumerate(aggregator_configs):
+      for device_id in config['device_ids']:
+        self.owner[device_id] = i
+    self.executor = ProcessPoolExecutor(max_workers=len(aggregator_configs),
+                                        mp_context=mp.get_context('spawn'))
+
+  def assign(self, device_id):
+    """
+    Returns the aggregator owning a device, devices that were not assigned
+    up front are spread round robin, or placed by the shard map
+    :param device_id: Device ID
+    :return: Index of the aggregator
+    """
+    if self.shard_map is not None:
+      if self.shard_map.shard_of(device_id) is None:
+        self.shard_map.add(device_id)
+      return self.shard_map.shard_of(device_id)
+    if device_id not in self.owner:
+      self.owner[device_id] = len(self.owner) % len(self.aggregator_configs)
+    return self.owner[device_id]
+
+  def reduce(self, updates):
+    """
+    Reduces one round of updates in parallel
+    :param updates: dict of device_id -> (update, num_samples)
+    :return: Flat averaged update, None if there were no updates
+    """
+    shards = [[] for _ in self.aggregator_configs]
+    for device_id, update in updates.items():
+      # Masks are cached here, the workers get the resolved active positions
+      if isinstance(update[0], MaskedWeights):
+        self.mask_decoder.resolve(update[0], device_id)
+      shards[self.assign(device_id)].append(update)
+    futures = [self.executor.submit(reduce_shard, config, shard)
+               for config, shard in zip(self.aggregator_configs, shards) if shard]
+    self.master_aggregator.sync_aggregator([future.result() for future in futures])
+    return self.master_aggregator.aggregate()
+
+  def shutdown(self):
+    self.executor.shutdown()
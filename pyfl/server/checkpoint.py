@@ -0,0 +1,194 @@
+"""
+Asynchronous, incremental checkpoints of the server state.
+
+A checkpoint is a directory holding every tensor as chunked .npy files, which
+np.load can memory map, and a state.json with the round state and the layout
+of the tensors. Checkpoints are written by a background thread, the caller only
+pays for a copy of the tensors. A chunk equal to the same chunk of the previous
+checkpoint is hard linked instead of written again. Every checkpoint is written
+in a temporary directory and renamed into place once complete, so a crash
+mid-write leaves the previous checkpoints intact. A failed checkpoint is
+logged and does not stop the caller, the error is raised by close.
+"""
+import json
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+from pyfl.utils import get_logger
+
+logger = get_logger(__name__)
+
+PREFIX = 'checkpoint-'
+STATE_FILE = 'state.json'
+CHUNK_BYTES = 1 << 22
+
+
+def _fsync_dir(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def _chunk_name(name, index):
+  return '{}.{:05d}.npy'.format(name, index)
+
+
+class Checkpointer(object):
+  """
+  Checkpoint writer
+
+  What is checkpointer config ? A dict with the following params:
+  directory : Directory the checkpoints are written in
+  keep : Optional, number of checkpoints kept, older ones are deleted (default 3)
+  chunk_bytes : Optional, size of the .npy chunks the tensors are split in (default 4 MB)
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self.directory = config['directory']
+    os.makedirs(self.directory, exist_ok=True)
+    self.queue = queue.Queue()
+    # Path and chunks of the last checkpoint written, unchanged chunks are linked to it
+    self.previous = None
+    self.error = None
+    self.thread = threading.Thread(target=self.__run, daemon=True)
+    self.thread.start()
+
+  def save(self, step, tensors, state):
+    """
+    Queues a checkpoint, returns as soon as the tensors are copied
+    :param step: Number of the checkpoint, usually the round
+    :param tensors: Dict name -> tensor
+    :param state: JSON serializable dict
+    :return: None
+    """
+    arrays = {name: tensor.detach().cpu().numpy().copy() for name, tensor in tensors.items()}
+    self.queue.put((step, arrays, state))
+
+  def wait(self):
+    """
+    Blocks until every queued checkpoint is written or failed
+    :return: None
+    """
+    self.queue.join()
+
+  def close(self):
+    """
+    Writes the queued checkpoints and stops the writer thread
+    :return: None
+    :raises: The error of the last checkpoint that failed, if any
+    """
+    self.wait()
+    self.queue.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def __run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        self.__write(*item)
+      except Exception as e:
+        logger.error('Checkpoint {} failed: {}'.format(item[0], e))
+        self.error = e
+      finally:
+        self.queue.task_done()
+
+  def __write(self, step, arrays, state):
+    path = os.path.join(self.directory, '{}{:08d}'.format(PREFIX, step))
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    chunks, layout, linked = {}, {}, 0
+    for name, array in arrays.items():
+      flat = array.reshape(-1)
+      size = max(self.config.get('chunk_bytes', CHUNK_BYTES) // flat.itemsize, 1)
+      pieces = [flat[start:start + size] for start in range(0, flat.size, size)] or [flat]
+      for index, piece in enumerate(pieces):
+        if self.__link_unchanged(name, index, piece, tmp):
+          linked += 1
+          continue
+        with open(os.path.join(tmp, _chunk_name(name, index)), 'wb') as f:
+          np.save(f, piece)
+          f.flush()
+          os.fsync(f.fileno())
+      chunks[name] = pieces
+      layout[name] = {'shape': list(array.shape), 'dtype': str(array.dtype), 'chunks': len(pieces)}
+    with open(os.path.join(tmp, STATE_FILE), 'w') as f:
+      json.dump({'step': step, 'state': state, 'tensors': layout}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+    _fsync_dir(self.directory)
+    self.previous = (path, chunks)
+    logger.info('Checkpoint {} written to {}, {} unchanged chunks linked'.format(step, path, linked))
+    self.__prune()
+
+  def __link_unchanged(self, name, index, piece, tmp):
+    if self.previous is None:
+      return False
+    path, chunks = self.previous
+    previous = chunks.get(name)
+    if previous is None or index >= len(previous) or previous[index].dtype != piece.dtype or \
+        not np.array_equal(previous[index], piece):
+      return False
+    try:
+      os.link(os.path.join(path, _chunk_name(name, index)), os.path.join(tmp, _chunk_name(name, index)))
+    except OSError:
+      return False
+    return True
+
+  def __prune(self):
+    for path in list_checkpoints(self.directory)[:-self.config.get('keep', 3)]:
+      shutil.rmtree(path, ignore_errors=True)
+
+
+def list_checkpoints(directory):
+  """
+  :param directory: Checkpoint directory
+  :return: Paths of the complete checkpoints, oldest first
+  """
+  if not os.path.isdir(directory):
+    return []
+  names = sorted(name for name in os.listdir(directory)
+                 if name.startswith(PREFIX) and not name.endswith('.tmp'))
+  return [os.path.join(directory, name) for name in names]
+
+
+def latest_checkpoint(directory):
+  """
+  :param directory: Checkpoint directory
+  :return: Path of the newest complete checkpoint, None if there is none
+  """
+  checkpoints = list_checkpoints(directory)
+  return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path):
+  """
+  Reads a checkpoint, the chunks are memory mapped and copied once into the tensors
+  :param path: Checkpoint path
+  :return: (step, dict name -> tensor, state)
+  """
+  with open(os.path.join(path, STATE_FILE)) as f:
+    meta = json.load(f)
+  tensors = {}
+  for name, layout in meta['tensors'].items():
+    # Empty arrays can't be memory mapped
+    mmap_mode = 'r' if np.prod(layout['shape']) else None
+    pieces = [np.load(os.path.join(path, _chunk_name(name, index)), mmap_mode=mmap_mode)
+              for index in range(layout['chunks'])]
+    array = np.concatenate(pieces) if len(pieces) > 1 else np.array(pieces[0])
+    tensors[name] = torch.from_numpy(array.reshape(layout['shape']))
+  return meta['step'], tensors, meta['state']
@@ -0,0 +1,52 @@
+"""
+Server side metrics of a FL task.
+"""
+import time
+
+import torch
+
+
+def evaluate(model, loader):
+  """
+  Accuracy of a model on a test loader
+  :param model: Model to evaluate
+  :param loader: Iterable of (data, target) batches
+  :return: Fraction of correctly classified samples
+  """
+  model.eval()
+  correct = 0
+  total = 0
+  with torch.no_grad():
+    for data, target in loader:
+      correct += (model(data).argmax(dim=1) == target).sum().item()
+      total += target.shape[0]
+  model.train()
+  return correct / max(total, 1)
+
+
+class AccuracyTimeline(object):
+  """
+  Test accuracy of the global model against wall clock time
+
+  points : List of (seconds since start, model version, accuracy)
+  """
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.points = []
+
+  def record(self, version, accuracy):
+    self.points.append((time.perf_counter() - self.start, version, accuracy))
+
+  def time_to_accuracy(self, target):
+    """
+    :param target: Accuracy to reach
+    :return: Seconds until the global model first reached target, None if it never did
+    """
+    for seconds, _, accuracy in self.points:
+      if accuracy >= target:
+        return seconds
+    return None
+
+  def best(self):
+    return max((accuracy for _, _, accuracy in self.points), default=0.)
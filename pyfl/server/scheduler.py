@@ -0,0 +1,138 @@
+"""
+Deadline driven round scheduling.
+
+A round selects more devices than it needs to make up for the expected
+dropouts, and closes as soon as a quorum of updates is in or its deadline
+passes, whichever comes first. Liveness probes are sent on a timer wheel and
+every message from a device counts as a sign of life, so devices that died
+mid-round stop being waited for.
+"""
+import math
+
+# Slack for the float error of time / tick on tick boundaries
+EPSILON = 1e-9
+
+
+class TimerWheel(object):
+  """
+  Hashed timer wheel
+
+  tick : Resolution of the wheel in seconds
+  num_slots : Number of buckets, timers further than num_slots ticks away
+              stay in their bucket for several turns of the wheel
+
+  Timers are bucketed by the tick they expire on, scheduling, rescheduling and
+  cancelling are O(1) no matter how many timers are pending. Rescheduling a key
+  replaces its previous timer.
+  """
+
+  def __init__(self, tick=0.1, num_slots=512, now=0.):
+    self.tick = tick
+    self.slots = [[] for _ in range(num_slots)]
+    self.current_tick = int(now / tick + EPSILON)
+    self.timers = {}
+
+  def schedule(self, key, delay, now):
+    expiry = max(int(math.ceil((now + delay) / self.tick - EPSILON)), self.current_tick)
+    self.timers[key] = expiry
+    self.slots[expiry % len(self.slots)].append((expiry, key))
+
+  def cancel(self, key):
+    self.timers.pop(key, None)
+
+  def advance(self, now):
+    """
+    Turns the wheel up to now
+    :param now: Current time
+    :return: Keys of the timers that expired
+    """
+    target = int(now / self.tick + EPSILON)
+    expired = []
+    # One turn of the wheel visits every bucket
+    last = min(target, self.current_tick + len(self.slots) - 1)
+    for tick in range(self.current_tick, last + 1):
+      slot = self.slots[tick % len(self.slots)]
+      keep = []
+      for expiry, key in slot:
+        if self.timers.get(key) != expiry:
+          continue
+        if expiry <= target:
+          del self.timers[key]
+          expired.append(key)
+        else:
+          keep.append((expiry, key))
+      slot[:] = keep
+    self.current_tick = target + 1
+    return expired
+
+  def __len__(self):
+    return len(self.timers)
+
+
+class LivenessTracker(object):
+  """
+  Last time every device was seen
+
+  timeout : Seconds of silence after which a device is considered dead
+  """
+
+  def __init__(self, timeout):
+    self.timeout = timeout
+    self.last_seen = {}
+
+  def seen(self, device_id, now):
+    self.last_seen[device_id] = now
+
+  def is_alive(self, device_id, now):
+    last_seen = self.last_seen.get(device_id)
+    return last_seen is not None and now - last_seen <= self.timeout
+
+  def forget(self, device_id):
+    self.last_seen.pop(device_id, None)
+
+
+class RoundScheduler(object):
+  """
+  Sizes and closes the rounds
+
+  What is round scheduler config ? A dict with the following params:
+  clients_per_round : Number of updates a round aims for
+  quorum : Fraction of clients_per_round that closes a round early
+  deadline : Seconds after which a round closes with the updates it has
+  expected_dropout : Initial estimate of the fraction of selected devices that never report
+
+  The dropout estimate follows the rounds, as a running average of the
+  fraction of selected devices that died or missed the deadline.
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self.dropout = config.get('expected_dropout', 0.)
+
+  def num_to_select(self, num_available):
+    """
+    :param num_available: Number of devices that can be selected
+    :return: Number of devices to select, clients_per_round inflated by the expected dropouts.
+    Without clients_per_round every available device, at least one
+    """
+    target = self.config.get('clients_per_round') or num_available or 1
+    wanted = int(math.ceil(target / max(1. - self.dropout, 0.05)))
+    return max(min(wanted, num_available), 1) if num_available else wanted
+
+  def quorum(self, num_selected):
+    """
+    :param num_selected: Number of devices selected for the round
+    :return: Number of updates that closes the round
+    """
+    target = self.config.get('clients_per_round') or num_selected
+    return max(min(int(math.ceil(self.config.get('quorum', 1.) * target)), num_selected), 1)
+
+  def end_round(self, num_selected, num_dropped):
+    """
+    Updates the dropout estimate with the outcome of a round
+    :param num_selected: Number of devices selected
+    :param num_dropped: Number of selected devices that died or missed the deadline
+    :return: None
+    """
+    if num_selected:
+      self.dropout = 0.7 * self.dropout + 0.3 * num_dropped / num_selected
@@ -0,0 +1,276 @@
+"""
+Device selection policies over an array based device table.
+
+The DeviceTable keeps one row per registered device in numpy columns
+(availability, stratum, last reported training loss, running average of the
+round time, participation count), so that a policy picks K devices out of
+the available ones with a handful of vectorized operations whatever the
+number of registered devices.
+
+Policies:
+uniform : K available devices uniformly at random
+stratified : K devices spread over the strata in proportion to their number of
+             available devices, uniformly within every stratum
+power_of_choice : d * K candidates uniformly at random, the K with the
+                  highest training loss among them, devices with no reported
+                  loss first
+latency : K devices sampled without replacement with probability proportional
+          to round_time ** -alpha, devices with no measured round time get the
+          median one
+"""
+import numpy as np
+
+
+class DeviceTable(object):
+  """
+  Columns of per-device statistics, one row per registered device
+
+  ids : Device id of every row
+  available : The device is ready and not selected
+  stratum : Stratum of the device, a small non-negative int, e.g. a data or
+            hardware class (default 0)
+  loss : Last training loss reported, nan if never reported
+  latency : Running average of the round time, nan if never measured
+  participations : Number of rounds the device was selected for
+  """
+  COLUMNS = (('ids', np.int64, 0), ('available', np.bool_, False), ('stratum', np.int32, 0),
+             ('loss', np.float32, np.nan), ('latency', np.float32, np.nan), ('participations', np.int32, 0))
+
+  def __init__(self, capacity=1024, smoothing=0.3):
+    self.size = 0
+    self.smoothing = smoothing
+    self.rows = {}
+    for name, dtype, fill in self.COLUMNS:
+      setattr(self, name, np.full(capacity, fill, dtype=dtype))
+
+  def __len__(self):
+    return self.size
+
+  def __contains__(self, device_id):
+    return device_id in self.rows
+
+  def __grow(self):
+    for name, dtype, fill in self.COLUMNS:
+      column = getattr(self, name)
+      grown = np.full(2 * len(column), fill, dtype=dtype)
+      grown[:self.size] = column[:self.size]
+      setattr(self, name, grown)
+
+  def add(self, device_id, stratum=0):
+    """
+    Registers a device, a registered device keeps its statistics
+    :param device_id: Device id
+    :param stratum: Stratum of the device
+    :return: Row of the device
+    """
+    row = self.rows.get(device_id)
+    if row is not None:
+      return row
+    if self.size == len(self.ids):
+      self.__grow()
+    row = self.size
+    for name, dtype, fill in self.COLUMNS:
+      getattr(self, name)[row] = fill
+    self.ids[row] = device_id
+    self.stratum[row] = stratum
+    self.rows[device_id] = row
+    self.size += 1
+    return row
+
+  def remove(self, device_id):
+    """
+    Unregisters a device, the last row takes its place
+    :param device_id: Device id
+    :return: None
+    """
+    row = self.rows.pop(device_id, None)
+    if row is None:
+      return
+    last = self.size - 1
+    if row != last:
+      for name, _, _ in self.COLUMNS:
+        column = getattr(self, name)
+        column[row] = column[last]
+      self.rows[int(self.ids[row])] = row
+    self.size = last
+
+  def index(self, device_ids):
+    return np.fromiter((self.rows[device_id] for device_id in device_ids), dtype=np.int64, count=len(device_ids))
+
+  def set_available(self, device_ids, available=True):
+    self.available[self.index(device_ids)] = available
+
+  def set_stratum(self, device_id, stratum):
+    self.stratum[self.add(device_id)] = stratum
+
+  def record(self, device_id, loss=None, latency=None):
+    """
+    Records the outcome of a round of a device
+    :param device_id: Device id
+    :param loss: Training loss reported by the device
+    :param latency: Seconds from the selection to the update
+    :return: None
+    """
+    row = self.rows.get(device_id)
+    if row is None:
+      return
+    if loss is not None:
+      self.loss[row] = loss
+    if latency is not None:
+      previous = self.latency[row]
+      self.latency[row] = latency if np.isnan(previous) else \
+        (1. - self.smoothing) * previous + self.smoothing * latency
+
+  def num_available(self):
+    return int(np.count_nonzero(self.available[:self.size]))
+
+  def candidates(self):
+    """
+    :return: Rows of the available devices
+    """
+    return np.flatnonzero(self.available[:self.size])
+
+  def mark_selected(self, rows):
+    self.available[rows] = False
+    self.participations[rows] += 1
+
+
+class SelectionPolicy(object):
+  """
+  Selection policy base class, also the uniform policy
+  """
+  name = 'uniform'
+
+  def __init__(self, seed=None):
+    self.rng = np.random.default_rng(seed)
+
+  def choose(self, table, rows, k):
+    """
+    :param table: DeviceTable
+    :param rows: Rows of the available devices
+    :param k: Number of devices to choose, at most len(rows)
+    :return: Chosen rows
+    """
+    return self.rng.choice(rows, k, replace=False)
+
+  def select(self, table, k, rows=None):
+    """
+    Picks up to k available devices and marks them selected
+    :param table: DeviceTable
+    :param k: Number of devices
+    :param rows: Optional, rows of the available devices to pick among (default all of them)
+    :return: Device ids of the selected devices
+    """
+    rows = table.candidates() if rows is None else rows
+    k = min(k, len(rows))
+    if k <= 0:
+      return []
+    chosen = rows if k == len(rows) else self.choose(table, rows, k)
+    table.mark_selected(chosen)
+    return table.ids[chosen].tolist()
+
+
+class StratifiedPolicy(SelectionPolicy):
+  """
+  Proportional allocation over the strata, largest remainders first
+  """
+  name = 'stratified'
+
+  def choose(self, table, rows, k):
+    stratum = table.stratum[rows]
+    counts = np.bincount(stratum)
+    strata = np.flatnonzero(counts)
+    quotas = counts[strata] * k / float(len(rows))
+    allocation = np.zeros(len(counts), dtype=np.int64)
+    allocation[strata] = np.floor(quotas)
+    shortfall = k - allocation.sum()
+    if shortfall:
+      allocation[strata[np.argsort(allocation[strata] - quotas, kind='stable')[:shortfall]]] += 1
+    # A uniform sample of the rows, grown until it holds the allocation of
+    # every stratum, the first members of every stratum in it are kept
+    size = min(len(rows), 2 * k)
+    while True:
+      candidates = self.rng.choice(len(rows), size, replace=False)
+      sampled = stratum[candidates]
+      if size == len(rows) or (np.bincount(sampled, minlength=len(counts)) >= allocation).all():
+        break
+      size = min(len(rows), 2 * size)
+    order = np.argsort(sampled, kind='stable')
+    sampled = sampled[order]
+    rank = np.arange(size) - np.searchsorted(sampled, sampled)
+    return rows[candidates[order[rank < allocation[sampled]]]]
+
+
+class PowerOfChoicePolicy(SelectionPolicy):
+  """
+  Power-of-choice: the highest loss devices among d * k random candidates
+
+  d : Size of the candidate set, as a multiple of k, at least k candidates are drawn
+  """
+  name = 'power_of_choice'
+
+  def __init__(self, d=2., seed=None):
+    super(PowerOfChoicePolicy, self).__init__(seed)
+    self.d = d
+
+  def choose(self, table, rows, k):
+    # A d under 1 would draw fewer candidates than the devices to select
+    candidates = self.rng.choice(rows, min(len(rows), max(int(np.ceil(self.d * k)), k)), replace=False)
+    loss = table.loss[candidates]
+    loss = np.where(np.isnan(loss), np.inf, loss)
+    return candidates[np.argpartition(-loss, k - 1)[:k]]
+
+
+class LatencyAwarePolicy(SelectionPolicy):
+  """
+  Weighted sampling without replacement favoring the fast devices
+
+  alpha : Devices are weighted by round_time ** -alpha, 0 is uniform
+  """
+  name = 'latency'
+
+  def __init__(self, alpha=1., seed=None):
+    super(LatencyAwarePolicy, self).__init__(seed)
+    self.alpha = alpha
+
+  def choose(self, table, rows, k):
+    latency = table.latency[rows]
+    known = ~np.isnan(latency)
+    if not known.all():
+      latency = np.where(known, latency, np.median(latency[known]) if known.any() else 1.)
+    latency = np.maximum(latency, 1e-3)
+    fastest = latency.min()
+    if (latency.max() / fastest) ** -self.alpha == 0.:
+      # The slowest weights underflow, the limit of a large alpha is the k fastest devices
+      return rows[np.argpartition(latency, k - 1)[:k]]
+    weights = np.power(latency / fastest, -self.alpha, dtype=np.float64)
+    # Draws with replacement, the first k distinct devices drawn are a
+    # weighted sample without replacement
+    cdf = np.cumsum(weights, out=weights)
+    chosen = np.empty(0, dtype=np.int64)
+    while len(chosen) < k:
+      draws = np.searchsorted(cdf, self.rng.random(2 * (k - len(chosen))) * cdf[-1], side='right')
+      drawn = np.concatenate((chosen, np.minimum(draws, len(rows) - 1)))
+      _, first = np.unique(drawn, return_index=True)
+      chosen = drawn[np.sort(first)][:k]
+    return rows[chosen]
+
+
+def get_selection_policy(config):
+  """
+  Builds the selection policy of a server or selector config
+  :param config: Dict with selection_policy (default uniform), and optionally
+  seed, power_of_choice_d and latency_alpha
+  :return: SelectionPolicy
+  """
+  name = config.get('selection_policy') or 'uniform'
+  seed = config.get('seed')
+  if name == 'uniform':
+    return SelectionPolicy(seed)
+  elif name == 'stratified':
+    return StratifiedPolicy(seed)
+  elif name == 'power_of_choice':
+    return PowerOfChoicePolicy(config.get('power_of_choice_d', 2.), seed)
+  elif name == 'latency':
+    return LatencyAwarePolicy(config.get('latency_alpha', 1.), seed)
+  raise NotImplementedError('Selection policy {} not supported'.format(name))
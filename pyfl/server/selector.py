@@ -3,6 +3,7 @@ from abc import ABC
 from pyfl.communication.message import Message
 from pyfl.communication.message_definitions import ServerDeviceMessage, DeviceServerSendClass
 from pyfl.communication.message_definitions import ServerDeviceQueryClass, ServerDeviceNotifClass
+from pyfl.server.selection import DeviceTable, get_selection_policy
 from pyfl.utils import get_logger
 
 logger = get_logger(__name__)
@@ -52,6 +53,9 @@ class Selector(SelectorBase):
     device_id : device_ids of the devices
     device_comm: Communicator objects
   server_id : Server id
+  selection_policy : Optional, one of uniform, stratified, power_of_choice, latency (default uniform)
+  power_of_choice_d, latency_alpha : Optional, parameters of the selection policy
+  seed : Optional, seed of the selection policy
 
   The selector registers all devices that ping it to participate in the FL task,
   but only chooses certain number of devices that coordinator
@@ -59,8 +63,45 @@ class Selector(SelectorBase):
 
   def __init__(self, selector_config):
     self.selector_config = selector_config
-    print(self.selector_config['devices'])
     self.selected_devices = {}
+    self.device_table = DeviceTable(max(len(selector_config['devices']), 1))
+    for device_id in selector_config['devices']:
+      self.device_table.add(device_id)
+    self.policy = get_selection_policy(selector_config)
+
+  def add_device(self, device_id, device):
+    """
+    Hands a device over to this selector
+    :param device_id: Device id
+    :param device: Device dict, shared with the server
+    :return: None
+    """
+    self.selector_config['devices'][device_id] = device
+    self.device_table.add(device_id)
+
+  def remove_device(self, device_id):
+    self.selector_config['devices'].pop(device_id, None)
+    self.selected_devices.pop(device_id, None)
+    self.device_table.remove(device_id)
+
+  def ready_rows(self, table):
+    """
+    :param table: DeviceTable of the server
+    :return: Rows of the table of this selector's ready devices
+    """
+    rows = table.index([device_id for device_id in self.selector_config['devices'] if device_id in table])
+    return rows[table.available[rows]]
+
+  def select_ready(self, table, num_devices, rows=None):
+    """
+    Picks up to num_devices of this selector's ready devices by the statistics
+    the server keeps in its table, and marks them selected there
+    :param table: DeviceTable of the server
+    :param num_devices: Number of devices
+    :param rows: Optional, rows returned by ready_rows
+    :return: List of selected device ids
+    """
+    return self.policy.select(table, num_devices, self.ready_rows(table) if rows is None else rows)
 
   def send_message(self,
                    message):
@@ -71,17 +112,18 @@ class Selector(SelectorBase):
     Select the number of devices specified by the server from the pool
     of registered devices
     :param num_selected_devices_per_selector: Num of selected devices for the FL task
-    :return: None
+    :return: Dict device_id -> device of the selected devices
     """
-    for i, key in enumerate(self.selector_config['devices'].keys()):
-      if i < num_selected_devices_per_selector:
-        device = self.selector_config['devices'][key]
-        self.selected_devices['device_id'] = device['device_id']
-        self.selected_devices['device_comm'] = device['device_comm']
-        self.send_message(Message({
-          'sender_id': self.selector_config['server_id'],
-          'receiver_id': self.selected_devices['device_id'],
-          'message_class': server2device.D2S_NOTIF_CLASS,
-          'message_type': server2device.D2S_NOTIF_CLASS.S2D_SELECTED,
-          'message': None
-        }))
+    self.device_table.set_available(list(self.selector_config['devices']))
+    self.selected_devices = {}
+    for device_id in self.policy.select(self.device_table, num_selected_devices_per_selector):
+      device = self.selector_config['devices'][device_id]
+      self.selected_devices[device_id] = device
+      self.send_message(Message({
+        'sender_id': self.selector_config['server_id'],
+        'receiver_id': device['device_id'],
+        'message_class': server2device.S2D_NOTIF_CLASS,
+        'message_type': server2device.S2D_NOTIF_CLASS.S2D_SELECTED,
+        'message': None
+      }))
+    return self.selected_devices
@@ -1,23 +1,34 @@
 import abc
-import copy
+import asyncio
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 
 import loguru
+import numpy as np
 
-from pyfl.args import get_args
 from pyfl.communication.communicator import Communicator
+from pyfl.communication.compression import payload_nbytes
+from pyfl.communication.delta import ModelHistory
+from pyfl.communication.message import held_version, version_payload
 from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
-from pyfl.communication.message_definitions import DeviceServerNotifClass
-# from pyfl.server.selector import Selector
-from pyfl.utils import get_logger
+from pyfl.communication.message_definitions import DeviceServerNotifClass, DeviceServerQueryClass
+from pyfl.communication.message_definitions import DeviceServerSendClass
+from pyfl.communication.masked import MaskedDecoder, MaskedEncoder, MaskedWeights
+from pyfl.communication.shared_memory import SharedModelBuffer
+from pyfl.models.flat_params import FlatParameters
+from pyfl.server.aggregator import Aggregator, AggregatorPool, MasterAggregator, flatten_update
+from pyfl.server.checkpoint import Checkpointer, load_checkpoint
+from pyfl.server.scheduler import LivenessTracker, RoundScheduler, TimerWheel
+from pyfl.server.selection import DeviceTable, get_selection_policy
+from pyfl.server.selector import Selector
+from pyfl.server.sharding import ShardMap
+from pyfl.utils import get_logger, get_model
 
 log = loguru.logger
 logger = get_logger(__name__)
 device2server = DeviceServerMessage()
 server2device = ServerDeviceMessage()
 
-args = get_args()
-
 
 class ServerBase(ABC):
   """
@@ -52,14 +63,47 @@ class Server(ServerBase):
   num_selectors : The number of selectors in use (int)
   num_coordinators : The number of coordinators in use (int)
   num_master_aggregators : The number of master aggregators in use (int)
-  num_aggregators : The number of aggregators in use (int)
+  num_aggregators : The number of aggregators in use (int), over 1 the updates are
+                    reduced by a pool of aggregator processes
   rounds : Number of rounds the FL task is run for (int)
+  server_lr : Optional, step size of the server on the averaged update (default 1)
+  task_config : Optional, task config sent to the devices, builds the global model
+  clients_per_round : Optional, devices selected per round, all registered devices if missing
+  round_timeout : Optional, seconds the selection of a round waits for ready devices
+  deadline : Optional, seconds after which a round closes with the updates it has
+  quorum : Optional, fraction of clients_per_round that closes a round early (default 1)
+  expected_dropout : Optional, initial fraction of selected devices expected to drop out,
+                     the selection is inflated to make up for them
+  heartbeat_interval : Optional, seconds of silence after which a device is probed (default 1)
+  liveness_timeout : Optional, seconds of silence after which a device is considered dead,
+                     no device is ever declared dead if missing
+  max_devices_per_selector : Optional, devices handed to each selector (default 2)
+  sharding : Optional, how the devices are assigned to the selectors and aggregators,
+             hash or balanced (default balanced), see pyfl.server.sharding
+  selection_policy : Optional, how the devices of a round are picked among the ready ones,
+                     one of uniform, stratified, power_of_choice, latency (default uniform)
+  power_of_choice_d : Optional, candidate set size of power_of_choice as a multiple of
+                      the devices selected (default 2)
+  latency_alpha : Optional, exponent of the round time weighting of latency (default 1)
+  seed : Optional, seed of the selection policy
+  delta_history : Optional, global model versions a device can get a delta from,
+                  0 or missing always sends the full model
+  delta_codec : Optional, compression of the model deltas (default qsgd8)
+  max_delta_chain : Optional, deltas a device gets in a row before the full model is sent again (default 8)
+  checkpoint_dir : Optional, directory of the checkpoints (default runs/checkpoints)
+  checkpoint_interval : Optional, rounds between checkpoints, 0 or missing never checkpoints
+  checkpoint_keep : Optional, number of checkpoints kept (default 3)
+
+  The server runs as an asyncio event loop: every device channel has its own
+  conversation task, selection and aggregation run as tasks fed by queues, and
+  the aggregation itself runs in an executor so the loop keeps serving devices.
 
   Server2Device message system:
   Message Class : what it does
   0 : Class of Notification messages from server to device
     0 : Notify the device it's selected
     1 : Notify the device to try later
+    2 : Notify the device the task is finished
   1 : Class of Query messages from server to device
     0 : Query the device if it's alive
     1 : Query the device if it's ready
@@ -67,7 +111,14 @@ class Server(ServerBase):
     0 : Send the global model
     1 : Send the task config
     2 : Send the task metrics
-    #TODO: checkpoint stuff
+
+  Checkpoints hold the global model and the round state, devices register
+  again after a restart. They are written by a background thread, see
+  pyfl.server.checkpoint, and restore picks a task up from one.
+
+  Ready devices are kept in a DeviceTable with their stratum, last training
+  loss and round time, the selection policy picks the devices of a round from
+  it, see pyfl.server.selection.
   """
 
   def __init__(self,
@@ -77,34 +128,81 @@ class Server(ServerBase):
     self.devices = {}
     self.coordinators = []
     self.selectors = []
+    self.selector_shards = None
     self.aggregators = []
+    self.aggregator_shards = None
     self.master_aggregators = []
+    self.aggregator_pool = None
     self.communicator = communicator
+    self.shared_model = None
+    self.mask_encoder = MaskedEncoder()
+    self.mask_decoder = MaskedDecoder()
+    self.flat_params = None
+    self.model_history = None
+    if server_config.get('task_config') is not None:
+      model, _ = get_model(server_config['task_config'])
+      self.flat_params = FlatParameters(model)
+      if server_config.get('delta_history'):
+        self.model_history = ModelHistory(self.flat_params.weights, server_config['delta_history'],
+                                          server_config.get('delta_codec', 'qsgd8'),
+                                          server_config.get('max_delta_chain', 8))
+    self.ready_devices = None
+    self.updates = None
+    self.device_table = DeviceTable()
+    self.selection_policy = get_selection_policy(server_config)
+    # Loop time every selected device was notified at, its round time ends with its update
+    self.selected_at = {}
+    self.scheduler = RoundScheduler(server_config)
+    self.liveness = LivenessTracker(server_config.get('liveness_timeout'))
+    self.wheel = None
+    # One worker so that model updates are applied in order
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.start_round = 0
+    self.checkpointer = None
+    if server_config.get('checkpoint_interval'):
+      self.checkpointer = Checkpointer({'directory': server_config.get('checkpoint_dir', 'runs/checkpoints'),
+                                        'keep': server_config.get('checkpoint_keep', 3)})
 
-  def spawn_selectors(self, num_selectors):
+  def spawn_selectors(self):
     """
-    Spawns the number of selectors ( a pre-determined constant) mentioned in the server
-    config dict
+    Spawns one selector per max_devices_per_selector registered devices,
+    rounded up. Devices are sharded over the selectors by a ShardMap and the
+    selectors share the server's device dicts. Selectors are added, removed and
+    handed devices as devices join and leave
     :return: None
     """
-    logger.info('Spawning {} selectors'.format(num_selectors))
-    devices_per_selector = []
-    curr_dict = {}
-    for k, v in self.devices.items():
-      if len(curr_dict.keys()) < args.max_devices_per_selector:
-        curr_dict.update({k: v})
-      else:
-        devices_per_selector.append(copy.deepcopy(curr_dict))
-        curr_dict = {k: v}
-    # update last curr_dict
-    devices_per_selector.append(curr_dict)
-    for i in range(num_selectors):
-      config = {
-        'selector_id': i,
-        'devices': devices_per_selector[i],
-        'server_id': self.config['server_id']
-      }
-      self.selectors.append(Selector(selector_config=config))
+    self.selector_shards = ShardMap({'max_devices_per_shard': self.config.get('max_devices_per_selector', 2),
+                                     'strategy': self.config.get('sharding', 'balanced')})
+    moves = []
+    for device_id in self.devices:
+      moves += self.selector_shards.add(device_id)
+    self.selectors = []
+    self.move_selector_devices(moves)
+    logger.info('Spawned {} selectors for {} devices'.format(len(self.selectors), len(self.devices)))
+
+  def move_selector_devices(self, moves):
+    """
+    Applies the moves of the selector shard map, spawning and dropping
+    selectors to match its shards
+    :param moves: List of (device_id, old shard, new shard)
+    :return: None
+    """
+    while len(self.selectors) < self.selector_shards.num_shards:
+      self.selectors.append(Selector(selector_config={
+        'selector_id': len(self.selectors),
+        'devices': {},
+        'server_id': self.config['server_id'],
+        'selection_policy': self.config.get('selection_policy'),
+        'power_of_choice_d': self.config.get('power_of_choice_d', 2.),
+        'latency_alpha': self.config.get('latency_alpha', 1.),
+        'seed': None if self.config.get('seed') is None else self.config['seed'] + len(self.selectors)
+      }))
+    for device_id, old_shard, new_shard in moves:
+      if old_shard is not None and old_shard < len(self.selectors):
+        self.selectors[old_shard].remove_device(device_id)
+      if new_shard is not None:
+        self.selectors[new_shard].add_device(device_id, self.devices.setdefault(device_id, {}))
+    del self.selectors[self.selector_shards.num_shards:]
 
   def spawn_coordinators(self):
     """
@@ -127,19 +225,24 @@ class Server(ServerBase):
   def spawn_aggregators(self):
     """
     Spawns the number of aggregators mentioned in the server
-    config dict
+    config dict, as a pool of worker processes. Devices are sharded over
+    the aggregators by a ShardMap, which the pool keeps up to date.
+    Master aggregators must be spawned first.
     :return: None
     """
     logger.info('Spawning {} no of aggregators'.format(self.config['num_aggregators']))
+    self.aggregator_shards = ShardMap({'num_shards': self.config['num_aggregators'],
+                                       'strategy': self.config.get('sharding', 'balanced')})
+    for device_id in self.devices:
+      self.aggregator_shards.add(device_id)
     for i in range(self.config['num_aggregators']):
       config = {
-        'selector_id': i,
-        'total_population': 0,
-        'total_population_ids': [],
-        'selected_population': 0,
-        'selected_population_ids': []
+        'aggregator_id': i,
+        'device_ids': sorted(self.aggregator_shards.members(i))
       }
-      self.aggregators.append(Selector(selector_config=config))
+      self.aggregators.append(Aggregator(config))
+    self.aggregator_pool = AggregatorPool([aggregator.config for aggregator in self.aggregators],
+                                          self.master_aggregators[0], self.aggregator_shards)
 
   def spawn_master_aggregators(self):
     """
@@ -147,25 +250,49 @@ class Server(ServerBase):
     config dict
     :return: None
     """
-    logger.info('Spawning {} no of master aggregators'.format(self.config['num_master_aggregators']))
-    for i in range(self.config['num_master_aggregators']):
+    logger.info('Spawning {} no of master aggregators'.format(self.config.get('num_master_aggregators', 1)))
+    for i in range(self.config.get('num_master_aggregators', 1)):
       config = {
-        'selector_id': i,
-        'total_population': 0,
-        'total_population_ids': [],
-        'selected_population': 0,
-        'selected_population_ids': []
+        'master_aggregator_id': i
       }
-      self.master_aggregators.append(Selector(selector_config=config))
+      self.master_aggregators.append(MasterAggregator(config))
 
-  def calculate_num_workers(self, num_devices):
+  def global_model_payload(self, weights, device_id=None, weight_mask=None, version=None):
     """
-    Returns the total number of devices required per FL task
-    :param num_devices: Total number of devices registered in a given round
-    :return: num_devices_for_task
+    Builds the payload of a S2D_SEND_GLOBAL_MODEL message. With the shared memory
+    transport the weights are published once and every device gets a handle.
+    With mask transfer only the unmasked weights are sent, plus the mask bitmap
+    the first time a device gets a mask version. With a model history a device
+    gets the delta from the version it holds
+    :param weights: List of global model weight tensors
+    :param device_id: Device the payload is sent to
+    :param weight_mask: Flat bool mask aligned with the weights (FlatParameters.weight_mask)
+    :param version: Version of the global model the device holds, None if it holds no model
+    :return: Flat weights tensor, SharedModelHandle, MaskedWeights or ModelDelta
     """
-    num_devices_for_task = num_devices
-    return num_devices_for_task
+    if self.config['run_args'].mask_transfer and weight_mask is not None:
+      self.mask_encoder.set_mask(weight_mask)
+      return self.mask_encoder.encode(flatten_update(weights), device_id)
+    if self.config['run_args'].model_transport != 'shared_memory':
+      if self.model_history is not None:
+        return self.model_history.encode(device_id, version)
+      return flatten_update(weights)
+    # apply_average publishes every new version, handing out a handle never
+    # stales the handles of the other devices
+    if self.shared_model is None:
+      self.shared_model = SharedModelBuffer.from_weights(weights)
+    return self.shared_model.handle()
+
+  def model_payload(self, device_id, version=None):
+    """
+    Payload of the global model for a device, masked by the model's weight
+    mask with mask transfer
+    :param device_id: Device the payload is sent to
+    :param version: Version of the global model the device holds
+    :return: See global_model_payload
+    """
+    weight_mask = self.flat_params.weight_mask() if self.config['run_args'].mask_transfer else None
+    return self.global_model_payload([self.flat_params.weights], device_id, weight_mask, version)
 
   def get_config(self):
     """
@@ -174,18 +301,404 @@ class Server(ServerBase):
     """
     return self.config
 
+  def reduce_updates(self, updates):
+    """
+    Averages the updates of a round, through the aggregator pool if spawned
+    :param updates: Dict device_id -> (update, num_samples)
+    :return: Flat averaged update, None if there were no updates
+    """
+    if self.aggregator_pool is not None:
+      return self.aggregator_pool.reduce(updates)
+    aggregator = Aggregator({'aggregator_id': 0})
+    for device_id, (update, num_samples) in updates.items():
+      # Masked updates get their active positions from the mask the device sent last
+      if isinstance(update, MaskedWeights):
+        self.mask_decoder.resolve(update, device_id)
+      aggregator.accumulate(update, num_samples)
+    master_aggregator = MasterAggregator({'master_aggregator_id': 0})
+    master_aggregator.sync_aggregator([aggregator.ping_master()])
+    return master_aggregator.aggregate()
+
+  def send(self, device_id, msg_class, msg_type, msg=None):
+    self.communicator.send_message(self.config['server_id'], device_id, msg_class, msg_type, msg)
+
+  async def handle_message(self, message):
+    """
+    Answers one device message, updates are handed to the aggregation task
+    :param message: Message from a device
+    :return: None
+    """
+    device_id = message.sender_id
+    # Any message is a sign of life, the next probe is pushed back
+    now = asyncio.get_running_loop().time()
+    self.liveness.seen(device_id, now)
+    self.wheel.schedule(device_id, self.config.get('heartbeat_interval', 1.), now)
+    if isinstance(message.message_class, DeviceServerNotifClass):
+      # Other notifications, as the answers to the probes, are only signs of life
+      if message.message_type not in (DeviceServerNotifClass.D2S_READY, DeviceServerNotifClass.D2S_NOT_READY):
+        return
+      ready = message.message_type == DeviceServerNotifClass.D2S_READY
+      self.devices.setdefault(device_id, {})['ready'] = ready
+      row = self.device_table.add(device_id)
+      self.device_table.available[row] = ready
+      if ready:
+        self.devices[device_id]['version'] = held_version(message)
+        if isinstance(message.message, dict) and message.message.get('stratum') is not None:
+          self.device_table.stratum[row] = message.message['stratum']
+        # Wakes up the selection task
+        await self.ready_devices.put(device_id)
+    elif isinstance(message.message_class, DeviceServerQueryClass):
+      if message.message_type == DeviceServerQueryClass.D2S_QUERY_TASK_CONFIG:
+        self.send(device_id, server2device.S2D_SEND_CLASS,
+                  server2device.S2D_SEND_CLASS.S2D_SEND_TASK_CONFIG, self.config.get('task_config'))
+      elif message.message_type == DeviceServerQueryClass.D2S_QUERY_GLOBAL_MODEL:
+        version = held_version(message)
+        if version is None:
+          version = self.devices.get(device_id, {}).get('version')
+        self.send(device_id, server2device.S2D_SEND_CLASS,
+                  server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL, self.model_payload(device_id, version))
+    elif (isinstance(message.message_class, DeviceServerSendClass) and
+          message.message_type == DeviceServerSendClass.D2S_SEND_GRADIENT_UPDATES):
+      selected_at = self.selected_at.pop(device_id, None)
+      latency = None if selected_at is None else now - selected_at
+      self.device_table.record(device_id, message.message.get('loss'), latency)
+      for shard_map in (self.selector_shards, self.aggregator_shards):
+        if shard_map is not None:
+          shard_map.record(device_id, payload_nbytes(message.message['update']), latency)
+      await self.updates.put((device_id, message.message['update'], message.message['num_samples']))
+
+  async def device_conversation(self, device_id):
+    """
+    Conversation task of one device, runs until the device closes its channel
+    :param device_id: Device id
+    :return: None
+    """
+    self.wheel.schedule(device_id, self.config.get('heartbeat_interval', 1.), asyncio.get_running_loop().time())
+    self.join_shards(device_id)
+    while True:
+      try:
+        messages = await self.communicator.recv_message_from(self.config['server_id'], device_id)
+      except EOFError:
+        logger.info('Device {} closed its channel'.format(device_id))
+        self.wheel.cancel(device_id)
+        self.liveness.forget(device_id)
+        self.devices.pop(device_id, None)
+        self.device_table.remove(device_id)
+        self.selected_at.pop(device_id, None)
+        self.leave_shards(device_id)
+        if self.model_history is not None:
+          self.model_history.forget(device_id)
+        self.mask_encoder.forget(device_id)
+        self.mask_decoder.forget(device_id)
+        if self.aggregator_pool is not None:
+          self.aggregator_pool.mask_decoder.forget(device_id)
+        return
+      for message in messages:
+        await self.handle_message(message)
+
+  def join_shards(self, device_id):
+    """
+    Assigns a connecting device to a selector and an aggregator, if spawned
+    :param device_id: Device id
+    :return: None
+    """
+    if self.selector_shards is not None:
+      self.devices.setdefault(device_id, {})
+      self.move_selector_devices(self.selector_shards.add(device_id))
+    if self.aggregator_shards is not None:
+      self.aggregator_shards.add(device_id)
+
+  def leave_shards(self, device_id):
+    if self.selector_shards is not None:
+      self.move_selector_devices(self.selector_shards.remove(device_id))
+    if self.aggregator_shards is not None:
+      self.aggregator_shards.remove(device_id)
+
+  def rebalance_shards(self):
+    """
+    Moves devices off the selectors and aggregators that got the most work
+    over the last rounds, by the update sizes and round times measured
+    :return: Number of devices moved
+    """
+    moved = 0
+    if self.selector_shards is not None:
+      moves = self.selector_shards.rebalance()
+      self.move_selector_devices(moves)
+      moved += len(moves)
+    if self.aggregator_shards is not None:
+      moved += len(self.aggregator_shards.rebalance())
+    return moved
+
+  async def heartbeat(self, conversations):
+    """
+    Probes the devices that have been silent for heartbeat_interval seconds,
+    the probes are kept on a timer wheel
+    :param conversations: Dict device_id -> conversation task
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    interval = self.config.get('heartbeat_interval', 1.)
+    while True:
+      now = loop.time()
+      for device_id in self.wheel.advance(now):
+        task = conversations.get(device_id)
+        if task is None or task.done():
+          continue
+        try:
+          self.send(device_id, server2device.S2D_QUERY_CLASS, server2device.S2D_QUERY_CLASS.S2D_CHECK_ALIVE_STATUS)
+        except (OSError, KeyError):
+          continue
+        self.wheel.schedule(device_id, interval, now)
+      await asyncio.sleep(self.wheel.tick)
+
+  def is_alive(self, device_id, now):
+    """
+    Devices are only declared dead when a liveness timeout is configured and
+    they have been connected long enough to have answered a probe
+    """
+    if self.config.get('liveness_timeout') is None:
+      return device_id in self.liveness.last_seen or device_id in self.devices
+    return self.liveness.is_alive(device_id, now)
+
+  @staticmethod
+  def remaining(deadline, now):
+    return None if deadline is None else max(deadline - now, 0.)
+
+  def pick_devices(self, num_devices):
+    """
+    Picks up to num_devices ready devices and marks them selected. With
+    selectors the devices are split over them as a uniform sample of the
+    ready devices would be, and every selector's policy picks its share
+    among its own devices
+    :param num_devices: Number of devices
+    :return: List of device ids
+    """
+    if not self.selectors:
+      return self.selection_policy.select(self.device_table, num_devices)
+    rows = [selector.ready_rows(self.device_table) for selector in self.selectors]
+    counts = [len(selector_rows) for selector_rows in rows]
+    num_devices = min(num_devices, sum(counts))
+    if num_devices <= 0:
+      return []
+    shards = self.selection_policy.rng.choice(np.repeat(np.arange(len(rows)), counts), num_devices, replace=False)
+    selected = []
+    for selector, selector_rows, quota in zip(self.selectors, rows, np.bincount(shards, minlength=len(rows))):
+      if quota:
+        selected += selector.select_ready(self.device_table, int(quota), selector_rows)
+    return selected
+
+  async def select_devices(self, num_devices, deadline=None, minimum=None):
+    """
+    Selector task: waits for num_devices ready devices, lets the selection
+    policy pick up to num_devices live ones and notifies them. Stops waiting
+    at the deadline with whatever devices are ready, or once minimum devices
+    are ready and no other device is waiting
+    :param num_devices: Number of devices for the round
+    :param deadline: Loop time at which the selection stops waiting, None waits forever
+    :param minimum: Number of devices after which over-selected ones are not waited for
+    :return: List of selected device ids
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+      # The queue only signals new ready devices, the table knows which are ready
+      while not self.ready_devices.empty():
+        self.ready_devices.get_nowait()
+      num_ready = self.device_table.num_available()
+      if num_ready >= num_devices or (minimum is not None and num_ready >= minimum):
+        break
+      try:
+        await asyncio.wait_for(self.ready_devices.get(), self.remaining(deadline, loop.time()))
+      except asyncio.TimeoutError:
+        break
+    selected = []
+    while len(selected) < num_devices:
+      chosen = self.pick_devices(num_devices - len(selected))
+      if not chosen:
+        break
+      # Dead devices are left unavailable until they are ready again
+      now = loop.time()
+      selected.extend(device_id for device_id in chosen if self.is_alive(device_id, now))
+    # Selected devices already holding the current version skip the model download
+    version = version_payload(None if self.model_history is None else self.model_history.version)
+    now = loop.time()
+    for device_id in selected:
+      self.devices.setdefault(device_id, {})['ready'] = False
+      self.selected_at[device_id] = now
+      self.send(device_id, server2device.S2D_NOTIF_CLASS, server2device.S2D_NOTIF_CLASS.S2D_SELECTED, version)
+    return selected
+
+  async def aggregate_round(self, selected, quorum=None, deadline=None):
+    """
+    Aggregation task: collects the updates of the selected devices until a
+    quorum is in, the deadline passes or every device still waited for is dead,
+    then applies their average in the executor
+    :param selected: Device ids selected for the round
+    :param quorum: Number of updates that closes the round, all selected devices if None
+    :param deadline: Loop time at which the round closes, None waits forever
+    :return: (number of updates applied, number of selected devices that dropped out)
+    """
+    loop = asyncio.get_running_loop()
+    quorum = len(selected) if quorum is None else quorum
+    interval = self.config.get('heartbeat_interval', 1.)
+    updates = {}
+    pending = set(selected)
+    while len(updates) < quorum and pending:
+      remaining = self.remaining(deadline, loop.time())
+      if remaining == 0:
+        break
+      try:
+        device_id, update, num_samples = await asyncio.wait_for(
+          self.updates.get(), interval if remaining is None else min(remaining, interval))
+      except asyncio.TimeoutError:
+        pass
+      else:
+        if device_id in pending:
+          updates[device_id] = (update, num_samples)
+          pending.discard(device_id)
+      now = loop.time()
+      pending = {device_id for device_id in pending if self.is_alive(device_id, now)}
+    # Devices still running when the quorum closed the round did not drop out
+    if len(updates) >= quorum:
+      dropped = sum(1 for device_id in selected
+                    if device_id not in updates and not self.is_alive(device_id, loop.time()))
+    else:
+      dropped = len(selected) - len(updates)
+    average = await loop.run_in_executor(self.executor, self.reduce_updates, updates)
+    if average is not None and self.flat_params is not None:
+      await loop.run_in_executor(self.executor, self.apply_average, average)
+    return len(updates), dropped
+
+  def apply_average(self, average):
+    """
+    Steps the global model with the averaged update scaled by server_lr, the
+    result is a new version
+    :param average: Flat averaged update
+    :return: None
+    """
+    self.flat_params.weights.sub_(average, alpha=self.config.get('server_lr', 1.))
+    if self.model_history is not None:
+      self.model_history.commit(self.flat_params.weights)
+    if self.shared_model is not None:
+      self.shared_model.publish([self.flat_params.weights])
+
+  def save_checkpoint(self, rounds_done):
+    """
+    Queues a checkpoint of the global model and the round state. Runs in the
+    executor, after the update of the round
+    :param rounds_done: Number of rounds completed
+    :return: None
+    """
+    tensors = {} if self.flat_params is None else {'weights': self.flat_params.weights}
+    state = {
+      'round': rounds_done,
+      'version': None if self.model_history is None else self.model_history.version,
+      'dropout': self.scheduler.dropout
+    }
+    self.checkpointer.save(rounds_done, tensors, state)
+
+  def restore(self, path):
+    """
+    Picks the task up from a checkpoint, the next round is the first one not
+    completed in it. Devices register again as they connect, those holding an
+    older model get the full model
+    :param path: Checkpoint path
+    :return: Number of rounds completed in the checkpoint
+    """
+    _, tensors, state = load_checkpoint(path)
+    if self.flat_params is not None and 'weights' in tensors:
+      self.flat_params.set_flat_weights(tensors['weights'])
+      if self.shared_model is not None:
+        self.shared_model.publish([self.flat_params.weights])
+      if self.model_history is not None:
+        self.model_history = ModelHistory(self.flat_params.weights, self.config['delta_history'],
+                                          self.config.get('delta_codec', 'qsgd8'),
+                                          self.config.get('max_delta_chain', 8), state.get('version') or 0)
+    self.start_round = state['round']
+    self.scheduler.dropout = state['dropout']
+    logger.info('Restored round {} from {}'.format(self.start_round, path))
+    return self.start_round
+
+  async def accept_devices(self, conversations):
+    """
+    Starts a conversation task for every device connecting to the server
+    :param conversations: Dict device_id -> conversation task
+    :return: None
+    """
+    async for device_id in self.communicator.new_peers(self.config['server_id']):
+      if device_id not in conversations:
+        conversations[device_id] = asyncio.create_task(self.device_conversation(device_id))
+
+  async def serve(self):
+    """
+    Server event loop, the coordinator: one conversation task per device and a
+    heartbeat task, then for every round a selection task followed by an
+    aggregation task. A round takes at most round_timeout + deadline seconds.
+    The devices are sharded over the selectors, and over a pool of aggregator
+    processes when num_aggregators is over 1
+    :return: None
+    """
+    loop = asyncio.get_running_loop()
+    if self.selector_shards is None:
+      self.spawn_selectors()
+    if self.aggregator_pool is None and self.config.get('num_aggregators', 1) > 1:
+      if not self.master_aggregators:
+        self.spawn_master_aggregators()
+      self.spawn_aggregators()
+    self.ready_devices = asyncio.Queue()
+    self.updates = asyncio.Queue()
+    self.wheel = TimerWheel(tick=self.config.get('heartbeat_interval', 1.) / 4, now=loop.time())
+    conversations = {device_id: asyncio.create_task(self.device_conversation(device_id))
+                     for device_id in self.communicator.peers(self.config['server_id'])}
+    tasks = [asyncio.create_task(self.accept_devices(conversations)),
+             asyncio.create_task(self.heartbeat(conversations))]
+    round_timeout = self.config.get('round_timeout')
+    deadline = self.config.get('deadline')
+    try:
+      for round_id in range(self.start_round, self.config['rounds']):
+        num_connected = sum(1 for task in conversations.values() if not task.done())
+        num_devices = self.scheduler.num_to_select(num_connected)
+        start = loop.time()
+        selected = await self.select_devices(num_devices, None if round_timeout is None else start + round_timeout,
+                                             self.config.get('clients_per_round'))
+        if not selected:
+          # Devices may still be connecting, the next round waits for them again
+          logger.info('Round {} skipped, no device was ready within the round timeout'.format(round_id))
+          continue
+        count, dropped = await self.aggregate_round(selected, self.scheduler.quorum(len(selected)),
+                                                    None if deadline is None else loop.time() + deadline)
+        self.scheduler.end_round(len(selected), dropped)
+        self.rebalance_shards()
+        logger.info('Round {} done in {:.2f}s, aggregated {} of {} selected updates, {} dropped'.format(
+          round_id, loop.time() - start, count, len(selected), dropped))
+        if self.checkpointer is not None and (round_id + 1) % self.config['checkpoint_interval'] == 0:
+          # Only the copy of the state runs in the executor, the checkpointer's thread writes it
+          await loop.run_in_executor(self.executor, self.save_checkpoint, round_id + 1)
+    finally:
+      for device_id, task in conversations.items():
+        if not task.done():
+          try:
+            self.send(device_id, server2device.S2D_NOTIF_CLASS, server2device.S2D_NOTIF_CLASS.S2D_TASK_FINISHED)
+          except (OSError, KeyError):
+            pass
+      tasks += list(conversations.values())
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+  def calculate_num_workers(self, num_devices):
+    """
+    Returns the total number of devices required per FL task. With
+    clients_per_round set the round waits for that many ready devices,
+    which may still be connecting
+    :param num_devices: Total number of devices registered in a given round
+    :return: num_devices_for_task
+    """
+    return self.config.get('clients_per_round') or num_devices
+
   def run_server(self):
-    # spawn all related stuff
-    # self.spawn_selectors()
-    # self.spawn_coordinators()
-    # self.spawn_aggregators()
-    # self.spawn_master_aggregators()
-
-    device_participation_messages = self.communicator.recv_message(self.config['server_id'])
-    log.debug(device_participation_messages)
-    exit(0)
-    num_devices = len(self.devices)
-    num_selectors = num_devices // args.max_devices_per_selector
-    self.spawn_selectors(num_selectors)
-    num_selected_devices = self.calculate_num_workers(num_devices)
-    num_selected_devices_per_selector = num_selected_devices // num_selectors
+    asyncio.run(self.serve())
+    self.executor.shutdown()
+    if self.aggregator_pool is not None:
+      self.aggregator_pool.shutdown()
+    if self.checkpointer is not None:
+      self.checkpointer.close()
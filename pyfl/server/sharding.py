@@ -0,0 +1,309 @@
+"""
+Assignment of the devices to the selectors and aggregators of the server.
+
+Strategies:
+hash : consistent hashing with bounded loads. Every shard owns virtual_nodes
+       points of a hash ring and a device goes to the first shard after its
+       own point that is under the load cap. A device keeps its shard until it
+       leaves, and a new shard only takes the devices whose point now falls on it
+balanced : load-aware bin packing. The cost of a device is its update size
+           plus its round time, each relative to the mean of the devices
+           measured, a device never measured costs the mean. A joining device
+           goes to the least loaded shard and rebalance moves devices off the
+           most loaded shard until every shard is within tolerance of the mean
+
+Shards hold device ids only, the callers keep sharing their device dicts.
+Every change returns the moves it made as (device_id, old shard, new shard)
+tuples, old shard is None for a joining device and new shard None for a
+leaving one, so that the selectors and aggregators are updated incrementally.
+"""
+import hashlib
+import math
+
+import numpy as np
+
+# Columns of the per-shard statistics
+COUNT, NBYTES, NBYTES_KNOWN, LATENCY, LATENCY_KNOWN = range(5)
+
+
+def num_shards_for(num_devices, max_devices_per_shard):
+  """
+  :param num_devices: Number of devices
+  :param max_devices_per_shard: Capacity of a shard
+  :return: Number of shards holding every device, at least 1
+  """
+  return max(int(math.ceil(num_devices / float(max_devices_per_shard))), 1)
+
+
+def _hash(key):
+  return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'little')
+
+
+class ShardMap(object):
+  """
+  Devices to shards assignment
+
+  What is shard map config ? A dict with the following params:
+  num_shards : Optional, initial number of shards (default 1)
+  max_devices_per_shard : Optional, a shard is added when every shard is full and
+                          the last one removed when the others can hold its devices
+  strategy : Optional, hash or balanced (default balanced)
+  virtual_nodes : Optional, hash: points of every shard on the ring (default 64)
+  tolerance : Optional, fraction over the mean load a shard may hold (default 0.1)
+  smoothing : Optional, weight of a new measurement in the running averages (default 0.3)
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self.strategy = config.get('strategy', 'balanced')
+    if self.strategy not in ('hash', 'balanced'):
+      raise NotImplementedError('Sharding strategy {} not supported'.format(self.strategy))
+    self.max_devices = config.get('max_devices_per_shard')
+    self.tolerance = config.get('tolerance', 0.1)
+    self.smoothing = config.get('smoothing', 0.3)
+    self.virtual_nodes = config.get('virtual_nodes', 64)
+    self.owner = {}
+    self.shards = []
+    self.stats = np.zeros((0, 5))
+    # Running averages of the update size and round time of every device
+    self.nbytes = {}
+    self.latency = {}
+    self.points = {}
+    self.ring_points = np.empty(0, dtype=np.uint64)
+    self.ring_shards = np.empty(0, dtype=np.int64)
+    for _ in range(config.get('num_shards', 1)):
+      self.__new_shard()
+
+  def __len__(self):
+    return len(self.owner)
+
+  @property
+  def num_shards(self):
+    return len(self.shards)
+
+  def shard_of(self, device_id):
+    return self.owner.get(device_id)
+
+  def members(self, shard):
+    return self.shards[shard]
+
+  def __means(self):
+    totals = self.stats.sum(axis=0)
+    mean_nbytes = totals[NBYTES] / totals[NBYTES_KNOWN] if totals[NBYTES_KNOWN] else 0.
+    mean_latency = totals[LATENCY] / totals[LATENCY_KNOWN] if totals[LATENCY_KNOWN] else 0.
+    return mean_nbytes or 1., mean_latency or 1.
+
+  def cost(self, device_id):
+    """
+    :param device_id: Device id
+    :return: Update size plus round time of the device, relative to the means
+    """
+    return self.__cost(device_id, *self.__means())
+
+  def __cost(self, device_id, mean_nbytes, mean_latency):
+    nbytes, latency = self.nbytes.get(device_id), self.latency.get(device_id)
+    return (1. if nbytes is None else nbytes / mean_nbytes) + (1. if latency is None else latency / mean_latency)
+
+  def loads(self):
+    """
+    :return: Array of the summed cost of the devices of every shard
+    """
+    mean_nbytes, mean_latency = self.__means()
+    stats = self.stats
+    return (2 * stats[:, COUNT] - stats[:, NBYTES_KNOWN] - stats[:, LATENCY_KNOWN] +
+            stats[:, NBYTES] / mean_nbytes + stats[:, LATENCY] / mean_latency)
+
+  def __account(self, device_id, shard, sign):
+    row = self.stats[shard]
+    row[COUNT] += sign
+    nbytes, latency = self.nbytes.get(device_id), self.latency.get(device_id)
+    if nbytes is not None:
+      row[NBYTES] += sign * nbytes
+      row[NBYTES_KNOWN] += sign
+    if latency is not None:
+      row[LATENCY] += sign * latency
+      row[LATENCY_KNOWN] += sign
+
+  def __assign(self, device_id, shard):
+    self.owner[device_id] = shard
+    self.shards[shard].add(device_id)
+    self.__account(device_id, shard, 1)
+
+  def __unassign(self, device_id):
+    shard = self.owner.pop(device_id)
+    self.shards[shard].discard(device_id)
+    self.__account(device_id, shard, -1)
+    return shard
+
+  def __capacity(self, num_devices):
+    """
+    :return: Number of devices a shard may hold, hash bounds it to keep the ring balanced
+    """
+    cap = np.inf if self.max_devices is None else self.max_devices
+    if self.strategy == 'hash':
+      cap = min(cap, int(math.ceil((1. + self.tolerance) * num_devices / self.num_shards)))
+    return cap
+
+  def __place(self, device_id):
+    """
+    :return: Shard a device not assigned yet goes to
+    """
+    counts = self.stats[:, COUNT]
+    cap = self.__capacity(len(self.owner) + 1)
+    if self.strategy == 'balanced':
+      loads = np.where(counts < cap, self.loads(), np.inf)
+      return int(np.argmin(loads))
+    start = int(np.searchsorted(self.ring_points, np.uint64(self.points[device_id]), side='right'))
+    for step in range(len(self.ring_points)):
+      shard = int(self.ring_shards[(start + step) % len(self.ring_points)])
+      if counts[shard] < cap:
+        return shard
+    return int(np.argmin(counts))
+
+  def __new_shard(self):
+    shard = len(self.shards)
+    self.shards.append(set())
+    self.stats = np.vstack([self.stats, np.zeros((1, 5))])
+    if self.strategy == 'hash':
+      points = np.array([_hash('{}-{}'.format(shard, i)) for i in range(self.virtual_nodes)], dtype=np.uint64)
+      ring_points = np.concatenate([self.ring_points, points])
+      ring_shards = np.concatenate([self.ring_shards, np.full(self.virtual_nodes, shard, dtype=np.int64)])
+      order = np.argsort(ring_points, kind='stable')
+      self.ring_points, self.ring_shards = ring_points[order], ring_shards[order]
+    return shard
+
+  def add(self, device_id):
+    """
+    Assigns a joining device, adding a shard first if every shard is full
+    :param device_id: Device id
+    :return: List of moves
+    """
+    if device_id in self.owner:
+      return []
+    self.points[device_id] = _hash(device_id)
+    moves = []
+    if self.max_devices is not None and len(self.owner) >= self.num_shards * self.max_devices:
+      moves += self.add_shard()
+    shard = self.__place(device_id)
+    self.__assign(device_id, shard)
+    moves.append((device_id, None, shard))
+    return moves
+
+  def remove(self, device_id):
+    """
+    Unassigns a leaving device, removing the last shard if the others can
+    hold its devices
+    :param device_id: Device id
+    :return: List of moves
+    """
+    if device_id not in self.owner:
+      return []
+    moves = [(device_id, self.__unassign(device_id), None)]
+    self.nbytes.pop(device_id, None)
+    self.latency.pop(device_id, None)
+    self.points.pop(device_id, None)
+    if self.max_devices is not None and self.num_shards > 1 and \
+        len(self.owner) <= (self.num_shards - 1) * self.max_devices:
+      moves += self.remove_shard()
+    return moves
+
+  def record(self, device_id, nbytes=None, latency=None):
+    """
+    Records the update size and round time of a device
+    :param device_id: Device id
+    :param nbytes: Bytes of the device's update
+    :param latency: Seconds from the selection of the device to its update
+    :return: None
+    """
+    shard = self.owner.get(device_id)
+    if shard is None:
+      return
+    self.__account(device_id, shard, -1)
+    for values, value in ((self.nbytes, nbytes), (self.latency, latency)):
+      if value is not None:
+        previous = values.get(device_id)
+        values[device_id] = value if previous is None else \
+          (1. - self.smoothing) * previous + self.smoothing * value
+    self.__account(device_id, shard, 1)
+
+  def add_shard(self):
+    """
+    Adds a shard, hash moves the devices whose point falls on it, balanced
+    moves devices off the most loaded shards
+    :return: List of moves
+    """
+    shard = self.__new_shard()
+    if self.strategy == 'balanced':
+      return self.rebalance()
+    moves = []
+    if not self.owner:
+      return moves
+    device_ids = list(self.owner)
+    points = np.fromiter((self.points[device_id] for device_id in device_ids), dtype=np.uint64,
+                         count=len(device_ids))
+    owners = self.ring_shards[np.searchsorted(self.ring_points, points, side='right') % len(self.ring_points)]
+    cap = self.__capacity(len(self.owner))
+    for index in np.flatnonzero(owners == shard):
+      if self.stats[shard, COUNT] >= cap:
+        break
+      device_id = device_ids[index]
+      moves.append((device_id, self.__unassign(device_id), shard))
+      self.__assign(device_id, shard)
+    return moves
+
+  def remove_shard(self):
+    """
+    Removes the last shard, its devices are placed again on the others
+    :return: List of moves
+    """
+    shard = self.num_shards - 1
+    device_ids = list(self.shards[shard])
+    for device_id in device_ids:
+      self.__unassign(device_id)
+    self.shards.pop()
+    self.stats = self.stats[:shard]
+    if self.strategy == 'hash':
+      keep = self.ring_shards != shard
+      self.ring_points, self.ring_shards = self.ring_points[keep], self.ring_shards[keep]
+    moves = []
+    for device_id in device_ids:
+      new_shard = self.__place(device_id)
+      self.__assign(device_id, new_shard)
+      moves.append((device_id, shard, new_shard))
+    return moves
+
+  def rebalance(self, max_moves=None):
+    """
+    balanced: moves devices from the most to the least loaded shard until
+    every shard is within tolerance of the mean load. Every move narrows the
+    gap between two shards, so the loop ends. hash never moves devices
+    :param max_moves: Optional, maximum number of devices moved
+    :return: List of moves
+    """
+    moves = []
+    if self.strategy == 'hash' or self.num_shards < 2:
+      return moves
+    while max_moves is None or len(moves) < max_moves:
+      loads = self.loads()
+      heavy = int(np.argmax(loads))
+      open_shards = np.where(self.stats[:, COUNT] < self.__capacity(len(self.owner)), loads, np.inf)
+      light = int(np.argmin(open_shards))
+      mean = loads.mean()
+      if loads[heavy] <= (1. + self.tolerance) * mean and loads[light] >= (1. - self.tolerance) * mean:
+        break
+      gap = loads[heavy] - loads[light]
+      if light == heavy or not np.isfinite(gap):
+        break
+      # The device whose cost is closest to half the gap evens the two shards out the most
+      means = self.__means()
+      best, best_distance = None, None
+      for device_id in self.shards[heavy]:
+        cost = self.__cost(device_id, *means)
+        if cost < gap and (best is None or abs(cost - gap / 2.) < best_distance):
+          best, best_distance = device_id, abs(cost - gap / 2.)
+      if best is None:
+        break
+      self.__unassign(best)
+      self.__assign(best, light)
+      moves.append((best, heavy, light))
+    return moves
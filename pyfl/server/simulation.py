@@ -0,0 +1,142 @@
+"""
+Server side of the multi-client simulation.
+
+The SimulationServer owns the flat global model and drives the worker
+processes hosting the simulated devices (pyfl.device.simulation), either in
+synchronous FedAvg rounds or asynchronously with buffered aggregation.
+"""
+import random
+
+from pyfl.communication.message_definitions import ServerDeviceMessage
+from pyfl.server.aggregator import BufferedAggregator, MasterAggregator
+from pyfl.server.metrics import AccuracyTimeline
+from pyfl.utils import get_logger
+
+logger = get_logger(__name__)
+server2device = ServerDeviceMessage()
+
+
+class SimulationServer(object):
+  """
+  Simulation server
+
+  What is simulation server config ? A dict with the following params:
+  server_id : A unique identifier for this server
+  owners : Maps every device id to the id of the worker hosting it
+  clients_per_round : Devices sampled per synchronous round
+  devices_per_request : Devices a worker trains per asynchronous request
+  buffer_size : Updates buffered per asynchronous model version
+  staleness_exponent : Exponent of the asynchronous staleness discount
+  server_lr : Step size of the server on the averaged update
+  seed : Seed of the device sampling
+
+  global_weights is the flat global model, updated in place, the workers get a
+  copy of every version. evaluate, if given, is called after every model update
+  and returns the test accuracy of the global model.
+  """
+
+  def __init__(self, config, communicator, global_weights, evaluate=None):
+    self.config = config
+    self.communicator = communicator
+    self.global_weights = global_weights
+    self.evaluate = evaluate
+    self.workers = sorted(set(config['owners'].values()))
+    self.rng = random.Random(config.get('seed', 0))
+    self.timeline = AccuracyTimeline()
+    # (version, copy of the global model) last handed out to the workers
+    self.published = None
+
+  def snapshot(self, version):
+    """
+    Copy of the global model at a version, taken once per version so that the
+    in place server steps never reach weights already handed out
+    :param version: Version of the current global model
+    :return: Flat weights tensor
+    """
+    if self.published is None or self.published[0] != version:
+      self.published = (version, self.global_weights.clone())
+    return self.published[1]
+
+  def send_work(self, worker_id, device_ids, version=0):
+    self.communicator.send_message(self.config['server_id'], worker_id,
+                                   server2device.S2D_SEND_CLASS,
+                                   server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL,
+                                   {'weights': self.snapshot(version) if device_ids else None,
+                                    'device_ids': device_ids, 'version': version})
+
+  def apply(self, update, version):
+    """
+    Takes a server step on the global model and records its accuracy
+    :param update: Flat averaged update
+    :param version: Version of the new global model
+    :return: None
+    """
+    if update is not None:
+      self.global_weights.add_(update, alpha=-self.config.get('server_lr', 1.))
+    if self.evaluate is not None:
+      self.timeline.record(version, self.evaluate())
+
+  def run_sync(self, rounds):
+    """
+    Synchronous FedAvg: every round waits for all the sampled devices
+    :param rounds: Number of rounds
+    :return: AccuracyTimeline
+    """
+    master_aggregator = MasterAggregator({'master_aggregator_id': 0})
+    device_ids = list(self.config['owners'].keys())
+    clients_per_round = min(self.config.get('clients_per_round') or len(device_ids), len(device_ids))
+    self.timeline = AccuracyTimeline()
+    for round_id in range(rounds):
+      assignment = {}
+      for device_id in self.rng.sample(device_ids, clients_per_round):
+        assignment.setdefault(self.config['owners'][device_id], []).append(device_id)
+      for worker_id, selected in assignment.items():
+        self.send_work(worker_id, selected, round_id)
+      partial_sums = []
+      while len(partial_sums) < len(assignment):
+        for message in self.communicator.recv_message(self.config['server_id'], block=True):
+          partial_sums.append((message.message['update'], message.message['num_samples'],
+                               message.message['count']))
+      master_aggregator.sync_aggregator(partial_sums)
+      self.apply(master_aggregator.aggregate(), round_id + 1)
+      logger.info('Round {} done, {} devices trained'.format(round_id, clients_per_round))
+    return self.timeline
+
+  def run_async(self, versions):
+    """
+    Buffered asynchronous aggregation: every worker is kept busy with the
+    latest model, the global model moves on every buffer_size updates
+    :param versions: Number of model versions to publish
+    :return: AccuracyTimeline
+    """
+    aggregator = BufferedAggregator({'master_aggregator_id': 0,
+                                     'buffer_size': self.config['buffer_size'],
+                                     'staleness_exponent': self.config.get('staleness_exponent', 0.5)})
+    devices_per_request = self.config.get('devices_per_request', 1)
+    hosted = {worker_id: [d for d, owner in self.config['owners'].items() if owner == worker_id]
+            for worker_id in self.workers}
+    self.timeline = AccuracyTimeline()
+
+    def dispatch(worker_id):
+      selected = self.rng.sample(hosted[worker_id], min(devices_per_request, len(hosted[worker_id])))
+      self.send_work(worker_id, selected, aggregator.version)
+
+    for worker_id in self.workers:
+      dispatch(worker_id)
+    busy = len(self.workers)
+    while busy:
+      for message in self.communicator.recv_message(self.config['server_id'], block=True):
+        busy -= 1
+        if aggregator.version >= versions:
+          continue
+        if aggregator.add(message.message['update'], message.message['num_samples'],
+                          message.message['count'], message.message['version']):
+          self.apply(aggregator.aggregate(), aggregator.version)
+        if aggregator.version < versions:
+          dispatch(message.sender_id)
+          busy += 1
+    return self.timeline
+
+  def stop_workers(self):
+    for worker_id in self.workers:
+      self.send_work(worker_id, [])
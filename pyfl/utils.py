@@ -2,15 +2,13 @@ import errno
 import inspect
 import logging
 import os
+import socket
 import sys
+import zlib
 from logging.handlers import RotatingFileHandler
 
-import torch
-
 from pyfl.communication.message_definitions import ServerDeviceMessage, DeviceServerMessage
-from pyfl.models.lenet import LeNet, SimpleConvNet
-from pyfl.models.resnet import resnet20
-from pyfl.models.vgg import vgg11, vgg11_bn
+from pyfl.models.registry import build_model, build_optimizer
 
 FORMATTER = logging.Formatter("%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s",
                               datefmt='%m/%d/%Y %I:%M:%S %p')
@@ -51,27 +49,23 @@ def setup_dirs():
       raise
 
 
-def get_model(task_config):
-  if task_config['model'] == 'simplenet':
-    model = SimpleConvNet()
-  elif task_config['model'] == 'lenet':
-    model = LeNet()
-  elif task_config['model'] == 'vgg11':
-    model = vgg11()
-  elif task_config['model'] == 'vgg11_bn':
-    model = vgg11_bn()
-  elif task_config['model'] == 'resnet20':
-    model = resnet20(task_config['num_clases'])
-  else:
-    raise NotImplementedError("Model not supported")
-
-  if task_config['optimizer'] == 'sgd':
-    optim = torch.optim.sgd()
-  elif task_config['optimizer'] == 'adam':
-    optim = torch.optim.adam()
-  else:
-    raise NotImplementedError("Optimizer not implemented")
+def get_point_id():
+  """
+  Id of the calling process, unique across hosts: the pid in the low 22 bits
+  (the largest Linux pid_max) under a hash of the host name
+  :return: Positive int, fits an int64
+  """
+  return (zlib.crc32(socket.gethostname().encode()) << 22) | os.getpid()
 
+
+def get_model(task_config):
+  """
+  Builds the model and the optimizer of a task from the registry
+  :param task_config: Dict with model, optimizer, num_classes (default 10) and lr_params
+  :return: (model, optimizer)
+  """
+  model = build_model(task_config['model'], task_config.get('num_classes', 10))
+  optim = build_optimizer(task_config['optimizer'], model.parameters(), task_config.get('lr_params'))
   return model, optim
 
 
@@ -0,0 +1,30 @@
+import pytest
+
+from pyfl.communication.message import Message
+
+
+class RecordingCommunicator(object):
+  """
+  Communicator stand-in that delivers nothing and records every message sent
+  through it, as the Message the receiver would get
+  """
+
+  def __init__(self):
+    self.sent = []
+
+  def send_message(self, sender_id, receiver_id, msg_class, msg_type, msg=None):
+    self.sent.append(Message({
+      'sender_id': sender_id,
+      'receiver_id': receiver_id,
+      'message_class': msg_class,
+      'message_type': msg_type,
+      'message': msg
+    }))
+
+  def recv_message(self, receiver_id, block=False, timeout=None):
+    return []
+
+
+@pytest.fixture
+def recording_communicator():
+  return RecordingCommunicator()
@@ -0,0 +1,68 @@
+import pytest
+
+import main
+import pyfl.server.simulation
+from pyfl.args import get_args, parser
+from pyfl.server.metrics import AccuracyTimeline
+from pyfl.utils import get_point_id
+
+
+class FakeProcess(object):
+  started = []
+
+  def __init__(self, target, args):
+    self.target = target
+    self.args = args
+
+  def start(self):
+    FakeProcess.started.append(self)
+
+  def join(self):
+    pass
+
+
+class FakeSimulationServer(object):
+
+  def __init__(self, config, communicator, global_weights, evaluate=None):
+    self.config = config
+
+  def run_sync(self, rounds):
+    return AccuracyTimeline()
+
+  run_async = run_sync
+
+  def stop_workers(self):
+    pass
+
+
+@pytest.mark.simulation
+def test_run_simulation_builds_its_workers(monkeypatch):
+  monkeypatch.setattr(main, 'Process', FakeProcess)
+  monkeypatch.setattr(pyfl.server.simulation, 'SimulationServer', FakeSimulationServer)
+  FakeProcess.started = []
+  main.run_simulation(parser.parse_args(['--simulate', '--num_devices', '5', '--num_workers', '2']))
+  pool_configs = [process.args[2] for process in FakeProcess.started]
+  assert [config['device_ids'] for config in pool_configs] == [[0, 2, 4], [1, 3]]
+  assert all(process.target is main.spawn_simulation_worker for process in FakeProcess.started)
+
+
+@pytest.mark.simulation
+def test_split_roles_need_a_socket_transport(monkeypatch):
+  monkeypatch.setattr('sys.argv', ['main.py', '--role', 'device', '--loader', 'tensor'])
+  with pytest.raises(SystemExit):
+    get_args()
+  monkeypatch.setattr('sys.argv', ['main.py', '--role', 'device', '--transport', 'tcp', '--loader', 'tensor',
+                                   '--master_addr', '10.0.0.1', '--first_device', '4', '--local_devices', '2'])
+  args = get_args()
+  assert args.role == 'device' and args.first_device == 4
+  # Device ids carry the host, devices of two hosts with the same pid differ
+  assert get_point_id() & ((1 << 22) - 1) == main.os.getpid() and get_point_id() >> 22
+
+
+@pytest.mark.simulation
+def test_async_buffer_needs_the_simulation(monkeypatch):
+  monkeypatch.setattr('sys.argv', ['main.py', '--async_buffer', '4'])
+  with pytest.raises(SystemExit):
+    get_args()
+  monkeypatch.setattr('sys.argv', ['main.py', '--async_buffer', '4', '--simulate'])
+  assert get_args().async_buffer == 4
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.communication.message import update_payload
+from pyfl.communication.message_definitions import DeviceServerMessage
+from pyfl.server.aggregator import Aggregator, AggregatorPool, BufferedAggregator, MasterAggregator
+
+device2server = DeviceServerMessage()
+
+
+@pytest.mark.aggregator
+def test_fedavg_two_tier():
+  updates = [torch.randn(100) for _ in range(6)]
+  num_samples = [10, 20, 30, 40, 50, 60]
+  expected = sum(u * n for u, n in zip(updates, num_samples)) / sum(num_samples)
+
+  # Two aggregators each reduce half of the devices, the master reduces the partial sums
+  aggregators = [Aggregator({'aggregator_id': i}) for i in range(2)]
+  for i, (update, n) in enumerate(zip(updates, num_samples)):
+    aggregators[i % 2].accumulate(update, n)
+  master = MasterAggregator({'master_aggregator_id': 0})
+  master.sync_aggregator([aggregator.ping_master() for aggregator in aggregators])
+  assert torch.allclose(master.aggregate(), expected, atol=1e-6)
+  # Both tiers start over after handing their sums on
+  assert aggregators[0].accumulator.total is None and master.aggregate() is None
+
+
+@pytest.mark.aggregator
+def test_aggregator_sync_devices():
+  comm = Communicator()
+  comm.register(1, 34)
+  comm.register(2, 34)
+  comm.send_message(1, 34, device2server.D2S_UPDATE_CLASS, device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                    update_payload(torch.ones(5), 1))
+  comm.send_message(2, 34, device2server.D2S_UPDATE_CLASS, device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                    update_payload(torch.zeros(5), 3))
+  comm.send_message(2, 34, device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_TASK_FINISHED, None)
+
+  aggregator = Aggregator({'aggregator_id': 0})
+  assert aggregator.sync_devices(comm.recv_message(34)) == 2
+  total, weight, count = aggregator.ping_master()
+  assert weight == 4 and count == 2
+  assert torch.allclose(total / weight, torch.full((5,), 0.25))
+
+
+@pytest.mark.aggregator
+def test_aggregator_pool():
+  updates = {device_id: (torch.randn(50), device_id + 1) for device_id in range(5)}
+  expected = sum(u * n for u, n in updates.values()) / sum(n for _, n in updates.values())
+  configs = [{'aggregator_id': 0, 'device_ids': [0, 1, 2]}, {'aggregator_id': 1, 'device_ids': [3]}]
+  pool = AggregatorPool(configs, MasterAggregator({'master_aggregator_id': 0}))
+  try:
+    # Device 4 was never assigned and gets dealt to an aggregator on the fly
+    assert torch.allclose(pool.reduce(updates), expected, atol=1e-6)
+  finally:
+    pool.shutdown()
+
+
+@pytest.mark.aggregator
+def test_buffered_aggregator_discounts_stale_updates():
+  aggregator = BufferedAggregator({'master_aggregator_id': 0, 'buffer_size': 2, 'staleness_exponent': 1.})
+  aggregator.version = 3
+  fresh, stale = torch.ones(4), torch.ones(4)
+  assert not aggregator.add(fresh * 10, 10, 1, version=3)
+  # Trained from version 0, staleness 3, discounted by 1 / 4
+  assert aggregator.add(stale * 30, 30, 1, version=0)
+  assert torch.allclose(aggregator.aggregate(), torch.full((4,), (10 + 30 / 4) / 40))
+  assert aggregator.version == 4 and aggregator.aggregate() is None
@@ -0,0 +1,75 @@
+import os
+from argparse import Namespace
+
+import pytest
+import torch
+
+from pyfl.server.checkpoint import Checkpointer, latest_checkpoint, list_checkpoints, load_checkpoint
+from pyfl.server.server import Server
+
+TASK_CONFIG = {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.1}}
+
+
+@pytest.mark.checkpoint
+def test_incremental_checkpoints(tmp_path):
+  checkpointer = Checkpointer({'directory': str(tmp_path), 'keep': 2, 'chunk_bytes': 400})
+  weights = torch.randn(1000)
+  frozen = torch.arange(10).reshape(2, 5)
+  checkpointer.save(1, {'weights': weights, 'frozen': frozen}, {'round': 1})
+  # The caller's tensors can change as soon as save returns
+  weights[:100] += 1.
+  checkpointer.save(2, {'weights': weights, 'frozen': frozen}, {'round': 2})
+  checkpointer.wait()
+  first, second = list_checkpoints(str(tmp_path))
+  # Only the first chunk of the weights changed, the others are hard links
+  assert os.stat(os.path.join(second, 'weights.00000.npy')).st_ino != \
+         os.stat(os.path.join(first, 'weights.00000.npy')).st_ino
+  assert os.stat(os.path.join(second, 'weights.00001.npy')).st_ino == \
+         os.stat(os.path.join(first, 'weights.00001.npy')).st_ino
+  step, tensors, state = load_checkpoint(latest_checkpoint(str(tmp_path)))
+  assert step == 2 and state == {'round': 2}
+  assert torch.equal(tensors['weights'], weights) and torch.equal(tensors['frozen'], frozen)
+
+  # Only the last two are kept, a half written checkpoint is never picked
+  checkpointer.save(3, {'weights': weights}, {'round': 3})
+  checkpointer.close()
+  os.makedirs(os.path.join(str(tmp_path), 'checkpoint-00000004.tmp'))
+  assert [os.path.basename(path) for path in list_checkpoints(str(tmp_path))] == \
+         ['checkpoint-00000002', 'checkpoint-00000003']
+  assert load_checkpoint(latest_checkpoint(str(tmp_path)))[0] == 3
+
+
+@pytest.mark.checkpoint
+def test_server_resume(tmp_path):
+  config = {'server_id': 34, 'task_config': TASK_CONFIG, 'delta_history': 2, 'rounds': 10,
+            'checkpoint_dir': str(tmp_path), 'checkpoint_interval': 1, 'expected_dropout': 0.1,
+            'run_args': Namespace(mask_transfer=False, model_transport='pipe')}
+  server = Server(config, None)
+  server.devices = {7: {'ready': True, 'version': 0}}
+  server.apply_average(torch.randn_like(server.flat_params.weights))
+  server.save_checkpoint(4)
+  server.checkpointer.close()
+  server.executor.shutdown()
+
+  resumed = Server(config, None)
+  assert resumed.restore(latest_checkpoint(str(tmp_path))) == 4
+  assert torch.equal(resumed.flat_params.weights, server.flat_params.weights)
+  # Device ids do not outlive the processes, devices register again
+  assert resumed.devices == {}
+  assert resumed.scheduler.dropout == pytest.approx(0.1)
+  # Devices holding the version of the checkpoint get deltas again
+  assert resumed.model_history.version == 1 and resumed.model_history.encode(7, 1).values is None
+  resumed.checkpointer.close()
+  resumed.executor.shutdown()
+
+
+@pytest.mark.checkpoint
+def test_failed_checkpoint_is_raised_by_close(tmp_path):
+  checkpointer = Checkpointer({'directory': str(tmp_path)})
+  checkpointer.save(1, {'weights': torch.zeros(4)}, {'round': object()})
+  checkpointer.wait()
+  # The caller keeps going and later checkpoints are still written
+  checkpointer.save(2, {'weights': torch.ones(4)}, {'round': 2})
+  with pytest.raises(TypeError):
+    checkpointer.close()
+  assert load_checkpoint(latest_checkpoint(str(tmp_path)))[0] == 2
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from pyfl.communication.communicator import Communicator
@@ -41,3 +43,60 @@ def test_communicator():
   assert (len(msg1) != 0) and (len(msg2) != 0), "Device receive message failed"
   assert isinstance(msg1[0], Message) and isinstance(msg2[0], Message)
   assert message_class_type(msg1[0], "server") and message_class_type(msg2[0], "server")
+
+
+@pytest.mark.communicator
+def test_communicator_blocking_recv():
+  comm = Communicator()
+  comm.register(1, 34)
+  comm.register(2, 34)
+  # Nothing sent yet, a non-blocking and a timed-out blocking receive come back empty
+  assert comm.recv_message(34) == []
+  assert comm.recv_message(34, block=True, timeout=0.05) == []
+
+  # Several messages queued on the same pipe are all returned by one call
+  for _ in range(3):
+    comm.send_message(1, 34, device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_READY, None)
+  comm.send_message(2, 34, device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_READY, None)
+  messages = comm.recv_message(34, block=True)
+  assert len(messages) == 4, "Blocking receive did not drain all ready pipes"
+  assert sorted(m.get_sender() for m in messages) == [1, 1, 1, 2]
+
+
+@pytest.mark.communicator
+def test_communicator_unregister():
+  comm = Communicator()
+  comm.register(1, 34)
+  comm.register(2, 34)
+  comm.unregister(1, 34)
+  assert not comm.is_registered(1, 34) and not comm.is_registered(34, 1)
+  assert comm.is_registered(2, 34)
+  assert comm.recv_message(1) == []
+
+  comm.send_message(2, 34, device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_READY, None)
+  messages = comm.recv_message(34)
+  assert len(messages) == 1 and messages[0].get_sender() == 2
+
+
+@pytest.mark.communicator
+def test_awaitable_device_readers():
+  comm = Communicator()
+  for device_id in range(1, 51):
+    comm.register(device_id, 100)
+  assert sorted(comm.peers(100)) == list(range(1, 51))
+
+  async def conversation(device_id):
+    messages = await comm.recv_message_from(100, device_id)
+    return [message.sender_id for message in messages]
+
+  async def serve():
+    tasks = [asyncio.create_task(conversation(device_id)) for device_id in range(1, 51)]
+    # Every reader is suspended at once, replies arrive in reverse order
+    await asyncio.sleep(0.01)
+    for device_id in range(50, 0, -1):
+      comm.send_message(device_id, 100, device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_READY, None)
+    return await asyncio.wait_for(asyncio.gather(*tasks), timeout=5)
+
+  assert asyncio.run(serve()) == [[device_id] for device_id in range(1, 51)]
+  comm.unregister(1, 100)
+  assert 1 not in comm.peers(100)
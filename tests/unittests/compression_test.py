@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from pyfl.communication.compression import (QSGD8Compressor, SignCompressor, ThresholdCompressor,
+                                            TopKCompressor, decompress, payload_nbytes)
+from pyfl.device.device import Device
+from pyfl.server.aggregator import Aggregator
+
+
+@pytest.mark.compression
+def test_topk_error_feedback():
+  update = torch.randn(10000)
+  compressor = TopKCompressor(ratio=0.01)
+  payload = compressor.compress(update)
+  assert payload.indices.numel() == 100
+  # 100 int32 indices + 100 float32 values vs 10000 dense float32
+  assert payload_nbytes(update) / payload_nbytes(payload) == 50
+  # Nothing is lost: what was not sent is carried in the residual
+  assert torch.allclose(decompress(payload) + compressor.residual, update)
+  # The next round sends the residual back too
+  payload = compressor.compress(torch.zeros(10000))
+  assert float(decompress(payload).abs().sum()) > 0
+
+
+@pytest.mark.compression
+def test_threshold_and_quantization():
+  update = torch.randn(4096)
+  payload = ThresholdCompressor(threshold=2.).compress(update)
+  assert torch.equal(decompress(payload)[update.abs() >= 2.], update[update.abs() >= 2.])
+
+  payload = QSGD8Compressor().compress(update)
+  assert payload_nbytes(payload) == 4096 + 4
+  assert float((decompress(payload) - update).abs().max()) <= float(update.abs().max()) / 127.
+
+  payload = SignCompressor().compress(update)
+  assert payload_nbytes(payload) == 4096 // 8 + 4
+  assert torch.equal(decompress(payload).sign(), torch.where(update >= 0, 1., -1.))
+
+
+@pytest.mark.compression
+def test_aggregator_decompresses():
+  updates = [torch.randn(1000) for _ in range(3)]
+  aggregator = Aggregator({'aggregator_id': 0})
+  expected = torch.zeros(1000)
+  for update in updates:
+    payload = TopKCompressor(ratio=0.1).compress(update)
+    expected += decompress(payload) * 2
+    aggregator.accumulate(payload, 2)
+  total, weight, count = aggregator.ping_master()
+  assert torch.allclose(total, expected) and weight == 6 and count == 3
+
+
+@pytest.mark.compression
+def test_device_sends_empty_sparse_update(recording_communicator):
+  data = torch.utils.data.TensorDataset(torch.randn(4, 3), torch.zeros(4, dtype=torch.long))
+  communicator = recording_communicator
+  device = Device({'device_id': 1, 'server_id': 0}, {'trainset': torch.utils.data.DataLoader(data)}, communicator,
+                  ThresholdCompressor(threshold=1., error_feedback=False))
+  device.gradient_updates = torch.full((100,), 1e-3)
+  device.update_model()
+  assert payload_nbytes(communicator.sent[0].message['update']) == 0 and device.bytes_sent == [0]
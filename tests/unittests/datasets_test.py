@@ -0,0 +1,132 @@
+import os
+import subprocess
+import sys
+from argparse import Namespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from pyfl.datasets import DataPartitioner, ShardDataset, TensorBatchLoader, get_tensor_data, get_transforms
+from pyfl.datasets import shard_dir, write_shards
+
+
+class FakeDataset(object):
+  def __init__(self, targets):
+    self.targets = targets
+
+  def __len__(self):
+    return len(self.targets)
+
+  def __getitem__(self, index):
+    return index, self.targets[index]
+
+
+@pytest.mark.datasets
+def test_partition_schemes():
+  targets = np.repeat(np.arange(10), 6000)
+  data = FakeDataset(targets)
+  sizes = [1.0 / 1000] * 1000
+  for scheme in ('iid', 'label_shard', 'dirichlet'):
+    partitions = DataPartitioner(data, sizes, seed=7, scheme=scheme, alpha=0.1).partitions
+    assert len(partitions) == 1000
+    # Disjoint, and the non-IID schemes assign every sample
+    everything = np.concatenate(partitions)
+    assert len(np.unique(everything)) == len(everything)
+    if scheme != 'iid':
+      assert len(everything) == len(targets)
+    # Seedable and reproducible
+    again = DataPartitioner(data, sizes, seed=7, scheme=scheme, alpha=0.1).partitions
+    assert all(np.array_equal(a, b) for a, b in zip(partitions, again))
+
+  partitions = DataPartitioner(data, sizes, scheme='label_shard', shards_per_client=2).partitions
+  assert max(len(np.unique(targets[p])) for p in partitions) <= 2
+
+  partition = DataPartitioner(data, [0.5, 0.5]).use(1)
+  assert partition.__getitems__([0, 1]) == [partition[0], partition[1]]
+
+
+@pytest.mark.datasets
+def test_write_and_map_shards(tmp_path):
+  data = np.random.randint(0, 256, size=(100, 28, 28), dtype=np.uint8)
+  targets = np.repeat(np.arange(10), 10)
+  partitions = DataPartitioner(FakeDataset(targets), [0.2] * 5, scheme='label_shard').partitions
+
+  out_dir = str(tmp_path / 'shards')
+  write_shards(out_dir, data, targets, partitions, testset=(data[:10], targets[:10]))
+  assert os.path.exists(os.path.join(out_dir, 'manifest.json'))
+
+  shard = ShardDataset(os.path.join(out_dir, 'train_3'))
+  assert isinstance(shard.data, np.memmap) and len(shard) == 20
+  index = np.sort(partitions[3])
+  assert np.array_equal(np.asarray(shard.data), data[index])
+  img, target = shard[0]
+  assert np.array_equal(np.asarray(img), data[index[0]]) and target == targets[index[0]]
+  assert [t for _, t in shard.__getitems__([2, 0])] == [targets[index[2]], targets[index[0]]]
+
+  transform_train, _ = get_transforms('mnist')
+  img, _ = ShardDataset(os.path.join(out_dir, 'test'), transform_train)[0]
+  assert tuple(img.shape) == (1, 28, 28)
+
+
+@pytest.mark.datasets
+def test_tensor_batch_loader():
+  data = np.random.randint(0, 256, size=(50, 32, 32, 3), dtype=np.uint8)
+  targets = np.arange(50)
+  _, transform_test = get_transforms('cifar10')
+
+  loader = TensorBatchLoader(data, targets, 'cifar10', batch_size=16, train=False)
+  batches = list(loader)
+  assert len(batches) == len(loader) == 4 and len(loader.dataset) == 50
+  # Same normalization as the torchvision transforms
+  expected = transform_test(Image.fromarray(data[0]))
+  assert torch.allclose(batches[0][0][0], expected, atol=1e-5)
+
+  loader = TensorBatchLoader(data, targets, 'cifar10', batch_size=16, train=True, seed=0)
+  seen = []
+  for batch, target in loader:
+    assert tuple(batch.shape[1:]) == (3, 32, 32)
+    seen.extend(target.tolist())
+    # Every augmented image is a (possibly flipped) crop of the zero padded original
+    for image, label in zip(batch, target.tolist()):
+      padded = F.pad(transform_test(Image.fromarray(data[label])), (4, 4, 4, 4))
+      black = transform_test(Image.fromarray(np.zeros((1, 1, 3), dtype=np.uint8))).view(3, 1, 1)
+      padded = padded + black * (F.pad(torch.ones(1, 32, 32), (4, 4, 4, 4)) == 0)
+      crops = padded.unfold(1, 32, 1).unfold(2, 32, 1).permute(1, 2, 0, 3, 4).reshape(-1, 3, 32, 32)
+      found = (crops - image).abs().amax(dim=(1, 2, 3)).min() < 1e-5
+      found_flipped = (crops - image.flip(2)).abs().amax(dim=(1, 2, 3)).min() < 1e-5
+      assert found or found_flipped
+  assert sorted(seen) == list(range(50))
+
+
+@pytest.mark.datasets
+def test_shard_dir_depends_on_every_partition_parameter():
+  args = Namespace(dataset='cifar10', partition_scheme='dirichlet', iid_partion=False, dirichlet_alpha=0.5,
+                   shards_per_client=2, partition_seed=1)
+  changes = [{'dataset': 'mnist'}, {'partition_scheme': 'iid'}, {'dirichlet_alpha': 0.1},
+             {'shards_per_client': 3}, {'partition_seed': 2}]
+  paths = {shard_dir(Namespace(**dict(vars(args), **change)), 10) for change in changes}
+  assert len(paths | {shard_dir(args, 10), shard_dir(args, 20)}) == len(changes) + 2
+
+
+@pytest.mark.datasets
+def test_tensor_data_loads_the_test_set_for_evaluation_only(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  args = Namespace(dataset='mnist', partition_scheme='iid', iid_partion=False, dirichlet_alpha=0.5,
+                   shards_per_client=2, partition_seed=1, cache_shards=True, batch_size=20)
+  data = np.random.randint(0, 256, size=(40, 28, 28), dtype=np.uint8)
+  targets = np.arange(40) % 10
+  write_shards(shard_dir(args, 2), data, targets, [np.arange(20), np.arange(20, 40)], (data[:8], targets[:8]))
+  trainloader, testloader = get_tensor_data(Namespace(**vars(args)), 1, 2)
+  assert len(trainloader.dataset) == 20 and testloader is None
+  _, testloader = get_tensor_data(Namespace(**vars(args)), 1, 2, evaluate=True)
+  assert len(testloader.dataset) == 8
+
+
+@pytest.mark.datasets
+def test_datasets_module_does_not_load_torchvision():
+  # A fresh interpreter, the other tests have loaded torchvision already
+  code = 'import sys, pyfl.datasets; sys.exit("torchvision" in sys.modules or "PIL" in sys.modules)'
+  assert subprocess.run([sys.executable, '-c', code]).returncode == 0
@@ -0,0 +1,68 @@
+from argparse import Namespace
+
+import pytest
+import torch
+
+from pyfl.communication.delta import ModelDelta, ModelHistory
+from pyfl.communication.message import Message
+from pyfl.communication.message_definitions import ServerDeviceMessage
+from pyfl.device.device import Device
+from pyfl.server.server import Server
+
+server2device = ServerDeviceMessage()
+TASK_CONFIG = {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.1}}
+
+
+def over_the_wire(payload):
+  return Message.decode(Message({
+    'sender_id': 34, 'receiver_id': 1, 'message_class': server2device.S2D_SEND_CLASS,
+    'message_type': server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL, 'message': payload}).encode()).message
+
+
+@pytest.mark.compression
+def test_model_history():
+  weights = torch.randn(1000)
+  history = ModelHistory(weights, max_versions=2, codec='qsgd8', max_chain=2)
+  full = history.encode(1, None)
+  assert full.is_full() and full.version == 0 and torch.equal(full.values, weights)
+  assert history.encode(1, 0).values is None and history.encode(1, 0).nbytes() == 0
+
+  held = weights.clone()
+  weights.add_(torch.randn(1000) * 0.01)
+  history.commit(weights)
+  delta = over_the_wire(history.encode(1, 0))
+  assert delta.base_version == 0 and delta.version == 1
+  # One byte per entry instead of four
+  assert delta.nbytes() < full.nbytes() / 3.9
+  assert torch.allclose(delta.apply(held), weights, atol=1e-3)
+  # Devices holding the same version share one compressed delta
+  assert history.encode(2, 0).values is history.encode(3, 0).values
+
+  # Too long a chain, or a version out of the history, falls back to the full model
+  weights.add_(torch.randn(1000) * 0.01)
+  history.commit(weights)
+  assert not history.encode(1, 1).is_full()
+  assert history.encode(1, 1).is_full()
+  history.commit(weights)
+  assert history.encode(3, 0).is_full()
+
+
+@pytest.mark.compression
+def test_server_sends_deltas_to_returning_devices():
+  server = Server({'server_id': 34, 'task_config': TASK_CONFIG, 'delta_history': 4, 'delta_codec': 'none',
+                   'run_args': Namespace(mask_transfer=False, model_transport='pipe')}, None)
+  device = Device({'device_id': 1, 'server_id': 34}, {}, None)
+  device.build_device(TASK_CONFIG)
+  device.apply_weights(over_the_wire(server.global_model_payload([server.flat_params.weights], 1,
+                                                                 version=device.model_version)))
+  assert device.model_version == 0
+  for version in range(1, 3):
+    server.apply_average(torch.randn_like(server.flat_params.weights) * 0.01)
+    payload = server.global_model_payload([server.flat_params.weights], 1, version=device.model_version)
+    assert not payload.is_full()
+    device.apply_weights(over_the_wire(payload))
+    assert device.model_version == version
+    assert torch.allclose(device.flat_params.weights, server.flat_params.weights, atol=1e-6)
+  with pytest.raises(ValueError):
+    device.apply_weights(ModelDelta(5, 4, torch.zeros_like(device.flat_params.weights)))
+  server.executor.shutdown()
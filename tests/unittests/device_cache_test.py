@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+from argparse import Namespace
+
+import pytest
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.communication.delta import ModelHistory
+from pyfl.device.device import Device
+from pyfl.server.server import Server
+
+TASK_CONFIG = {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.1, 'momentum': 0.9}}
+
+
+def local_round(device):
+  data = torch.utils.data.TensorDataset(torch.randn(8, 1, 28, 28), torch.randint(0, 10, (8,)))
+  device.dataset = {'trainset': torch.utils.data.DataLoader(data, batch_size=4)}
+  device.train_step()
+
+
+@pytest.mark.device
+def test_device_keeps_model_across_rounds(tmp_path):
+  device = Device({'device_id': 1, 'server_id': 34, 'spill_dir': str(tmp_path)}, {}, None)
+  assert device.prepare_model(TASK_CONFIG)
+  model = device.model
+  assert not device.prepare_model(dict(TASK_CONFIG)) and device.model is model
+
+  global_weights = torch.randn_like(device.flat_params.weights) * 0.05
+  history = ModelHistory(global_weights, codec='none')
+  device.apply_weights(history.encode(1, device.model_version))
+  local_round(device)
+  # Deltas apply to the global model held, not to the locally trained weights
+  global_weights = global_weights + 0.01
+  history.commit(global_weights)
+  device.apply_weights(history.encode(1, device.model_version))
+  assert device.model_version == 1 and torch.allclose(device.flat_params.weights, global_weights)
+  local_round(device)
+  device.apply_weights(history.encode(1, device.model_version))
+  assert torch.equal(device.flat_params.weights, global_weights)
+
+  # An idle device spills to disk and picks up where it left
+  momentum = {k: v['momentum_buffer'].clone() for k, v in device.optimizer.state_dict()['state'].items()}
+  path = device.spill()
+  assert device.model is None and os.path.exists(path)
+  assert not device.prepare_model(TASK_CONFIG) and not os.path.exists(path)
+  assert device.model_version == 1 and torch.equal(device.flat_params.weights, global_weights)
+  state = device.optimizer.state_dict()['state']
+  assert momentum and all(torch.equal(momentum[k], state[k]['momentum_buffer']) for k in momentum)
+  assert device.prepare_model(dict(TASK_CONFIG, model='simplenet')) and device.model_version is None
+
+
+@pytest.mark.device
+def test_repeat_participant_rounds():
+  communicator = Communicator()
+  communicator.register(1, 0)
+  server = Server({'server_id': 0, 'task_config': TASK_CONFIG, 'rounds': 3, 'clients_per_round': 1,
+                   'heartbeat_interval': 0.1, 'delta_history': 2, 'delta_codec': 'none',
+                   'run_args': Namespace(mask_transfer=False, model_transport='pipe')}, communicator)
+  # The global model only moves after the first round
+  commits = []
+  apply_average = server.apply_average
+  server.apply_average = lambda average: commits.append(1) or (len(commits) == 1 and apply_average(average))
+
+  data = torch.utils.data.TensorDataset(torch.randn(8, 1, 28, 28), torch.randint(0, 10, (8,)))
+  device = Device({'device_id': 1, 'server_id': 0, 'server_timeout': 30},
+                  {'trainset': torch.utils.data.DataLoader(data, batch_size=4)}, communicator)
+  payloads = []
+  apply_weights = device.apply_weights
+  device.apply_weights = lambda weights: payloads.append(weights) or apply_weights(weights)
+  thread = threading.Thread(target=device.run_device)
+  thread.start()
+  asyncio.run(server.serve())
+  thread.join(30)
+  server.executor.shutdown()
+  assert not thread.is_alive()
+  assert len(commits) == 3 and len(device.bytes_sent) == 3
+  # Full model, then the delta from the version held, then nothing: the device holds the current version
+  assert [(payload.base_version, payload.version) for payload in payloads] == [(None, 0), (0, 1)]
+  assert device.model_version == server.model_history.version == 1
@@ -0,0 +1,50 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from pyfl.models.flat_params import FlatParameters
+from pyfl.models.lenet import LeNet
+from pyfl.models.vgg import vgg11
+
+
+@pytest.mark.models
+def test_flat_params_alias_model():
+  model = vgg11()
+  before = [p.detach().clone() for p in model.parameters() if p.requires_grad]
+  flat = FlatParameters(model)
+  assert flat.numel() == sum(p.numel() for p in before)
+  # Packing keeps the values, and params are views of the flat buffer
+  for param, value in zip(flat.params, before):
+    assert torch.equal(param, value)
+  flat.weights.zero_()
+  assert all(float(p.detach().abs().sum()) == 0 for p in flat.params)
+  # Masks of the MaskedConv/MaskedDense layers live in their own buffer
+  assert flat.masks.numel() == sum(m.mask.numel() for m in flat.masked_layers)
+  flat.set_masks(torch.zeros_like(flat.masks))
+  assert float(flat.masked_layers[0].mask.sum()) == 0
+
+
+@pytest.mark.models
+def test_flat_params_grads_and_set_weights():
+  model = LeNet()
+  flat = FlatParameters(model)
+  loss = F.cross_entropy(model(torch.randn(4, 1, 28, 28)), torch.tensor([0, 1, 2, 3]))
+  loss.backward()
+  assert float(flat.grads.abs().sum()) > 0
+  assert torch.equal(flat.views(flat.grads)[0], model.conv1.weight.grad)
+
+  flat.zero_grad()
+  assert float(flat.grads.abs().sum()) == 0
+
+  new_weights = torch.randn(flat.numel())
+  flat.set_flat_weights(new_weights)
+  assert torch.equal(model.fc3.bias, new_weights[-10:])
+  flat.set_weights([w * 2 for w in flat.views(new_weights)])
+  assert torch.equal(flat.weights, new_weights * 2)
+  # A one-parameter model takes a flat tensor and a list of one tensor alike
+  single = FlatParameters(torch.nn.Linear(3, 1, bias=False))
+  single.set_flat_weights(torch.ones(3))
+  single.set_weights([torch.full((1, 3), 2.)])
+  assert torch.equal(single.weights, torch.full((3,), 2.))
+  with pytest.raises(ValueError):
+    flat.set_weights([new_weights])
@@ -0,0 +1,120 @@
+import asyncio
+from argparse import Namespace
+
+import pytest
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.communication.masked import MaskedDecoder, MaskedEncoder, MaskedWeights, pack_mask, unpack_mask
+from pyfl.communication.message import update_payload
+from pyfl.communication.message_definitions import DeviceServerMessage
+from pyfl.device.device import Device
+from pyfl.models.flat_params import FlatParameters
+from pyfl.models.vgg import vgg11
+from pyfl.server.aggregator import Aggregator
+from pyfl.server.scheduler import TimerWheel
+from pyfl.server.server import Server
+
+device2server = DeviceServerMessage()
+
+
+@pytest.mark.compression
+def test_mask_bitmap_roundtrip():
+  active = torch.rand(1001) > 0.5
+  packed = pack_mask(active)
+  assert packed.numel() == 126
+  assert torch.equal(unpack_mask(packed, 1001), active)
+
+
+@pytest.mark.compression
+def test_weight_mask_follows_masked_layers():
+  flat = FlatParameters(vgg11())
+  layer = flat.masked_layers[0]
+  layer.mask.data[0].zero_()
+  active = flat.weight_mask()
+  assert int((~active).sum()) == layer.mask[0].numel()
+  layer.mask.data.fill_(1.)
+  flat.set_weight_mask(active)
+  assert float(layer.mask[0].sum()) == 0
+
+
+@pytest.mark.compression
+def test_masked_transfer_and_aggregation():
+  active = torch.rand(500) > 0.7
+  encoder = MaskedEncoder()
+  encoder.set_mask(active)
+  decoder = MaskedDecoder()
+
+  weights = torch.randn(500)
+  payload = encoder.encode(weights, peer_id=1)
+  # Bitmap only goes out once per version to each peer
+  assert payload.packed_mask is not None and payload.values.numel() == int(active.sum())
+  assert torch.equal(decoder.decode(payload, 1), weights * active)
+  payload = encoder.encode(weights, peer_id=1)
+  assert payload.packed_mask is None
+  assert torch.equal(decoder.decode(payload, 1), weights * active)
+  # A new mask bumps the version and the bitmap is sent again
+  assert encoder.set_mask(~active) == 2 and encoder.encode(weights, peer_id=1).packed_mask is not None
+
+  comm = Communicator()
+  comm.register(1, 34)
+  comm.register(2, 34)
+  for device_id in (1, 2):
+    device_encoder = MaskedEncoder()
+    device_encoder.set_mask(active)
+    comm.send_message(device_id, 34, device2server.D2S_UPDATE_CLASS,
+                      device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                      update_payload(device_encoder.encode(torch.ones(500) * device_id, 34), device_id))
+  aggregator = Aggregator({'aggregator_id': 0})
+  assert aggregator.sync_devices(comm.recv_message(34)) == 2
+  total, weight, _ = aggregator.ping_master()
+  assert torch.equal(total, active.float() * 5) and weight == 3
+
+
+@pytest.mark.compression
+def test_server_sends_masked_model():
+  task_config = {'model': 'vgg11', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.01}}
+  server = Server({'server_id': 34, 'task_config': task_config,
+                   'run_args': Namespace(mask_transfer=True, model_transport='pipe')}, None)
+  server.flat_params.masked_layers[0].mask.data[0].zero_()
+  active = server.flat_params.weight_mask()
+  payload = server.model_payload(1)
+  assert isinstance(payload, MaskedWeights) and payload.packed_mask is not None
+  assert payload.values.numel() == int(active.sum())
+
+  device = Device({'device_id': 1, 'server_id': 34, 'mask_transfer': True}, {}, None)
+  device.build_device(task_config)
+  device.apply_weights(payload)
+  assert torch.equal(device.flat_params.weight_mask(), active)
+  assert torch.equal(device.flat_params.weights[active], server.flat_params.weights[active])
+  # The bitmap only travels once per mask version
+  assert server.model_payload(1).packed_mask is None
+  server.executor.shutdown()
+
+
+class ClosedCommunicator(object):
+
+  async def recv_message_from(self, receiver_id, sender_id):
+    raise EOFError
+
+
+@pytest.mark.compression
+def test_server_forgets_the_masks_of_gone_devices():
+  task_config = {'model': 'vgg11', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.01}}
+  server = Server({'server_id': 34, 'task_config': task_config,
+                   'run_args': Namespace(mask_transfer=True, model_transport='pipe')}, ClosedCommunicator())
+  server.flat_params.masked_layers[0].mask.data[0].zero_()
+  assert server.model_payload(1).packed_mask is not None
+  device_encoder = MaskedEncoder()
+  device_encoder.set_mask(server.flat_params.weight_mask())
+  server.mask_decoder.resolve(device_encoder.encode(torch.ones_like(server.flat_params.weights), 34), 1)
+  assert server.model_payload(1).packed_mask is None
+
+  async def disconnect():
+    server.wheel = TimerWheel(tick=0.25, now=asyncio.get_running_loop().time())
+    await server.device_conversation(1)
+
+  asyncio.run(disconnect())
+  # A device coming back under the same id gets the bitmap again
+  assert server.model_payload(1).packed_mask is not None and 1 not in server.mask_decoder.masks
+  server.executor.shutdown()
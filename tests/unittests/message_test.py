@@ -0,0 +1,115 @@
+import multiprocessing as mp
+
+import pytest
+import torch
+import torch.multiprocessing  # noqa: F401, registers the shared memory reducers of the tensors
+
+from pyfl.communication.compression import CompressedUpdate, TopKCompressor
+from pyfl.communication.delta import ModelDelta
+from pyfl.communication.masked import MaskedEncoder
+from pyfl.communication.message import Message, update_payload
+from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
+
+device2server = DeviceServerMessage()
+server2device = ServerDeviceMessage()
+
+
+def roundtrip(payload, msg_class=device2server.D2S_UPDATE_CLASS,
+              msg_type=device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES):
+  message = Message({
+    'sender_id': 12345,
+    'receiver_id': 34,
+    'message_class': msg_class,
+    'message_type': msg_type,
+    'message': payload
+  })
+  encoded = message.encode()
+  return encoded, Message.decode(encoded)
+
+
+@pytest.mark.communicator
+def test_control_message_wire_format():
+  encoded, decoded = roundtrip(None, device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_TASK_ABORTED)
+  assert len(encoded) == 23
+  assert decoded.get_sender() == 12345 and decoded.get_receiver() == 34
+  assert decoded.message_class is DeviceServerMessage.D2S_NOTIF_CLASS
+  assert decoded.message_type == device2server.D2S_NOTIF_CLASS.D2S_TASK_ABORTED
+  assert decoded.message is None
+  assert not hasattr(decoded, '__dict__')
+
+
+@pytest.mark.communicator
+def test_tensor_payloads():
+  tensor = torch.randn(3, 4, 5)
+  encoded, decoded = roundtrip(tensor)
+  # Raw float32 buffer behind a 2 byte dtype/ndim header and 3 int64 dims
+  assert len(encoded) == 23 + 2 + 3 * 8 + tensor.numel() * 4
+  assert torch.equal(decoded.message, tensor)
+
+  tensors = [torch.randn(7), torch.tensor(3), torch.rand(2, 2) > 0.5, torch.zeros(0, dtype=torch.uint8)]
+  _, decoded = roundtrip(tensors, server2device.S2D_SEND_CLASS, server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL)
+  assert all(torch.equal(a, b) and a.dtype == b.dtype for a, b in zip(decoded.message, tensors))
+  decoded.message[0] += 1  # decoded tensors own their storage
+
+  _, decoded = roundtrip(update_payload(tensor, 10))
+  assert torch.equal(decoded.message['update'], tensor) and decoded.message['num_samples'] == 10
+
+
+def structured_payloads():
+  torch.manual_seed(0)
+  update = torch.randn(1000)
+  encoder = MaskedEncoder()
+  encoder.set_mask(update > 0)
+  return [
+    update_payload(update, 10, loss=0.5),
+    TopKCompressor(ratio=0.1).compress(update),
+    encoder.encode(update, peer_id=1),
+    ModelDelta(3, 2, CompressedUpdate('qsgd8', 1000, torch.ones(1000, dtype=torch.int8), scale=torch.tensor(2.))),
+  ]
+
+
+def send_encoded(conn):
+  for payload in structured_payloads():
+    conn.send_bytes(roundtrip(payload)[0])
+  conn.close()
+
+
+def assert_same(a, b):
+  if torch.is_tensor(a):
+    assert torch.equal(a, b) and a.dtype == b.dtype
+  elif isinstance(a, dict):
+    assert a.keys() == b.keys()
+    for key in a:
+      assert_same(a[key], b[key])
+  elif hasattr(a, '__slots__'):
+    assert type(a) is type(b)
+    for slot in a.__slots__:
+      assert_same(getattr(a, slot), getattr(b, slot))
+  else:
+    assert a == b
+
+
+@pytest.mark.communicator
+def test_structured_payloads_are_plain_bytes():
+  payloads = structured_payloads()
+  for payload in payloads:
+    encoded, decoded = roundtrip(payload)
+    assert_same(payload, decoded.message)
+  # Encoding leaves the sender's tensors where they are
+  assert not payloads[0]['update'].is_shared() and not payloads[1].values.is_shared()
+  # and the bytes decode after the sender is gone
+  receiver, sender = mp.Pipe(duplex=False)
+  process = mp.get_context('spawn').Process(target=send_encoded, args=(sender,))
+  process.start()
+  sender.close()
+  frames = []
+  while True:
+    try:
+      frames.append(receiver.recv_bytes())
+    except EOFError:
+      break
+  process.join()
+  assert process.exitcode == 0
+  for payload, frame in zip(payloads, frames):
+    assert_same(payload, Message.decode(frame).message)
+  assert len(frames) == len(payloads)
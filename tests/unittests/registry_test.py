@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from pyfl.models.registry import build_model, build_optimizer, clear_templates
+from pyfl.utils import get_model
+
+
+@pytest.mark.models
+def test_build_model_copies_template():
+  clear_templates()
+  first = build_model('resnet20', 100)
+  second = build_model('resnet20', 100)
+  assert first.linear.out_features == 100
+  # Same initial weights, separate storage
+  for a, b in zip(first.parameters(), second.parameters()):
+    assert torch.equal(a, b) and a.data_ptr() != b.data_ptr()
+  with torch.no_grad():
+    next(first.parameters()).add_(1.)
+  assert not torch.equal(next(first.parameters()), next(second.parameters()))
+  assert build_model('resnet20', 10).linear.out_features == 10
+  with pytest.raises(NotImplementedError):
+    build_model('alexnet')
+
+
+@pytest.mark.models
+def test_get_model_optimizer():
+  model, optim = get_model({'model': 'lenet', 'optimizer': 'sgd', 'num_classes': 10,
+                            'lr_params': {'initial_lr': 0.1, 'momentum': 0.9}})
+  assert isinstance(optim, torch.optim.SGD)
+  assert optim.param_groups[0]['lr'] == 0.1 and optim.param_groups[0]['momentum'] == 0.9
+  assert len(optim.param_groups[0]['params']) == len(list(model.parameters()))
+  optim = build_optimizer('adam', model.parameters())
+  assert isinstance(optim, torch.optim.Adam) and optim.param_groups[0]['lr'] == 0.01
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+from argparse import Namespace
+
+import pytest
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.communication.masked import MaskedEncoder
+from pyfl.communication.message import update_payload
+from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
+from pyfl.communication.socket_communicator import SocketCommunicator
+from pyfl.server.scheduler import LivenessTracker, RoundScheduler, TimerWheel
+from pyfl.server.server import Server
+
+device2server = DeviceServerMessage()
+server2device = ServerDeviceMessage()
+
+
+@pytest.mark.scheduler
+def test_timer_wheel():
+  wheel = TimerWheel(tick=0.1, num_slots=8)
+  wheel.schedule('a', 0.25, 0.)
+  wheel.schedule('b', 0.5, 0.)
+  wheel.schedule('c', 5., 0.)  # Several turns of the wheel away
+  wheel.schedule('d', 0.3, 0.)
+  wheel.cancel('d')
+  assert len(wheel) == 3
+  assert wheel.advance(0.2) == []
+  assert wheel.advance(0.3) == ['a']
+  # Rescheduling replaces the previous timer
+  wheel.schedule('b', 1., 0.3)
+  assert wheel.advance(1.) == []
+  assert wheel.advance(1.3) == ['b']
+  assert wheel.advance(4.9) == []
+  assert wheel.advance(5.) == ['c']
+  assert len(wheel) == 0
+
+
+@pytest.mark.scheduler
+def test_liveness_tracker():
+  liveness = LivenessTracker(timeout=2.)
+  assert not liveness.is_alive(1, 0.)
+  liveness.seen(1, 1.)
+  assert liveness.is_alive(1, 3.) and not liveness.is_alive(1, 3.5)
+  liveness.forget(1)
+  assert not liveness.is_alive(1, 1.)
+
+
+@pytest.mark.scheduler
+def test_round_scheduler():
+  scheduler = RoundScheduler({'clients_per_round': 8, 'quorum': 0.75, 'expected_dropout': 0.2})
+  # 8 / (1 - 0.2) devices make up for the expected dropouts
+  assert scheduler.num_to_select(100) == 10
+  assert scheduler.num_to_select(6) == 6
+  assert scheduler.quorum(10) == 6 and scheduler.quorum(4) == 4
+  # No dropouts drive the estimate down, many drive it up
+  scheduler.end_round(10, 0)
+  assert scheduler.dropout == pytest.approx(0.14)
+  scheduler.end_round(10, 10)
+  assert scheduler.dropout == pytest.approx(0.398)
+  assert scheduler.num_to_select(100) == 14
+  # Without clients_per_round a round takes every device, and waits for one
+  assert RoundScheduler({}).num_to_select(5) == 5 and RoundScheduler({}).num_to_select(0) == 1
+
+
+def fake_device(communicator, device_id, updates):
+  """
+  Reports ready, answers its first updates[device_id] selections with an
+  update and ignores the later ones, reporting ready again every time
+  """
+  encoder = MaskedEncoder()
+  ready = (device2server.D2S_NOTIF_CLASS, device2server.D2S_NOTIF_CLASS.D2S_READY, {'version': None})
+  communicator.send_message(device_id, 0, *ready)
+  rounds = 0
+  while True:
+    for message in communicator.recv_message(device_id, block=True, timeout=30):
+      if message.message_type == server2device.S2D_NOTIF_CLASS.S2D_TASK_FINISHED and \
+          message.message_class is server2device.S2D_NOTIF_CLASS:
+        return
+      if message.message_class is not server2device.S2D_NOTIF_CLASS:
+        continue
+      if rounds < len(updates) and updates[rounds] is not None:
+        update, num_samples, mask = updates[rounds]
+        if mask is not None:
+          encoder.set_mask(mask)
+          update = encoder.encode(update, 0)
+        communicator.send_message(device_id, 0, device2server.D2S_UPDATE_CLASS,
+                                  device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                                  update_payload(update, num_samples))
+      rounds += 1
+      communicator.send_message(device_id, 0, *ready)
+
+
+@pytest.mark.scheduler
+@pytest.mark.parametrize('num_aggregators', [1, 2])
+def test_server_rounds_close_on_quorum_and_deadline(num_aggregators):
+  communicator = Communicator()
+  server = Server({'server_id': 0, 'task_config': {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {}},
+                   'rounds': 2, 'clients_per_round': 3, 'quorum': 0.6, 'deadline': 2., 'heartbeat_interval': 0.1,
+                   'server_lr': 0.5, 'num_aggregators': num_aggregators, 'seed': 0,
+                   'run_args': Namespace(mask_transfer=False, model_transport='pipe')}, communicator)
+  initial = server.flat_params.weights.clone()
+  numel = initial.numel()
+  dense, masked = torch.randn(numel), torch.randn(numel)
+  mask = torch.rand(numel) > 0.5
+  # Device 1 always sends its update, device 2 (masked) only in the first round, device 3 never
+  updates = {1: [(dense, 10, None), (dense, 10, None)], 2: [(masked, 30, mask), None], 3: [None, None]}
+  threads = []
+  for device_id, device_updates in updates.items():
+    communicator.register(device_id, 0)
+    threads.append(threading.Thread(target=fake_device, args=(communicator, device_id, device_updates)))
+    threads[-1].start()
+  try:
+    asyncio.run(server.serve())
+  finally:
+    server.executor.shutdown()
+    if server.aggregator_pool is not None:
+      server.aggregator_pool.shutdown()
+  for thread in threads:
+    thread.join(30)
+  # The first round closes on the quorum of 2 updates, the masked one only moves
+  # its active weights. The second closes at the deadline with one update
+  first = (10 * dense + 30 * masked * mask) / 40
+  assert torch.allclose(server.flat_params.weights, initial - 0.5 * first - 0.5 * dense, atol=1e-5)
+  # Nobody died in the first round, the two missing updates of the second count as dropouts
+  assert server.scheduler.dropout == pytest.approx(0.3 * 2 / 3)
+  assert (server.aggregator_pool is not None) == (num_aggregators > 1)
+
+
+def late_device(communicator, device_id, updates):
+  """
+  Connects once the server is already serving, then behaves like fake_device
+  """
+  time.sleep(0.5)
+  communicator.register(device_id, 0)
+  fake_device(communicator, device_id, updates)
+
+
+@pytest.mark.scheduler
+def test_server_waits_for_devices_connecting_late():
+  communicator = SocketCommunicator(('127.0.0.1', 0))
+  communicator.listen(0)
+  server = Server({'server_id': 0, 'task_config': {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {}},
+                   'rounds': 1, 'round_timeout': 20., 'deadline': 5., 'heartbeat_interval': 0.1, 'seed': 0,
+                   'run_args': Namespace(mask_transfer=False, model_transport='pipe')}, communicator)
+  initial = server.flat_params.weights.clone()
+  update = torch.randn(initial.numel())
+  # No device is connected when the first round starts
+  thread = threading.Thread(target=late_device,
+                            args=(SocketCommunicator(communicator.address), 1, [(update, 10, None)]), daemon=True)
+  thread.start()
+  try:
+    asyncio.run(server.serve())
+  finally:
+    server.executor.shutdown()
+  thread.join(30)
+  assert torch.allclose(server.flat_params.weights, initial - update, atol=1e-5)
@@ -0,0 +1,163 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from pyfl.communication.message import Message, ready_payload, update_payload
+from pyfl.communication.message_definitions import DeviceServerMessage
+from pyfl.device.device import Device
+from pyfl.server.scheduler import TimerWheel
+from pyfl.server.selection import DeviceTable, LatencyAwarePolicy, PowerOfChoicePolicy, SelectionPolicy
+from pyfl.server.selection import StratifiedPolicy, get_selection_policy
+from pyfl.server.selector import Selector
+from pyfl.server.server import Server
+
+device2server = DeviceServerMessage()
+
+
+def make_table(num_devices, num_strata=1):
+  table = DeviceTable(capacity=4)
+  for device_id in range(num_devices):
+    table.add(device_id, stratum=device_id % num_strata)
+  table.set_available(list(range(num_devices)))
+  return table
+
+
+@pytest.mark.selection
+def test_device_table_add_remove():
+  table = make_table(10)
+  assert len(table) == 10 and table.num_available() == 10
+  table.record(3, loss=0.5, latency=2.)
+  table.record(3, latency=4.)
+  assert table.latency[table.rows[3]] == pytest.approx(0.7 * 2. + 0.3 * 4.)
+  # The last row takes the removed device's place with its statistics
+  table.record(9, loss=1.5)
+  table.remove(0)
+  assert 0 not in table and len(table) == 9
+  assert table.ids[table.rows[9]] == 9 and table.loss[table.rows[9]] == 1.5
+  assert table.loss[table.rows[3]] == 0.5
+
+
+@pytest.mark.selection
+def test_selected_devices_are_unavailable():
+  table = make_table(20)
+  policy = SelectionPolicy(seed=0)
+  first = policy.select(table, 15)
+  second = policy.select(table, 15)
+  assert len(set(first)) == 15 and len(second) == 5
+  assert not set(first) & set(second)
+  assert policy.select(table, 1) == []
+  assert table.participations[:len(table)].sum() == 20
+
+
+@pytest.mark.selection
+def test_stratified_policy_is_proportional():
+  table = make_table(1000, num_strata=4)
+  # Strata 0 and 1 have 4 times fewer ready devices than 2 and 3
+  table.set_available([device_id for device_id in range(1000) if device_id % 4 < 2 and device_id % 16 >= 4], False)
+  selected = StratifiedPolicy(seed=0).select(table, 50)
+  assert len(set(selected)) == 50
+  counts = np.bincount(np.array(selected) % 4, minlength=4)
+  assert counts.tolist() == [5, 5, 20, 20]
+
+
+@pytest.mark.selection
+def test_power_of_choice_prefers_high_loss():
+  table = make_table(100)
+  for device_id in range(100):
+    table.record(device_id, loss=float(device_id))
+  # Every device is a candidate, the highest losses win
+  assert sorted(PowerOfChoicePolicy(d=100., seed=0).select(table, 10)) == list(range(90, 100))
+  # Devices that never reported a loss come first
+  table = make_table(100)
+  table.record(0, loss=10.)
+  assert 0 not in PowerOfChoicePolicy(d=100., seed=0).select(table, 99)
+  # A d under 1 still draws enough candidates
+  assert len(PowerOfChoicePolicy(d=0.5, seed=0).select(make_table(100), 10)) == 10
+
+
+@pytest.mark.selection
+def test_latency_policy_prefers_fast_devices():
+  picks = np.zeros(100)
+  for seed in range(50):
+    table = make_table(100)
+    for device_id in range(100):
+      table.record(device_id, latency=1. if device_id < 50 else 10.)
+    picks[LatencyAwarePolicy(alpha=1., seed=seed).select(table, 10)] += 1
+  assert picks[:50].sum() > 5 * picks[50:].sum()
+  table = make_table(10)
+  assert len(set(LatencyAwarePolicy(seed=0).select(table, 5))) == 5
+
+
+@pytest.mark.selection
+def test_selection_from_many_devices_is_fast():
+  table = DeviceTable()
+  for device_id in range(100000):
+    table.add(device_id, stratum=device_id % 10)
+  table.latency[:len(table)] = np.random.default_rng(0).exponential(size=len(table))
+  for name in ['uniform', 'stratified', 'power_of_choice', 'latency']:
+    table.available[:len(table)] = True
+    policy = get_selection_policy({'selection_policy': name, 'seed': 0})
+    start = time.perf_counter()
+    selected = policy.select(table, 100)
+    assert len(set(selected)) == 100
+    assert time.perf_counter() - start < 0.1
+  with pytest.raises(NotImplementedError):
+    get_selection_policy({'selection_policy': 'oracle'})
+
+
+@pytest.mark.selection
+def test_selector_keeps_every_selected_device():
+  devices = {device_id: {'device_id': device_id, 'device_comm': None} for device_id in range(5)}
+  selector = Selector({'selector_id': 0, 'devices': devices, 'server_id': 0, 'seed': 0})
+  selected = selector.select_devices(3)
+  assert len(selected) == 3
+  assert all(selected[device_id] is devices[device_id] for device_id in selected)
+
+
+@pytest.mark.selection
+def test_server_selects_with_policy_and_records_round_times(recording_communicator):
+  communicator = recording_communicator
+  server = Server({'server_id': 0, 'selection_policy': 'power_of_choice', 'power_of_choice_d': 10., 'seed': 0},
+                  communicator)
+
+  def ready(device_id, stratum=None):
+    return Message({'sender_id': device_id, 'receiver_id': 0, 'message_class': device2server.D2S_NOTIF_CLASS,
+                    'message_type': device2server.D2S_NOTIF_CLASS.D2S_READY,
+                    'message': ready_payload(None, stratum)})
+
+  async def run():
+    loop = asyncio.get_running_loop()
+    server.ready_devices = asyncio.Queue()
+    server.updates = asyncio.Queue()
+    server.wheel = TimerWheel(tick=0.25, now=loop.time())
+    for device_id in range(6):
+      await server.handle_message(ready(device_id, stratum=device_id % 2))
+    for device_id in range(6):
+      server.device_table.record(device_id, loss=float(device_id))
+    selected = await server.select_devices(2, loop.time() + 1.)
+    await server.handle_message(Message({
+      'sender_id': 5, 'receiver_id': 0, 'message_class': device2server.D2S_UPDATE_CLASS,
+      'message_type': device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+      'message': update_payload(None, 1, loss=0.25)}))
+    return selected
+
+  selected = asyncio.run(run())
+  assert sorted(selected) == [4, 5]
+  assert [message.receiver_id for message in communicator.sent] == selected
+  table = server.device_table
+  assert table.num_available() == 4 and table.stratum[table.rows[5]] == 1
+  assert table.loss[table.rows[5]] == 0.25 and not np.isnan(table.latency[table.rows[5]])
+  assert np.isnan(table.latency[table.rows[4]])
+  server.executor.shutdown()
+
+
+@pytest.mark.selection
+def test_device_reports_its_stratum(recording_communicator):
+  communicator = recording_communicator
+  device = Device({'device_id': 1, 'server_id': 0, 'ready': 1, 'stratum': 3}, {}, communicator)
+  with pytest.raises(EOFError):
+    device.ping_server()
+  message = communicator.sent[0]
+  assert message.message_type == device2server.D2S_NOTIF_CLASS.D2S_READY and message.message['stratum'] == 3
@@ -0,0 +1,113 @@
+import pytest
+
+from pyfl.server.server import Server
+from pyfl.server.sharding import ShardMap, num_shards_for
+
+
+def assert_consistent(shard_map):
+  assert sum(len(shard_map.members(shard)) for shard in range(shard_map.num_shards)) == len(shard_map)
+  for device_id, shard in shard_map.owner.items():
+    assert device_id in shard_map.members(shard)
+
+
+@pytest.mark.sharding
+def test_num_shards_keeps_the_remainder():
+  assert num_shards_for(5, 2) == 3
+  assert num_shards_for(4, 2) == 2
+  assert num_shards_for(0, 2) == 1
+
+
+@pytest.mark.sharding
+def test_hash_sharding_moves_few_devices():
+  shard_map = ShardMap({'num_shards': 4, 'strategy': 'hash', 'tolerance': 0.5})
+  for device_id in range(1000):
+    shard_map.add(device_id)
+  assert_consistent(shard_map)
+  assert max(len(shard_map.members(shard)) for shard in range(4)) <= 375
+  before = dict(shard_map.owner)
+  moves = shard_map.add_shard()
+  # Only devices taken by the new shard move, about a fifth of them
+  assert moves and all(new_shard == 4 for _, _, new_shard in moves)
+  assert len(moves) < 300
+  assert all(shard_map.owner[device_id] == before[device_id]
+             for device_id in before if device_id not in {move[0] for move in moves})
+  # A leaving device moves nobody else
+  shard, before = shard_map.shard_of(7), dict(shard_map.owner)
+  assert shard_map.remove(7) == [(7, shard, None)]
+  assert all(shard_map.owner[device_id] == owner for device_id, owner in before.items() if device_id != 7)
+  assert_consistent(shard_map)
+
+
+@pytest.mark.sharding
+def test_shards_follow_the_number_of_devices():
+  for strategy in ['hash', 'balanced']:
+    shard_map = ShardMap({'max_devices_per_shard': 2, 'strategy': strategy})
+    for device_id in range(5):
+      shard_map.add(device_id)
+    assert shard_map.num_shards == 3
+    assert max(len(shard_map.members(shard)) for shard in range(3)) <= 2
+    shard_map.remove(0)
+    shard_map.remove(1)
+    assert shard_map.num_shards == 2 and len(shard_map) == 3
+    assert_consistent(shard_map)
+
+
+@pytest.mark.sharding
+def test_balanced_sharding_spreads_measured_load():
+  shard_map = ShardMap({'num_shards': 2, 'strategy': 'balanced', 'smoothing': 1.})
+  for device_id in range(8):
+    shard_map.add(device_id)
+  assert sorted(len(shard_map.members(shard)) for shard in range(2)) == [4, 4]
+  # Every slow device of one shard reports a large update and a long round
+  slow_shard = shard_map.shard_of(0)
+  for device_id in shard_map.members(slow_shard):
+    shard_map.record(device_id, nbytes=4000, latency=4.)
+  for device_id in shard_map.members(1 - slow_shard):
+    shard_map.record(device_id, nbytes=1000, latency=1.)
+  loads = shard_map.loads()
+  assert loads[slow_shard] > 3 * loads[1 - slow_shard]
+  moves = shard_map.rebalance()
+  assert moves and all(old == slow_shard for _, old, _ in moves)
+  loads = shard_map.loads()
+  assert loads.max() <= 1.1 * loads.mean() + max(shard_map.cost(device_id) for device_id in shard_map.owner)
+  assert shard_map.rebalance() == []
+  assert_consistent(shard_map)
+  with pytest.raises(NotImplementedError):
+    ShardMap({'strategy': 'random'})
+
+
+@pytest.mark.sharding
+def test_server_selectors_share_devices_and_rebalance():
+  server = Server({'server_id': 0, 'max_devices_per_selector': 2, 'seed': 0}, None)
+  for device_id in range(5):
+    server.devices[device_id] = {'ready': True}
+  server.spawn_selectors()
+  assert len(server.selectors) == 3
+  for selector in server.selectors:
+    for device_id, device in selector.selector_config['devices'].items():
+      assert device is server.devices[device_id]
+  server.join_shards(5)
+  server.join_shards(6)
+  assert len(server.selectors) == 4
+  for device_id in [0, 1, 2, 3]:
+    server.leave_shards(device_id)
+  assert len(server.selectors) == 2
+  owned = [device_id for selector in server.selectors for device_id in selector.selector_config['devices']]
+  assert sorted(owned) == [4, 5, 6]
+  server.executor.shutdown()
+
+
+@pytest.mark.sharding
+def test_server_selects_through_its_selectors():
+  server = Server({'server_id': 0, 'max_devices_per_selector': 2, 'seed': 0}, None)
+  server.spawn_selectors()
+  for device_id in range(6):
+    server.join_shards(device_id)
+    server.device_table.available[server.device_table.add(device_id)] = device_id != 5
+  assert len(server.selectors) == 3
+  selected = server.pick_devices(3)
+  assert len(set(selected)) == 3 and 5 not in selected
+  assert server.device_table.num_available() == 2
+  assert sorted(selected + server.pick_devices(10)) == [0, 1, 2, 3, 4]
+  assert server.pick_devices(1) == []
+  server.executor.shutdown()
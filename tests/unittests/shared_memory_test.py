@@ -0,0 +1,101 @@
+import multiprocessing as mp
+import time
+
+import pytest
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.communication.message_definitions import ServerDeviceMessage
+from pyfl.communication.shared_memory import SharedModelBuffer, SharedModelHandle
+
+server2device = ServerDeviceMessage()
+
+
+@pytest.mark.communicator
+def test_shared_model_transport():
+  weights = [torch.randn(6, 1, 5, 5), torch.randn(10, 84)]
+  shared = SharedModelBuffer.from_weights(weights)
+  assert shared.buffer.is_shared() and shared.version == 1
+
+  comm = Communicator()
+  comm.register(1, 34)
+  comm.send_message(34, 1, server2device.S2D_SEND_CLASS, server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL,
+                    shared.handle())
+  handle = comm.recv_message(1)[0].message
+  assert isinstance(handle, SharedModelHandle) and handle.version == 1
+  for received, sent in zip(handle.weights(), weights):
+    assert torch.equal(received, sent)
+
+  # A new publish is visible through the same mapping and stales old handles
+  new_weights = [w + 1 for w in weights]
+  new_handle = shared.publish(new_weights)
+  assert not handle.is_current() and new_handle.is_current()
+  with pytest.raises(RuntimeError):
+    handle.weights()
+  assert torch.equal(new_handle.weights()[1], new_weights[1])
+
+
+def publish_forever(shared, stop):
+  version = 0
+  while not stop.is_set():
+    version += 1
+    shared.publish([torch.full((1 << 20,), float(version))])
+    time.sleep(0.001)
+
+
+@pytest.mark.communicator
+def test_shared_model_reads_are_never_torn():
+  shared = SharedModelBuffer.from_weights([torch.zeros(1 << 20)])
+  stop = mp.get_context('fork').Event()
+  writer = mp.get_context('fork').Process(target=publish_forever, args=(shared, stop))
+  writer.start()
+  try:
+    reads = 0
+    for _ in range(2000):
+      try:
+        weights = shared.handle().read()
+      except RuntimeError:
+        continue
+      # A read that passed the check holds a single version
+      assert torch.equal(weights, torch.full_like(weights, weights[0].item()))
+      reads += 1
+    assert reads
+  finally:
+    stop.set()
+    writer.join()
+
+
+@pytest.mark.communicator
+def test_devices_of_a_round_share_one_version():
+  from argparse import Namespace
+
+  from pyfl.device.device import Device
+  from pyfl.server.server import Server
+
+  task_config = {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.1}}
+  server = Server({'server_id': 34, 'task_config': task_config,
+                   'run_args': Namespace(mask_transfer=False, model_transport='shared_memory')}, None)
+  comm = Communicator()
+  devices = []
+  for device_id in (1, 2):
+    comm.register(device_id, 34)
+    device = Device({'device_id': device_id, 'server_id': 34}, {}, comm)
+    device.build_device(task_config)
+    devices.append(device)
+  # Both devices of the round are handed the model before either reads it
+  for device in devices:
+    comm.send_message(34, device.device_config['device_id'], server2device.S2D_SEND_CLASS,
+                      server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL,
+                      server.model_payload(device.device_config['device_id']))
+  handles = [comm.recv_message(device.device_config['device_id'])[0].message for device in devices]
+  for device, handle in zip(devices, handles):
+    device.apply_weights(handle)
+    assert torch.equal(device.flat_params.weights, server.flat_params.weights)
+
+  # The next version is published once, by the update of the round
+  server.apply_average(torch.randn_like(server.flat_params.weights) * 0.01)
+  assert not any(handle.is_current() for handle in handles)
+  handle = server.model_payload(1)
+  assert handle.version == handles[0].version + 1
+  assert torch.equal(handle.read(), server.flat_params.weights)
+  server.executor.shutdown()
@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+import torch
+
+from pyfl.communication.communicator import Communicator
+from pyfl.device.device import Device
+from pyfl.device.simulation import SimulatedDevicePool
+from pyfl.models.flat_params import FlatParameters
+from pyfl.server.simulation import SimulationServer
+from pyfl.utils import get_model
+
+TASK_CONFIG = {'model': 'lenet', 'optimizer': 'sgd', 'lr_params': {'initial_lr': 0.1}}
+
+
+@pytest.mark.simulation
+def test_pool_matches_independent_devices():
+  torch.manual_seed(0)
+  trainset = torch.utils.data.TensorDataset(torch.randn(40, 1, 28, 28), torch.randint(0, 10, (40,)))
+  partitions = {device_id: torch.arange(device_id * 10, device_id * 10 + 10).numpy() for device_id in range(4)}
+  pool = SimulatedDevicePool({'pool_id': 1, 'server_id': 0, 'device_ids': [0, 1, 2, 3],
+                              'task_config': TASK_CONFIG, 'batch_size': 10, 'local_epochs': 2},
+                             trainset, partitions)
+  global_weights = pool.flat_params.weights.clone()
+  total, weight, count = pool.run_round(global_weights, [0, 2, 3])
+  assert count == 3 and weight == 30
+  # The skeleton is released after every client
+  assert all(device.model is None for device in pool.devices.values())
+
+  # Same result as three devices each owning a model
+  expected = torch.zeros_like(total)
+  for device_id in (0, 2, 3):
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(trainset, partitions[device_id]), batch_size=10)
+    device = Device({'device_id': device_id, 'server_id': 0}, {'trainset': loader}, None)
+    device.build_device(TASK_CONFIG)
+    device.apply_weights(global_weights)
+    device.train_step()
+    device.train_step()
+    expected += device.gradient_updates * 10
+  assert torch.allclose(total, expected, atol=1e-5)
+
+
+@pytest.mark.simulation
+@pytest.mark.parametrize('lr_params', [{'initial_lr': 0.1},
+                                       {'initial_lr': 0.05, 'momentum': 0.9, 'weight_decay': 5e-4},
+                                       {'initial_lr': 0.05, 'momentum': 0.9, 'nesterov': True}])
+def test_vectorized_pool_matches_sequential_pool(lr_params):
+  torch.manual_seed(0)
+  trainset = torch.utils.data.TensorDataset(torch.randn(45, 1, 28, 28), torch.randint(0, 10, (45,)))
+  # Uneven shards: ragged last batches and a device running out of data early
+  partitions = {0: torch.arange(0, 10).numpy(), 1: torch.arange(10, 17).numpy(), 2: torch.arange(17, 45).numpy()}
+  pool_config = {'pool_id': 1, 'server_id': 0, 'device_ids': [0, 1, 2],
+                 'task_config': dict(TASK_CONFIG, lr_params=lr_params), 'batch_size': 10, 'local_epochs': 2}
+  pools = [SimulatedDevicePool(pool_config, trainset, partitions),
+           SimulatedDevicePool(dict(pool_config, vectorize=3), trainset, partitions)]
+  for pool in pools:
+    for device in pool.devices.values():
+      device.dataset['trainset'] = torch.utils.data.DataLoader(device.dataset['trainset'].dataset, batch_size=10)
+  global_weights = pools[0].flat_params.weights.clone()
+  # The second round starts from the momentum the devices kept
+  for _ in range(2):
+    sequential, vectorized = (pool.run_round(global_weights) for pool in pools)
+    assert sequential[1:] == vectorized[1:] == (45, 3)
+    assert torch.allclose(sequential[0], vectorized[0], atol=1e-4)
+
+
+@pytest.mark.simulation
+def test_async_server_never_waits_for_stragglers():
+  torch.manual_seed(0)
+  trainset = torch.utils.data.TensorDataset(torch.randn(40, 1, 28, 28), torch.randint(0, 10, (40,)))
+  partitions = {device_id: torch.arange(device_id * 10, device_id * 10 + 10).numpy() for device_id in range(4)}
+  communicator = Communicator()
+  threads = []
+  # Worker 1 only hosts a straggler
+  for worker_id, device_ids, latency in ((1, [0], 1.), (2, [1, 2, 3], 0.)):
+    communicator.register(worker_id, 0)
+    pool = SimulatedDevicePool({'pool_id': worker_id, 'server_id': 0, 'device_ids': device_ids,
+                                'task_config': TASK_CONFIG, 'batch_size': 10, 'local_epochs': 1,
+                                'latency': {device_ids[0]: latency}}, trainset, partitions, communicator)
+    threads.append(threading.Thread(target=pool.serve))
+    threads[-1].start()
+  model, _ = get_model(TASK_CONFIG)
+  global_weights = FlatParameters(model).weights
+  initial = global_weights.clone()
+  server = SimulationServer({'server_id': 0, 'owners': {0: 1, 1: 2, 2: 2, 3: 2}, 'buffer_size': 2},
+                            communicator, global_weights, evaluate=lambda: 0.)
+  timeline = server.run_async(3)
+  server.stop_workers()
+  for thread in threads:
+    thread.join()
+  assert [version for _, version, _ in timeline.points] == [1, 2, 3]
+  # The three versions were published by the fast worker alone, before the straggler came back
+  assert timeline.points[-1][0] < 1.
+  assert not torch.equal(global_weights, initial)
+
+
+@pytest.mark.simulation
+def test_server_hands_out_a_copy_per_version(recording_communicator):
+  communicator = recording_communicator
+  global_weights = torch.zeros(10)
+  server = SimulationServer({'server_id': 0, 'owners': {0: 1, 1: 2}, 'server_lr': 0.5}, communicator, global_weights)
+  server.send_work(1, [0], version=0)
+  server.send_work(2, [1], version=0)
+  server.apply(torch.ones(10), 1)
+  server.send_work(1, [0], version=1)
+  first, second, third = [message.message['weights'] for message in communicator.sent]
+  # One copy per version, untouched by the server step
+  assert first is second and torch.equal(first, torch.zeros(10))
+  assert torch.equal(global_weights, torch.full((10,), -0.5)) and torch.equal(third, global_weights)
+  assert third is not global_weights
@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing as mp
+import socket
+import threading
+
+import pytest
+import torch
+
+from pyfl.communication.compression import TopKCompressor
+from pyfl.communication.message_definitions import DeviceServerMessage, ServerDeviceMessage
+from pyfl.communication.socket_communicator import SocketCommunicator
+
+device2server = DeviceServerMessage()
+server2device = ServerDeviceMessage()
+
+
+def device(comm, device_id):
+  comm.register(device_id, 0)
+  comm.send_message(device_id, 0, device2server.D2S_UPDATE_CLASS,
+                    device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                    {'update': torch.full((300000,), float(device_id)), 'num_samples': device_id})
+  reply = comm.recv_message(device_id, block=True, timeout=30)
+  assert reply[0].message_type == server2device.S2D_NOTIF_CLASS.S2D_SELECTED
+
+
+@pytest.mark.communicator
+def test_tcp_many_device_processes():
+  comm = SocketCommunicator(('127.0.0.1', 0))
+  comm.listen(0)
+  # Fork: the devices only need the address, nothing is shared with the server
+  processes = [mp.get_context('fork').Process(target=device, args=(comm, device_id)) for device_id in range(1, 9)]
+  for p in processes:
+    p.start()
+  updates = {}
+  while len(updates) < len(processes):
+    messages = comm.recv_message(0, block=True, timeout=30)
+    assert messages, 'Timed out waiting for the devices'
+    for message in messages:
+      updates[message.sender_id] = message.message['update']
+      comm.send_message(0, message.sender_id, server2device.S2D_NOTIF_CLASS,
+                        server2device.S2D_NOTIF_CLASS.S2D_SELECTED, None)
+  for p in processes:
+    p.join()
+  assert [p.exitcode for p in processes] == [0] * len(processes)
+  assert sorted(updates) == list(range(1, 9))
+  assert all(torch.equal(update, torch.full((300000,), float(i))) for i, update in updates.items())
+
+
+def send_and_exit(comm):
+  comm.register(1, 0)
+  comm.send_message(1, 0, device2server.D2S_UPDATE_CLASS,
+                    device2server.D2S_UPDATE_CLASS.D2S_SEND_GRADIENT_UPDATES,
+                    {'update': torch.arange(1000.).share_memory_(),
+                     'compressed': TopKCompressor(ratio=0.1).compress(torch.arange(1000.)), 'num_samples': 5})
+
+
+@pytest.mark.communicator
+def test_tcp_payloads_outlive_the_sender():
+  comm = SocketCommunicator(('127.0.0.1', 0))
+  comm.listen(0)
+  process = mp.get_context('spawn').Process(target=send_and_exit, args=(comm,))
+  process.start()
+  process.join()
+  assert process.exitcode == 0
+  # The sender and its shared memory are gone before the frame is decoded
+  messages = []
+  while not messages:
+    messages = comm.recv_message(0, block=True, timeout=30)
+  payload = messages[0].message
+  assert torch.equal(payload['update'], torch.arange(1000.)) and payload['num_samples'] == 5
+  assert payload['compressed'].values.sort().values.equal(torch.arange(900., 1000.))
+
+
+@pytest.mark.communicator
+def test_unix_socket_async_peers(tmp_path):
+  server = SocketCommunicator(str(tmp_path / 'pyfl.sock'))
+  server.listen(0)
+  devices = SocketCommunicator(server.address)
+
+  def connect():
+    for device_id in (1, 2, 3):
+      devices.register(device_id, 0)
+      devices.send_message(device_id, 0, device2server.D2S_NOTIF_CLASS,
+                           device2server.D2S_NOTIF_CLASS.D2S_READY, None)
+
+  async def serve():
+    ready = []
+    peers = server.new_peers(0)
+    thread = threading.Thread(target=connect)
+    thread.start()
+    for _ in range(3):
+      device_id = await asyncio.wait_for(peers.__anext__(), timeout=10)
+      messages = await asyncio.wait_for(server.recv_message_from(0, device_id), timeout=10)
+      ready.extend(message.sender_id for message in messages)
+    thread.join()
+    devices.unregister(1, 0)
+    with pytest.raises(EOFError):
+      await asyncio.wait_for(server.recv_message_from(0, 1), timeout=10)
+    return ready
+
+  assert asyncio.run(serve()) == [1, 2, 3]
+  assert sorted(server.peers(0)) == [2, 3]
+
+
+@pytest.mark.communicator
+def test_stalled_peers_do_not_block_the_loop():
+  server = SocketCommunicator(('127.0.0.1', 0), handshake_timeout=1.)
+  server.listen(0)
+  devices = SocketCommunicator(server.address)
+  model = torch.randn(1 << 22)
+
+  def receive(count):
+    received = []
+    while len(received) < count:
+      received.extend(devices.recv_message(1, block=True, timeout=30))
+    return received
+
+  async def serve():
+    loop = asyncio.get_running_loop()
+    peers = server.new_peers(0)
+    # Connects and never sends its id
+    stalled = socket.create_connection(server.address)
+    stalled.settimeout(10)
+    await asyncio.sleep(0.1)
+    await loop.run_in_executor(None, devices.register, 1, 0)
+    assert await asyncio.wait_for(peers.__anext__(), timeout=0.5) == 1
+    # The device reads nothing yet, far more than the socket buffers is queued
+    for _ in range(4):
+      server.send_message(0, 1, server2device.S2D_SEND_CLASS, server2device.S2D_SEND_CLASS.S2D_SEND_GLOBAL_MODEL,
+                          model)
+    received = await loop.run_in_executor(None, receive, 4)
+    # The stalled connection is dropped at the handshake timeout
+    assert await loop.run_in_executor(None, stalled.recv, 1) == b''
+    stalled.close()
+    await peers.aclose()
+    return received
+
+  received = asyncio.run(serve())
+  assert all(torch.equal(message.message, model) for message in received)